@@ -0,0 +1,198 @@
+'''
+Manifest of a ScanNet++ data dir: which assets of ScannetppScene_Release exist for
+every scene, with file sizes, the number of files in the asset dirs and image sizes.
+
+The manifest is a single JSON file in the data dir (the dir containing the scene dirs),
+built once by scanning all scenes in parallel. Scenes opened with the manifest answer
+existence and metadata queries from it instead of touching the (networked) storage.
+The manifest reflects the data at the time of the scan, rebuild it after changing the data.
+
+Build the manifest:
+    python -m common.data_manifest --data_root DATA_ROOT/data
+'''
+
+import argparse
+import functools
+import json
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tqdm import tqdm
+
+from common.scene_release import ScannetppScene_Release
+from common.utils.colmap import read_cameras_text
+
+MANIFEST_NAME = "data_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def _asset_names(suffix):
+    return [
+        name for name, value in vars(ScannetppScene_Release).items()
+        if isinstance(value, property) and name.endswith(suffix)
+    ]
+
+
+# path properties of the scene are file assets, dir properties are dir assets
+FILE_ASSETS = _asset_names("_path")
+DIR_ASSETS = _asset_names("_dir")
+
+
+def _camera_size(colmap_dir):
+    cameras = read_cameras_text(colmap_dir / "cameras.txt")
+    camera = next(iter(cameras.values()))
+    return [int(camera.width), int(camera.height)]
+
+
+def _scene_metadata(scene, files):
+    '''
+    image sizes [width, height] and frame counts that can be read cheaply
+    '''
+    meta = {}
+    if "dslr_nerfstudio_transform_path" in files:
+        with open(scene.dslr_nerfstudio_transform_path) as f:
+            transforms = json.load(f)
+        meta["dslr_image_size"] = [int(transforms["w"]), int(transforms["h"])]
+        meta["dslr_num_frames"] = len(transforms.get("frames", []))
+        meta["dslr_num_test_frames"] = len(transforms.get("test_frames", []))
+    for device, colmap_dir in (("dslr", scene.dslr_colmap_dir), ("iphone", scene.iphone_colmap_dir)):
+        if (colmap_dir / "cameras.txt").is_file():
+            meta[f"{device}_camera_size"] = _camera_size(colmap_dir)
+    return meta
+
+
+def scan_scene(scene):
+    """Scan the assets of a scene.
+
+    Returns:
+        Dict with files (asset -> size in bytes), dirs (asset -> number of files)
+        and meta (see _scene_metadata) for the assets that exist.
+    """
+    files = {}
+    for name in FILE_ASSETS:
+        try:
+            st = os.stat(getattr(scene, name))
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files[name] = st.st_size
+
+    dirs = {}
+    # several properties point to the same dir, list each dir once
+    num_files = {}
+    for name in DIR_ASSETS:
+        path = getattr(scene, name)
+        if path not in num_files:
+            try:
+                with os.scandir(path) as it:
+                    num_files[path] = sum(1 for entry in it if entry.is_file())
+            except OSError:
+                num_files[path] = None
+        if num_files[path] is not None:
+            dirs[name] = num_files[path]
+
+    return {"files": files, "dirs": dirs, "meta": _scene_metadata(scene, files)}
+
+
+class DataManifest:
+    """Assets of all scenes of a data dir, see the module docstring.
+
+    Args:
+        data_root: Dir containing the scene dirs.
+        scenes: Dict scene_id -> output of scan_scene.
+    """
+
+    def __init__(self, data_root, scenes=None, created=None):
+        self.data_root = Path(data_root)
+        self.scenes = scenes if scenes is not None else {}
+        self.created = created
+
+    @property
+    def path(self):
+        return self.data_root / MANIFEST_NAME
+
+    @property
+    def scene_ids(self):
+        return list(self.scenes)
+
+    def __contains__(self, scene_id):
+        return scene_id in self.scenes
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def get(self, scene_id):
+        """Entry of a scene, None if the scene was not scanned."""
+        return self.scenes.get(scene_id)
+
+    @classmethod
+    def build(cls, data_root, scene_ids=None, num_threads=16):
+        """Scan the scenes of a data dir in parallel.
+
+        Args:
+            scene_ids: Scenes to scan, all dirs in data_root by default.
+            num_threads: Number of scenes scanned concurrently, scanning is I/O bound.
+        """
+        data_root = Path(data_root)
+        if scene_ids is None:
+            with os.scandir(data_root) as it:
+                scene_ids = sorted(entry.name for entry in it if entry.is_dir())
+        scenes = [ScannetppScene_Release(scene_id, data_root=data_root) for scene_id in scene_ids]
+        with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+            entries = list(tqdm(executor.map(scan_scene, scenes), total=len(scenes), desc="scene"))
+        return cls(data_root, dict(zip(scene_ids, entries)), created=time.time())
+
+    @classmethod
+    def load(cls, data_root):
+        """Load the manifest of a data dir, None if there is none."""
+        path = Path(data_root) / MANIFEST_NAME
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        if data.get("version") != MANIFEST_VERSION:
+            print(f"Ignoring outdated data manifest: {path}")
+            return None
+        return cls(data_root, data["scenes"], created=data.get("created"))
+
+    def save(self):
+        tmp_path = self.path.parent / f".{self.path.name}.tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "created": self.created, "scenes": self.scenes}, f)
+        os.replace(tmp_path, self.path)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_data_manifest(data_root):
+    return DataManifest.load(data_root)
+
+
+def load_data_manifest(data_root):
+    """DataManifest of a data dir, loaded once per process. None if there is none."""
+    return _load_data_manifest(str(Path(data_root).resolve()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the manifest of a ScanNet++ data dir")
+    parser.add_argument("--data_root", required=True, help="dir containing the scene dirs, e.g. DATA_ROOT/data")
+    parser.add_argument("--scene_list", default=None, help="txt file with the scenes to scan, default all")
+    parser.add_argument("--num_threads", type=int, default=16)
+    args = parser.parse_args()
+
+    scene_ids = None
+    if args.scene_list is not None:
+        with open(args.scene_list) as f:
+            scene_ids = [line.strip() for line in f if len(line.strip()) > 0]
+
+    start = time.perf_counter()
+    manifest = DataManifest.build(args.data_root, scene_ids, num_threads=args.num_threads)
+    manifest.save()
+    print(f"Scanned {len(manifest)} scenes in {time.perf_counter() - start:.1f}s, wrote {manifest.path}")
+
+
+if __name__ == "__main__":
+    main()
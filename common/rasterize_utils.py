@@ -1,15 +1,30 @@
 
 
-from scannetpp.common.utils.colmap import read_cameras_text, read_images_text
-import torch
+from scannetpp.common.utils.colmap import world_to_camera_batch, image_poses
+from scannetpp.common.utils.cpu_rasterizer import CPUCamera, rasterize_mesh_cpu
+from scannetpp.common.utils.face_index import remap_pix_to_face
 import numpy as np
 
-from pytorch3d.structures import Meshes
-from pytorch3d.utils import cameras_from_opencv_projection
-from pytorch3d.renderer import (
-    RasterizationSettings, 
-    MeshRasterizer,  
-)
+# torch and pytorch3d are only needed for the pytorch3d backend, the cpu backend
+# (common/utils/cpu_rasterizer.py) runs without them
+try:
+    import torch
+except ImportError:
+    torch = None
+try:
+    from pytorch3d.structures import Meshes
+    from pytorch3d.utils import cameras_from_opencv_projection
+    from pytorch3d.renderer import (
+        RasterizationSettings, 
+        MeshRasterizer,  
+        fisheyecameras
+    )
+except ImportError:
+    Meshes = None
+
+RASTER_BACKENDS = ("pytorch3d", "cpu")
+# memory for the meshes and outputs of a mini-batch in rasterize_mesh_batched
+DEFAULT_BATCH_BYTES = 2**30
 
 def get_vtx_prop_on_2d(pix_to_face, vtx_prop, mesh):
     '''
@@ -32,15 +47,30 @@ def get_vtx_prop_on_2d(pix_to_face, vtx_prop, mesh):
 
     return pix_vtx_prop.squeeze()
 
-def get_opencv_cameras(pose, img_height, img_width, intrinsic_mat):
-    # get 2d-3d mapping of this image by rasterizing, add a dimension in the beginning
-    R = torch.Tensor(pose[:3, :3]).unsqueeze(0)
-    T = torch.Tensor(pose[:3, 3]).unsqueeze(0)
+def get_opencv_cameras(pose, img_height, img_width, intrinsic_mat, backend='pytorch3d',
+                       camera_model='PINHOLE', distort_params=None):
+    '''
+    pose: world to camera (4, 4), or (N, 4, 4) for a batch of N cameras built in one call
+    backend: pytorch3d -> pytorch3d cameras, fisheye cameras for OPENCV_FISHEYE
+             cpu -> CPUCamera (list for a batch), also with OPENCV and OPENCV_FISHEYE distortion
+    '''
+    poses = np.asarray(pose).reshape(-1, 4, 4)
+    if backend == 'cpu':
+        cameras = [
+            CPUCamera(p, np.asarray(intrinsic_mat), img_height, img_width, camera_model, distort_params)
+            for p in poses
+        ]
+        return cameras[0] if np.ndim(pose) == 2 else cameras
+
+    # get 2d-3d mapping of this image by rasterizing, N in the first dimension
+    num_cameras = len(poses)
+    R = torch.Tensor(poses[:, :3, :3])
+    T = torch.Tensor(poses[:, :3, 3])
 
     # create camera with opencv function
     image_size = torch.Tensor((img_height, img_width))
-    image_size_repeat = torch.tile(image_size.reshape(-1, 2), (1, 1))
-    intrinsic_repeat = torch.Tensor(intrinsic_mat).unsqueeze(0).expand(1, -1, -1)
+    image_size_repeat = torch.tile(image_size.reshape(-1, 2), (num_cameras, 1))
+    intrinsic_repeat = torch.Tensor(intrinsic_mat).unsqueeze(0).expand(num_cameras, -1, -1)
     
     opencv_cameras = cameras_from_opencv_projection(
         # N, 3, 3
@@ -52,12 +82,42 @@ def get_opencv_cameras(pose, img_height, img_width, intrinsic_mat):
         # N, 2 h,w
         image_size=image_size_repeat
     )
+    if camera_model != 'OPENCV_FISHEYE':
+        return opencv_cameras
+
+    # apply the same transformation for fisheye cameras 
+    # transpose R, then negate 1st and 2nd columns
+    fisheye_R = R.mT
+    fisheye_R[:, :, :2] *= -1
+    # negate x and y in the transformation T
+    # negate everything
+    fisheye_T = -T
+    # negate z back
+    fisheye_T[:, -1] *= -1
 
-    return opencv_cameras
+    # need 6 radial params
+    radial_params = list(distort_params[:4]) + [0, 0]
+    # focal, center, radial_params, R, T, use_radial
+    return fisheyecameras.FishEyeCameras(
+        focal_length=opencv_cameras.focal_length,
+        principal_point=opencv_cameras.principal_point,
+        radial_params=torch.Tensor([radial_params]).repeat(num_cameras, 1),
+        use_radial=True,
+        R=fisheye_R,
+        T=fisheye_T,
+        image_size=image_size_repeat,
+        # need to specify world coordinates, otherwise camera coordinates
+        world_coordinates=True
+    )
 
-def prep_pt3d_inputs(mesh, device='cuda'):
+def prep_pt3d_inputs(mesh, device='cuda', backend='pytorch3d'):
+    '''
+    returns: vertices, faces and the mesh for rasterize_mesh, (vertices, faces) for the cpu backend
+    '''
     verts = np.array(mesh.vertices)
     faces = np.array(mesh.triangles)
+    if backend == 'cpu':
+        return verts, faces, (verts, faces)
     meshes = Meshes(verts=[torch.Tensor(verts).to(device)], faces=[torch.Tensor(faces).to(device)])
 
     return verts, faces, meshes
@@ -66,37 +126,62 @@ def get_camera_images_poses(scene, image_type, subsample_factor=1):
     # TODO: unify iphone and dslr code
 
     if image_type == 'iphone':
-        # read camera intrinsics
-        intrinsics_file = scene.iphone_colmap_dir / 'cameras.txt'
+        # read camera intrinsics and extrinsics, shared through the asset cache
+        cameras, all_extrinsics, _ = scene.load_colmap_model('iphone', pose_only=True)
         # there is only 1 camera model, get it
-        colmap_camera = list(read_cameras_text(intrinsics_file).values())[0]
+        colmap_camera = list(cameras.values())[0]
         # params [0,1,2,3] give the intrinsic
-        extrinsics_file = scene.iphone_colmap_dir / 'images.txt'
-        # dict with key 0,1,2, value has the same "id"
-        all_extrinsics = read_images_text(extrinsics_file)
+        # mapping with key 0,1,2, value has the same "id"
         # sort by id and get list of objects
         all_extrinsics = [all_extrinsics[k] for k in sorted(all_extrinsics.keys())]
         # subsample with cfg.subsample_factor
         subsampled_extrinsics = all_extrinsics[::subsample_factor]
         image_names = [e.name for e in subsampled_extrinsics]
-        poses = [e.to_transform_mat() for e in subsampled_extrinsics]
+        poses = list(world_to_camera_batch(*image_poses(subsampled_extrinsics)))
     else:
         raise NotImplementedError
 
     return colmap_camera, image_names, poses
 
 
-def rasterize_mesh_and_cache(meshes, img_height, img_width, opencv_cameras, rasterout_path):
+def rasterize_mesh_and_cache(meshes, img_height, img_width, opencv_cameras, rasterout_path, backend='pytorch3d',
+                             face_ids=None):
     if rasterout_path.exists():
         raster_out_dict = torch.load(rasterout_path)
     else:
         # rasterize mesh onto image and get mapping
-        raster_out_dict = rasterize_mesh(meshes, img_height, img_width, opencv_cameras)
+        raster_out_dict = rasterize_mesh(meshes, img_height, img_width, opencv_cameras, backend=backend,
+                                         face_ids=face_ids)
         torch.save(raster_out_dict, rasterout_path)
 
     return raster_out_dict
 
-def rasterize_mesh(meshes, img_height, img_width, cameras, device='cuda'):
+def rasterize_mesh(meshes, img_height, img_width, cameras, device='cuda', backend='pytorch3d', face_ids=None):
+    '''
+    backend: pytorch3d, or cpu with meshes and cameras from prep_pt3d_inputs and
+        get_opencv_cameras with backend='cpu'
+    face_ids: rasterize only these faces, e.g. the faces in the frustum from
+        scene.load_face_index().query(...), pix_to_face still refers to all faces
+    returns: dict with pix_to_face, zbuf, bary_coords and dists of shape (1, H, W, 1(, 3)),
+        torch tensors if torch is installed
+    '''
+    assert backend in RASTER_BACKENDS, f'Unknown rasterization backend: {backend}'
+    if backend == 'cpu':
+        verts, faces = meshes
+        raster_out = rasterize_mesh_cpu(
+            verts, faces, cameras.world_to_camera, cameras.K, img_height, img_width,
+            cameras.camera_model, cameras.dist_params, face_ids=face_ids,
+        )
+        raster_out_dict = {
+            'pix_to_face': raster_out['pix_to_face'][None, :, :, None],
+            'zbuf': raster_out['zbuf'][None, :, :, None],
+            'bary_coords': raster_out['bary_coords'][None, :, :, None, :],
+            'dists': raster_out['dists'][None, :, :, None],
+        }
+        if torch is not None:
+            raster_out_dict = {k: torch.from_numpy(v) for k, v in raster_out_dict.items()}
+        return raster_out_dict
+
     raster_settings = RasterizationSettings(image_size=(img_height, img_width), 
                                                     blur_radius=0.0, 
                                                     faces_per_pixel=1,
@@ -105,14 +190,115 @@ def rasterize_mesh(meshes, img_height, img_width, cameras, device='cuda'):
         raster_settings=raster_settings
     )
 
+    if face_ids is not None:
+        # the subset mesh shares the vertex tensor
+        face_ids = torch.as_tensor(face_ids, device=meshes.device)
+        meshes = Meshes(verts=meshes.verts_list(), faces=[meshes.faces_list()[0][face_ids]])
+
     with torch.no_grad():
         raster_out = rasterizer(meshes, cameras=cameras.to(device))
 
+    pix_to_face = raster_out.pix_to_face
+    if face_ids is not None:
+        pix_to_face = remap_pix_to_face(pix_to_face, face_ids)
+
     raster_out_dict = {
-        'pix_to_face': raster_out.pix_to_face.cpu(),
+        'pix_to_face': pix_to_face.cpu(),
         'zbuf': raster_out.zbuf.cpu(),
         'bary_coords': raster_out.bary_coords.cpu(),
         'dists': raster_out.dists.cpu(),
     }
 
     return raster_out_dict
+
+def raster_batch_size(num_verts, num_faces, img_height, img_width, max_bytes=DEFAULT_BATCH_BYTES):
+    '''
+    number of cameras per mini-batch so that the per-camera tensors pytorch3d builds for a
+    batch fit into max_bytes. per camera, the batch holds a packed copy of the mesh (float32
+    verts, int64 faces and their mesh indices), the verts transformed to view and screen space
+    with the packed verts of the transformed mesh, the float32 face_verts (3 x 3 per face) the
+    rasterizer reads, and the outputs (pix_to_face, zbuf, bary_coords, dists)
+    '''
+    packed_mesh = num_verts * (3 * 4 + 8) + num_faces * (3 * 8 + 8)
+    transformed_verts = 3 * num_verts * 3 * 4
+    face_verts = num_faces * 3 * 3 * 4
+    outputs = img_height * img_width * (8 + 4 + 12 + 4)
+    bytes_per_camera = packed_mesh + transformed_verts + face_verts + outputs
+    return max(int(max_bytes // bytes_per_camera), 1)
+
+def rasterize_mesh_batched(meshes, img_height, img_width, poses, intrinsic_mat, callback, batch_size=None,
+                           device='cuda', backend='pytorch3d', camera_model='PINHOLE', distort_params=None,
+                           face_index=None):
+    '''
+    rasterize the mesh with N cameras that share the intrinsics, in mini-batches
+    meshes: from prep_pt3d_inputs
+    poses: world to camera (N, 4, 4)
+    callback: called with (index of the pose, raster_out_dict) for every camera as soon as its
+        mini-batch is done, raster_out_dict as returned by rasterize_mesh
+    batch_size: cameras per mini-batch, default from raster_batch_size
+    face_index: optional FaceGrid, rasterize only the faces in the frustum of each camera
+    returns: number of rasterized cameras
+    '''
+    assert backend in RASTER_BACKENDS, f'Unknown rasterization backend: {backend}'
+    poses = np.asarray(poses).reshape(-1, 4, 4)
+    dist_params = distort_params if distort_params is not None else []
+
+    def query(pose):
+        if face_index is None:
+            return None
+        return face_index.query(pose, intrinsic_mat, img_height, img_width, camera_model, dist_params)
+
+    if backend == 'cpu':
+        # the cpu backend parallelizes within a camera
+        for idx, camera in enumerate(get_opencv_cameras(poses, img_height, img_width, intrinsic_mat, backend='cpu',
+                                                        camera_model=camera_model, distort_params=distort_params)):
+            callback(idx, rasterize_mesh(meshes, img_height, img_width, camera, backend='cpu',
+                                         face_ids=query(camera.world_to_camera)))
+        return len(poses)
+
+    verts = meshes.verts_list()[0]
+    faces = meshes.faces_list()[0]
+    if batch_size is None:
+        batch_size = raster_batch_size(len(verts), len(faces), img_height, img_width)
+
+    # the settings and the rasterizer are the same for all batches
+    raster_settings = RasterizationSettings(image_size=(img_height, img_width), 
+                                            blur_radius=0.0, 
+                                            faces_per_pixel=1,
+                                            cull_to_frustum=True)
+    rasterizer = MeshRasterizer(
+        raster_settings=raster_settings
+    )
+
+    for start in range(0, len(poses), batch_size):
+        batch_poses = poses[start:start + batch_size]
+        num_cameras = len(batch_poses)
+        # all cameras of the batch in one call
+        cameras = get_opencv_cameras(batch_poses, img_height, img_width, intrinsic_mat,
+                                     camera_model=camera_model, distort_params=distort_params)
+        # one mesh per camera, pytorch3d packs the verts and faces of all cameras of the
+        # batch into new tensors, see raster_batch_size for the memory per camera
+        if face_index is not None:
+            face_ids = [torch.as_tensor(query(pose), device=faces.device) for pose in batch_poses]
+            batch_meshes = Meshes(verts=[verts] * num_cameras, faces=[faces[ids] for ids in face_ids])
+        else:
+            face_ids = None
+            batch_meshes = Meshes(verts=[verts] * num_cameras, faces=[faces] * num_cameras)
+
+        with torch.no_grad():
+            raster_out = rasterizer(batch_meshes, cameras=cameras.to(device))
+
+        # pix_to_face indexes the packed faces of the batch
+        first_face = batch_meshes.mesh_to_faces_packed_first_idx()
+        for i in range(num_cameras):
+            pix_to_face = raster_out.pix_to_face[i:i + 1]
+            pix_to_face = torch.where(pix_to_face >= 0, pix_to_face - first_face[i], pix_to_face)
+            if face_ids is not None:
+                pix_to_face = remap_pix_to_face(pix_to_face, face_ids[i])
+            callback(start + i, {
+                'pix_to_face': pix_to_face.cpu(),
+                'zbuf': raster_out.zbuf[i:i + 1].cpu(),
+                'bary_coords': raster_out.bary_coords[i:i + 1].cpu(),
+                'dists': raster_out.dists[i:i + 1].cpu(),
+            })
+    return len(poses)
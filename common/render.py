@@ -9,14 +9,94 @@ from tqdm import tqdm
 try:
     import renderpy
 except ImportError:
-    print("renderpy not installed. Please install renderpy from https://github.com/liu115/renderpy")
-    sys.exit(1)
+    renderpy = None
 
-from common.utils.colmap import read_model, write_model, Image
+from common.utils.colmap import write_model, Image, world_to_camera_batch, image_poses, compute_resize_intrinsic
+from common.utils.cpu_rasterizer import CPURender
 from common.scene_release import ScannetppScene_Release
+from common.utils.depth_container import DepthContainerWriter
+from common.utils.pipeline import FramePipeline
 from common.utils.utils import run_command, load_yaml_munch, load_json, read_txt_list
 
 
+def depth_to_output(depth, dtype):
+    '''
+    rendered depth in m to uint16 in mm (clipped to fit 16 bits) or float32 in m
+    '''
+    if dtype == "float32":
+        return depth.astype(np.float32)
+    return (depth.astype(np.float32) * 1000).clip(0, 65535).astype(np.uint16)
+
+
+def select_frames(names, scene, device, cfg):
+    '''
+    indices of the frames to render: the explicit frame_names, or the train or test images
+    of the DSLR train_test_lists.json (frame_split), then subsampled with frame_stride
+    '''
+    indices = list(range(len(names)))
+    if cfg.get("frame_names"):
+        selected = set(cfg.frame_names)
+        indices = [idx for idx in indices if names[idx] in selected]
+    elif cfg.get("frame_split", "all") != "all":
+        split = cfg.frame_split
+        assert split in ("train", "test"), f"Unknown frame_split: {split}"
+        assert device == "dslr", "frame_split is only available for the DSLR"
+        selected = set(scene.load_train_test_lists()[split])
+        indices = [idx for idx in indices if names[idx] in selected]
+    return indices[::cfg.get("frame_stride", 1)]
+
+
+def render_frames(render_engine, names, world_to_cameras, near, far, rgb_dir, depth_dir,
+                  depth_container=None, vert_dir=None, pipeline_args=None, desc=None):
+    """Render frames and write them in background threads.
+
+    Rendering runs in the calling thread, which owns the GL context, while the outputs
+    are encoded and written by writer threads. Outputs without a dir are not written.
+
+    Args:
+        names: Image names, the outputs are rgb_dir/name, depth_dir/stem.png and
+            vert_dir/stem.npz.
+        world_to_cameras: (N, 4, 4) poses.
+        rgb_dir, depth_dir: Output dirs of the RGB and depth images, or None.
+        depth_container: Optional DepthContainerWriter, depth frames are appended to it
+            in order instead of being written as PNG.
+        vert_dir: Optional output dir of the per-pixel vertex indices.
+        pipeline_args: Dict with num_writers and queue_size for FramePipeline.
+    Returns:
+        PipelineStats of the run.
+    """
+    depth_dtype = "uint16" if depth_container is None else depth_container.dtype.name
+    write_depth = depth_dir is not None and depth_container is None
+
+    def read(idx):
+        return world_to_cameras[idx]
+
+    def render(idx, world_to_camera):
+        rgb, depth, vert_indices = render_engine.renderAll(world_to_camera, near, far)
+        if depth_container is not None:
+            # a single reader keeps the frames in order
+            depth_container.write(depth_to_output(depth, depth_dtype), names[idx])
+        return (
+            rgb.astype(np.uint8) if rgb_dir is not None else None,
+            depth_to_output(depth, depth_dtype) if write_depth else None,
+            vert_indices if vert_dir is not None else None,
+        )
+
+    def write(idx, result):
+        rgb, depth, vert_indices = result
+        stem = names[idx].split(".")[0]
+        if rgb is not None:
+            imageio.imwrite(rgb_dir / names[idx], rgb)
+        if depth is not None:
+            imageio.imwrite(depth_dir / (stem + ".png"), depth)
+        if vert_indices is not None:
+            np.savez_compressed(vert_dir / (stem + ".npz"), vert_indices=vert_indices)
+
+    pipeline_args = dict(pipeline_args or {})
+    pipeline = FramePipeline(read, render, write, num_readers=1, **pipeline_args)
+    return pipeline.run(range(len(names)), desc=desc)
+
+
 def main(args):
     cfg = load_yaml_munch(args.config_file)
 
@@ -41,44 +121,118 @@ def main(args):
     if cfg.get("render_iphone", False):
         render_devices.append("iphone")
 
+    # load the COLMAP models from their binary caches, see common/utils/colmap_cache.py
+    use_colmap_cache = cfg.get("use_colmap_cache", False)
+
+    depth_format = cfg.get("depth_format", "png")
+    assert depth_format in ("png", "container"), f"Unknown depth_format: {depth_format}"
+    pipeline_args = {
+        "num_writers": cfg.get("io_writers", 4),
+        "queue_size": cfg.get("io_queue_size", 8),
+    }
+    near = cfg.get("near", 0.05)
+    far = cfg.get("far", 20.0)
+
+    render_outputs = set(cfg.get("render_outputs", ["rgb", "depth"]))
+    unknown_outputs = render_outputs - {"rgb", "depth", "vert_indices"}
+    assert len(unknown_outputs) == 0, f"Unknown render_outputs: {unknown_outputs}"
+    # render at 1/downscale_factor of the camera resolution, like dslr/downscale.py
+    downscale_factor = float(cfg.get("downscale_factor", 1))
+
+    # frames and seconds per device, over all scenes
+    num_frames = {device: 0 for device in render_devices}
+    wall_time = {device: 0.0 for device in render_devices}
+    render_time = {device: 0.0 for device in render_devices}
+
+    # renderpy (GL) or cpu (common/utils/cpu_rasterizer.py)
+    render_backend = cfg.get("render_backend", "renderpy")
+    assert render_backend in ("renderpy", "cpu"), f"Unknown render_backend: {render_backend}"
+    if render_backend == "renderpy":
+        if renderpy is None:
+            print("renderpy not installed. Please install renderpy from https://github.com/liu115/renderpy "
+                  "or set render_backend: cpu")
+            sys.exit(1)
+        # the GL context is created once and reused for all scenes
+        render_engine = renderpy.Render()
+    else:
+        render_engine = CPURender(num_threads=cfg.get("cpu_render_threads"))
+
     # go through each scene
     for scene_id in tqdm(scene_ids, desc="scene"):
         scene = ScannetppScene_Release(scene_id, data_root=Path(cfg.data_root) / "data")
-        render_engine = renderpy.Render()
-        render_engine.setupMesh(str(scene.scan_mesh_path))
+        if render_backend == "renderpy":
+            render_engine.setupMesh(str(scene.scan_mesh_path))
+        else:
+            render_engine.setupMesh(scene.load_mesh(), scene.load_face_index() if cfg.get("cull_faces", True) else None)
         for device in render_devices:
-            if device == "dslr":
-                cameras, images, points3D = read_model(scene.dslr_colmap_dir, ".txt")
-            else:
-                cameras, images, points3D = read_model(scene.iphone_colmap_dir, ".txt")
+            cameras, images, points3D = scene.load_colmap_model(device, pose_only=True, use_cache=use_colmap_cache)
             assert len(cameras) == 1, "Multiple cameras not supported"
             camera = next(iter(cameras.values()))
 
             fx, fy, cx, cy = camera.params[:4]
+            K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
+            K, height, width = compute_resize_intrinsic(K, camera.height, camera.width, 1 / downscale_factor)
+            # distortion acts on normalized coordinates and does not change with the resolution
             params = camera.params[4:]
             camera_model = camera.model
             render_engine.setupCamera(
-                camera.height, camera.width,
-                fx, fy, cx, cy,
+                height, width,
+                K[0, 0], K[1, 1], K[0, 2], K[1, 2],
                 camera_model,
                 params,      # Distortion parameters np.array([k1, k2, k3, k4]) or np.array([k1, k2, p1, p2])
             )
 
-            near = cfg.get("near", 0.05)
-            far = cfg.get("far", 20.0)
-            rgb_dir = Path(cfg.output_dir) / scene_id / device / "render_rgb"
-            depth_dir = Path(cfg.output_dir) / scene_id / device / "render_depth"
-            rgb_dir.mkdir(parents=True, exist_ok=True)
-            depth_dir.mkdir(parents=True, exist_ok=True)
-            for image_id, image in tqdm(images.items(), f"Rendering {device} images"):
-                world_to_camera = image.world_to_camera
-                rgb, depth, vert_indices = render_engine.renderAll(world_to_camera, near, far)
-                rgb = rgb.astype(np.uint8)
-                # Make depth in mm and clip to fit 16-bit image
-                depth = (depth.astype(np.float32) * 1000).clip(0, 65535).astype(np.uint16)
-                imageio.imwrite(rgb_dir / image.name, rgb)
-                depth_name = image.name.split(".")[0] + ".png"
-                imageio.imwrite(depth_dir / depth_name, depth)
+            all_names = [image.name for image in images.values()]
+            indices = select_frames(all_names, scene, device, cfg)
+            names = [all_names[idx] for idx in indices]
+            world_to_cameras = world_to_camera_batch(*image_poses(images))[indices]
+
+            device_dir = output_dir / scene_id / device
+            rgb_dir = device_dir / "render_rgb" if "rgb" in render_outputs else None
+            depth_dir = device_dir / "render_depth" if "depth" in render_outputs else None
+            vert_dir = device_dir / "render_vert_indices" if "vert_indices" in render_outputs else None
+            for out_dir in (rgb_dir, vert_dir):
+                if out_dir is not None:
+                    out_dir.mkdir(parents=True, exist_ok=True)
+
+            depth_container = None
+            if depth_dir is not None and depth_format == "container":
+                depth_container = DepthContainerWriter(
+                    device_dir / "render_depth.bin",
+                    (height, width),
+                    dtype=cfg.get("depth_container_dtype", "uint16"),
+                    compression=cfg.get("depth_container_compression", "none"),
+                )
+            elif depth_dir is not None:
+                depth_dir.mkdir(parents=True, exist_ok=True)
+
+            try:
+                stats = render_frames(
+                    render_engine, names, world_to_cameras, near, far, rgb_dir, depth_dir,
+                    depth_container=depth_container, vert_dir=vert_dir, pipeline_args=pipeline_args,
+                    desc=f"Rendering {device} images",
+                )
+            except BaseException:
+                if depth_container is not None:
+                    depth_container.abort()
+                raise
+            if depth_container is not None:
+                depth_container.close()
+
+            num_frames[device] += len(names)
+            wall_time[device] += stats.wall_time
+            render_time[device] += stats.stage_time["compute"]
+            if cfg.get("report_pipeline_stats", False):
+                print(f"{scene_id} {device}\n{stats.summary()}")
+
+    for device in render_devices:
+        if num_frames[device] == 0:
+            continue
+        print(
+            f"{device}: {num_frames[device]} frames, "
+            f"{num_frames[device] / max(wall_time[device], 1e-9):.1f} fps overall, "
+            f"{num_frames[device] / max(render_time[device], 1e-9):.1f} fps rendering"
+        )
 
 
 if __name__ == "__main__":
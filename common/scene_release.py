@@ -1,9 +1,104 @@
+import json
+import warnings
+from collections import namedtuple
 from pathlib import Path
 
+import numpy as np
+
+from common.utils.asset_cache import get_asset_cache
+from common.utils.colmap import read_model
+from common.utils.face_index import FaceGrid
+
+# read-only vertices (N, 3), triangles (M, 3) and vertex colors (N, 3) in [0, 1] of a mesh
+MeshArrays = namedtuple("MeshArrays", ["vertices", "triangles", "vertex_colors"])
+
+
+def _load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _load_mesh_arrays(path):
+    import open3d as o3d
+    mesh = o3d.io.read_triangle_mesh(str(path))
+    return MeshArrays(
+        vertices=np.asarray(mesh.vertices),
+        triangles=np.asarray(mesh.triangles),
+        vertex_colors=np.asarray(mesh.vertex_colors) if mesh.has_vertex_colors() else None,
+    )
+
+
+def _load_mesh_mask(path):
+    with warnings.catch_warnings():
+        # an empty mask file
+        warnings.filterwarnings("ignore", category=UserWarning, append=1)
+        return np.loadtxt(path, dtype=np.int32).reshape(-1)
+
+
+def mesh_to_o3d(mesh):
+    '''
+    new open3d mesh from MeshArrays, e.g. to modify or visualize a cached mesh
+    '''
+    import open3d as o3d
+    o3d_mesh = o3d.geometry.TriangleMesh(
+        o3d.utility.Vector3dVector(mesh.vertices), o3d.utility.Vector3iVector(mesh.triangles)
+    )
+    if mesh.vertex_colors is not None:
+        o3d_mesh.vertex_colors = o3d.utility.Vector3dVector(mesh.vertex_colors)
+    return o3d_mesh
+
+
 class ScannetppScene_Release:
-    def __init__(self, scene_id, data_root=None):
+    def __init__(self, scene_id, data_root=None, manifest=None):
+        '''
+        manifest: optional DataManifest of data_root (see common/data_manifest.py),
+            existence and metadata queries are answered from it
+        '''
         self._scene_id = scene_id
         self.data_root = self.path_or_none(data_root)
+        self.manifest = manifest
+        self._scan = None
+
+    def _assets(self):
+        '''
+        manifest entry of the scene, scanned on first use if there is no manifest
+        '''
+        if self.manifest is not None and self._scene_id in self.manifest:
+            return self.manifest.get(self._scene_id)
+        if self._scan is None:
+            from common.data_manifest import scan_scene
+            self._scan = scan_scene(self)
+        return self._scan
+
+    def has(self, asset):
+        '''
+        asset: name of a path or dir property, e.g. "scan_mesh_path"
+        returns: True if the file or dir exists
+        '''
+        if self.manifest is not None and self._scene_id in self.manifest:
+            entry = self.manifest.get(self._scene_id)
+            return asset in entry["files"] or asset in entry["dirs"]
+        path = getattr(self, asset)
+        return path.is_dir() if asset.endswith("_dir") else path.is_file()
+
+    def asset_size(self, asset):
+        '''
+        size in bytes of a file asset, None if it does not exist
+        '''
+        return self._assets()["files"].get(asset)
+
+    def num_files(self, asset):
+        '''
+        number of files in a dir asset, e.g. "dslr_resized_dir", None if it does not exist
+        '''
+        return self._assets()["dirs"].get(asset)
+
+    @property
+    def metadata(self):
+        '''
+        image sizes and frame counts, see common/data_manifest.py
+        '''
+        return self._assets()["meta"]
 
     @staticmethod
     def path_or_none(path):
@@ -153,6 +248,10 @@ class ScannetppScene_Release:
     def iphone_depth_dir(self):
         return self.iphone_data_dir / 'depth'
 
+    @property
+    def iphone_depth_container_path(self):
+        return self.iphone_data_dir / 'depth_frames.bin'
+
     @property
     def iphone_pose_intrinsic_imu_path(self):
         return self.iphone_data_dir / 'pose_intrinsic_imu.json'
@@ -167,4 +266,65 @@ class ScannetppScene_Release:
     
     @property
     def iphone_exif_path(self):
-        return self.iphone_data_dir / 'exif.json'
\ No newline at end of file
+        return self.iphone_data_dir / 'exif.json'
+
+    ##### cached loaders #####
+    # the assets are cached process-wide (see common/utils/asset_cache.py), the returned
+    # objects are shared and must not be modified
+
+    def load_mesh(self):
+        '''
+        returns: MeshArrays of the mesh
+        '''
+        return get_asset_cache().get_or_load(self.scan_mesh_path, "mesh", _load_mesh_arrays)
+
+    def load_face_index(self):
+        '''
+        returns: FaceGrid of the mesh faces for frustum culling, see common/utils/face_index.py
+        '''
+        return get_asset_cache().get_or_load(
+            self.scan_mesh_path, "face_index", lambda path: FaceGrid.from_mesh(self.load_mesh())
+        )
+
+    def load_mesh_mask(self):
+        '''
+        returns: int32 array, indices of the vertices to ignore
+        '''
+        return get_asset_cache().get_or_load(self.scan_mesh_mask_path, "mesh_mask", _load_mesh_mask)
+
+    def load_segments(self):
+        '''
+        returns: dict of segments.json
+        '''
+        return get_asset_cache().get_or_load(self.scan_mesh_segs_path, "json", _load_json)
+
+    def load_annotations(self):
+        '''
+        returns: dict of segments_anno.json
+        '''
+        return get_asset_cache().get_or_load(self.scan_anno_json_path, "json", _load_json)
+
+    def load_train_test_lists(self):
+        '''
+        returns: dict with the train and test DSLR image names
+        '''
+        return get_asset_cache().get_or_load(self.dslr_train_test_lists_path, "json", _load_json)
+
+    def load_transforms(self, device="dslr"):
+        '''
+        returns: dict of the nerfstudio transforms.json of the dslr or iphone
+        '''
+        path = self.dslr_nerfstudio_transform_path if device == "dslr" else self.iphone_nerfstudio_transform_path
+        return get_asset_cache().get_or_load(path, "json", _load_json)
+
+    def load_colmap_model(self, device="dslr", pose_only=False, use_cache=False):
+        '''
+        use_cache: parse the text model through its binary cache, see read_model
+        returns: cameras, images, points3D of the dslr or iphone COLMAP text model, see read_model.
+            the model is shared by all callers, the images are a read-only ColumnarImages
+        '''
+        colmap_dir = self.dslr_colmap_dir if device == "dslr" else self.iphone_colmap_dir
+        return get_asset_cache().get_or_load(
+            colmap_dir / "images.txt", f"colmap_pose_only={pose_only}",
+            lambda path: read_model(path.parent, ".txt", pose_only=pose_only, use_cache=use_cache, columnar=True),
+        )
@@ -0,0 +1,123 @@
+'''
+Process-wide LRU cache of loaded scene assets (meshes, annotations, transforms, ...)
+with a memory budget, used by the loader methods of ScannetppScene_Release.
+
+Entries are keyed by the path, size and modification time of the source file, a file
+that changes is loaded again. The loaded values are shared between all callers and
+must not be modified, arrays are returned read-only.
+
+The budget defaults to SCANNETPP_ASSET_CACHE_MB (2048 MB), set it with
+set_asset_cache_budget, a budget of 0 disables the cache.
+'''
+
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_BUDGET_MB = 2048
+
+
+def estimate_size(value, file_size):
+    '''
+    bytes of the arrays in value (or its nbytes), the size of the source file for
+    other objects (e.g. parsed JSON)
+    '''
+    if isinstance(value, np.ndarray) or hasattr(value, "nbytes"):
+        return value.nbytes
+    if isinstance(value, (tuple, list)) and len(value) > 0 and all(
+        isinstance(v, np.ndarray) or v is None for v in value
+    ):
+        return sum(v.nbytes for v in value if v is not None)
+    return file_size
+
+
+def _freeze(value):
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, tuple):
+        for v in value:
+            _freeze(v)
+    return value
+
+
+class AssetCache:
+    """LRU cache with a budget in bytes, see the module docstring."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, path, kind, load_fn):
+        """Cached load_fn(path).
+
+        Args:
+            path: Source file of the asset, its size and mtime are part of the key.
+            kind: Name of the loader, different loaders of the same file are cached separately.
+            load_fn: Function loading the asset from path.
+        """
+        path = Path(path)
+        stat = os.stat(path)
+        key = (str(path), kind)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # load outside of the lock, concurrent loads of the same asset are possible
+        value = _freeze(load_fn(path))
+        size = estimate_size(value, stat.st_size)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.num_bytes -= old[2]
+            if size <= self.max_bytes:
+                self._entries[key] = (signature, value, size)
+                self.num_bytes += size
+                while self.num_bytes > self.max_bytes:
+                    _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                    self.num_bytes -= evicted_size
+        return value
+
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            while self.num_bytes > self.max_bytes and len(self._entries) > 0:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.num_bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.num_bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+_asset_cache = AssetCache(int(os.environ.get("SCANNETPP_ASSET_CACHE_MB", DEFAULT_BUDGET_MB)) * 2**20)
+
+
+def get_asset_cache():
+    return _asset_cache
+
+
+def set_asset_cache_budget(max_mb):
+    '''
+    memory budget of the process-wide cache in MB, 0 disables caching
+    '''
+    _asset_cache.set_budget(max_mb * 2**20)
@@ -32,6 +32,7 @@
 from typing import List, Tuple, Dict
 import os
 import collections
+import collections.abc
 import numpy as np
 import struct
 import argparse
@@ -60,6 +61,26 @@ def camera_to_intrinsic(camera):
     ])
 
 
+def compute_resize_intrinsic(K, height, width, scale_factor):
+    '''
+    intrinsic matrix and image size after resizing the image by scale_factor
+    '''
+    fx = K[0, 0]
+    fy = K[1, 1]
+    cx = K[0, 2]
+    cy = K[1, 2]
+    new_K = np.array(
+        [
+            [fx * scale_factor, 0, cx * scale_factor],
+            [0, fy * scale_factor, cy * scale_factor],
+            [0, 0, 1],
+        ]
+    )
+    new_height = int(height * scale_factor)
+    new_width = int(width * scale_factor)
+    return new_K, new_height, new_width
+
+
 class Image(BaseImage):
     def qvec2rotmat(self):
         return qvec2rotmat(self.qvec)
@@ -86,6 +107,170 @@ class Image(BaseImage):
         return world2cam
 
 
+class ColumnarImages(collections.abc.Mapping):
+    """Images of a COLMAP model stored as arrays.
+
+    Behaves like a read-only dict image_id -> Image, the Image objects are created on
+    access and their xys and point3D_ids are views into the shared arrays. Use to_dict()
+    for a mutable dict with copies. The 2D points of all images are packed into xys and
+    point3D_ids, the points of the i-th image are points2D_offsets[i]:points2D_offsets[i + 1].
+    Instead of the points, a function load_points() returning (xys, point3D_ids,
+    points2D_offsets) can be given, it is called on the first access to the points.
+    """
+
+    def __init__(self, ids, qvecs, tvecs, camera_ids, names, xys=None, point3D_ids=None,
+                 points2D_offsets=None, load_points=None):
+        self.ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        self.qvecs = np.asarray(qvecs, dtype=np.float64).reshape(-1, 4)
+        self.tvecs = np.asarray(tvecs, dtype=np.float64).reshape(-1, 3)
+        self.camera_ids = np.asarray(camera_ids, dtype=np.int64).reshape(-1)
+        self.names = list(names)
+        self._index = {image_id: idx for idx, image_id in enumerate(self.ids.tolist())}
+        self._points = None
+        self._load_points = load_points
+        if load_points is None:
+            self._set_points(xys, point3D_ids, points2D_offsets)
+
+    def _set_points(self, xys, point3D_ids, points2D_offsets):
+        self._points = (
+            np.ascontiguousarray(xys, dtype=np.float64).reshape(-1, 2),
+            np.ascontiguousarray(point3D_ids, dtype=np.int64).reshape(-1),
+            np.asarray(points2D_offsets, dtype=np.int64),
+        )
+        self._load_points = None
+
+    def _get_points(self):
+        if self._points is None:
+            self._set_points(*self._load_points())
+        return self._points
+
+    @property
+    def xys(self):
+        return self._get_points()[0]
+
+    @property
+    def point3D_ids(self):
+        return self._get_points()[1]
+
+    @property
+    def points2D_offsets(self):
+        return self._get_points()[2]
+
+    @classmethod
+    def from_images(cls, images):
+        """Pack a dict image_id -> Image."""
+        images = list(images.values())
+        counts = [len(image.point3D_ids) for image in images]
+        return cls(
+            ids=[image.id for image in images],
+            qvecs=np.array([image.qvec for image in images]),
+            tvecs=np.array([image.tvec for image in images]),
+            camera_ids=[image.camera_id for image in images],
+            names=[image.name for image in images],
+            xys=np.concatenate([np.reshape(image.xys, (-1, 2)) for image in images]) if images else [],
+            point3D_ids=np.concatenate([image.point3D_ids for image in images]) if images else [],
+            points2D_offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        )
+
+    def world_to_camera(self):
+        """(N, 4, 4) world to camera matrices of all images, in the order of the arrays."""
+        return world_to_camera_batch(self.qvecs, self.tvecs)
+
+    def camera_to_world(self):
+        """(N, 4, 4) camera to world matrices of all images, in the order of the arrays."""
+        return camera_to_world_batch(self.qvecs, self.tvecs)
+
+    def index_of(self, image_id):
+        """Row of an image in the arrays."""
+        return self._index[image_id]
+
+    def image_at(self, idx):
+        start, end = self.points2D_offsets[idx], self.points2D_offsets[idx + 1]
+        return Image(
+            id=int(self.ids[idx]), qvec=self.qvecs[idx].copy(), tvec=self.tvecs[idx].copy(),
+            camera_id=int(self.camera_ids[idx]), name=self.names[idx],
+            xys=self.xys[start:end], point3D_ids=self.point3D_ids[start:end])
+
+    def to_dict(self):
+        """Dict image_id -> Image with copies of the 2D points, like the original readers."""
+        out = {}
+        for idx in range(len(self.ids)):
+            image = self.image_at(idx)
+            out[image.id] = image._replace(xys=image.xys.copy(), point3D_ids=image.point3D_ids.copy())
+        return out
+
+    def __getitem__(self, image_id):
+        return self.image_at(self._index[image_id])
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+class ColumnarPoints3D(collections.abc.Mapping):
+    """3D points of a COLMAP model stored as arrays.
+
+    Behaves like a read-only dict point3D_id -> Point3D, the Point3D objects are created
+    on access. Use to_dict() for a mutable dict. The tracks of all points are packed into
+    track_image_ids and track_point2D_idxs, the track of the i-th point is
+    track_offsets[i]:track_offsets[i + 1].
+    """
+
+    def __init__(self, ids, xyzs, rgbs, errors, track_image_ids, track_point2D_idxs, track_offsets):
+        self.ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        self.xyzs = np.asarray(xyzs, dtype=np.float64).reshape(-1, 3)
+        self.rgbs = np.asarray(rgbs, dtype=np.uint8).reshape(-1, 3)
+        self.errors = np.asarray(errors, dtype=np.float64).reshape(-1)
+        self.track_image_ids = np.asarray(track_image_ids, dtype=np.int64).reshape(-1)
+        self.track_point2D_idxs = np.asarray(track_point2D_idxs, dtype=np.int64).reshape(-1)
+        self.track_offsets = np.asarray(track_offsets, dtype=np.int64)
+        self._index = None
+
+    @classmethod
+    def from_points3D(cls, points3D):
+        """Pack a dict point3D_id -> Point3D."""
+        points = list(points3D.values())
+        counts = [len(point.image_ids) for point in points]
+        return cls(
+            ids=[point.id for point in points],
+            xyzs=np.array([point.xyz for point in points]).reshape(-1, 3),
+            rgbs=np.array([point.rgb for point in points]).reshape(-1, 3),
+            errors=[float(point.error) for point in points],
+            track_image_ids=np.concatenate([point.image_ids for point in points]) if points else [],
+            track_point2D_idxs=np.concatenate([point.point2D_idxs for point in points]) if points else [],
+            track_offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        )
+
+    def index_of(self, point3D_id):
+        """Row of a point in the arrays."""
+        if self._index is None:
+            # built on first use, loading a large model does not pay for it
+            self._index = {point3D_id: idx for idx, point3D_id in enumerate(self.ids.tolist())}
+        return self._index[point3D_id]
+
+    def point_at(self, idx):
+        start, end = self.track_offsets[idx], self.track_offsets[idx + 1]
+        return Point3D(
+            id=int(self.ids[idx]), xyz=np.array(self.xyzs[idx]), rgb=self.rgbs[idx].astype(np.int64),
+            error=float(self.errors[idx]), image_ids=np.array(self.track_image_ids[start:end]),
+            point2D_idxs=np.array(self.track_point2D_idxs[start:end]))
+
+    def to_dict(self):
+        """Dict point3D_id -> Point3D, like the original readers."""
+        return {int(point3D_id): self.point_at(idx) for idx, point3D_id in enumerate(self.ids)}
+
+    def __getitem__(self, point3D_id):
+        return self.point_at(self.index_of(point3D_id))
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self):
+        return len(self.ids)
+
+
 class Camera(BaseCamera):
     @property
     def K(self):
@@ -244,13 +429,18 @@ def write_cameras_binary(cameras, path_to_model_file):
     return cameras
 
 
-def read_images_text(path):
+def read_images_text(path, pose_only=False, columnar=False):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadImagesText(const std::string& path)
         void Reconstruction::WriteImagesText(const std::string& path)
+    pose_only: skip the 2D points, the images have no xys and point3D_ids
+    columnar: return the read-only ColumnarImages, the 2D points are then parsed with numpy
+        on the first access to them
+    returns: dict image_id -> Image, or ColumnarImages if columnar
     """
-    images = {}
+    headers = []
+    points_lines = []
     with open(path, "r") as fid:
         while True:
             line = fid.readline()
@@ -258,56 +448,137 @@ def read_images_text(path):
                 break
             line = line.strip()
             if len(line) > 0 and line[0] != "#":
-                elems = line.split()
-                image_id = int(elems[0])
-                qvec = np.array(tuple(map(float, elems[1:5])))
-                tvec = np.array(tuple(map(float, elems[5:8])))
-                camera_id = int(elems[8])
-                image_name = elems[9]
-                elems = fid.readline().split()
-                xys = np.column_stack([tuple(map(float, elems[0::3])),
-                                       tuple(map(float, elems[1::3]))])
-                point3D_ids = np.array(tuple(map(int, elems[2::3])))
-                images[image_id] = Image(
-                    id=image_id, qvec=qvec, tvec=tvec,
-                    camera_id=camera_id, name=image_name,
-                    xys=xys, point3D_ids=point3D_ids)
-    return images
-
-
-def read_images_binary(path_to_model_file):
+                headers.append(line.split())
+                # the next line holds the 2D points, it may be empty
+                points_line = fid.readline()
+                if not pose_only:
+                    points_lines.append(points_line)
+
+    if pose_only:
+        points_lines = [""] * len(headers)
+
+    def load_points():
+        points = [
+            np.fromstring(line, dtype=np.float64, sep=" ") if len(line) > 0 else np.zeros(0)
+            for line in (line.strip() for line in points_lines)
+        ]
+        counts = [len(p) // 3 for p in points]
+        points = np.concatenate(points).reshape(-1, 3) if len(points) > 0 else np.zeros((0, 3))
+        return points[:, :2], points[:, 2].astype(np.int64), np.concatenate([[0], np.cumsum(counts)])
+
+    images = ColumnarImages(
+        ids=np.array([elems[0] for elems in headers], dtype=np.int64),
+        qvecs=np.array([elems[1:5] for elems in headers], dtype=np.float64).reshape(-1, 4),
+        tvecs=np.array([elems[5:8] for elems in headers], dtype=np.float64).reshape(-1, 3),
+        camera_ids=np.array([elems[8] for elems in headers], dtype=np.int64),
+        names=[elems[9] for elems in headers],
+        load_points=load_points,
+    )
+    return images if columnar else images.to_dict()
+
+
+# x, y, point3D_id of a 2D point in images.bin
+_POINT2D_DTYPE = np.dtype([("xy", "<f8", (2,)), ("point3D_id", "<i8")])
+
+
+def read_images_binary(path_to_model_file, pose_only=False, columnar=False):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadImagesBinary(const std::string& path)
         void Reconstruction::WriteImagesBinary(const std::string& path)
+    pose_only: skip the 2D points, the images have no xys and point3D_ids
+    columnar: return the read-only ColumnarImages
+    returns: dict image_id -> Image, or ColumnarImages if columnar. The file is read at once
+        and the 2D points are decoded with numpy
     """
-    images = {}
+    if pose_only:
+        images = _read_image_poses_binary(path_to_model_file)
+    else:
+        images = _read_images_binary(path_to_model_file)
+    return images if columnar else images.to_dict()
+
+
+def _read_images_binary(path_to_model_file):
+    with open(path_to_model_file, "rb") as fid:
+        data = fid.read()
+
+    num_reg_images = struct.unpack_from("<Q", data, 0)[0]
+    offset = 8
+    ids = []
+    qtvecs = []
+    camera_ids = []
+    names = []
+    points = []
+    for _ in range(num_reg_images):
+        binary_image_properties = struct.unpack_from("<idddddddi", data, offset)
+        ids.append(binary_image_properties[0])
+        qtvecs.append(binary_image_properties[1:8])
+        camera_ids.append(binary_image_properties[8])
+        offset += 64
+        name_end = data.index(b"\x00", offset)   # look for the ASCII 0 entry
+        names.append(data[offset:name_end].decode("utf-8"))
+        offset = name_end + 1
+        num_points2D = struct.unpack_from("<Q", data, offset)[0]
+        offset += 8
+        points.append(np.frombuffer(data, dtype=_POINT2D_DTYPE, count=num_points2D, offset=offset))
+        offset += _POINT2D_DTYPE.itemsize * num_points2D
+
+    qtvecs = np.array(qtvecs, dtype=np.float64).reshape(-1, 7)
+    counts = [len(p) for p in points]
+    points = np.concatenate(points) if len(points) > 0 else np.zeros(0, dtype=_POINT2D_DTYPE)
+    return ColumnarImages(
+        ids=ids,
+        qvecs=qtvecs[:, :4],
+        tvecs=qtvecs[:, 4:],
+        camera_ids=camera_ids,
+        names=names,
+        xys=points["xy"],
+        point3D_ids=points["point3D_id"],
+        points2D_offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+    )
+
+
+def _read_image_poses_binary(path_to_model_file):
+    # seek past the 2D points of each image instead of reading them
+    ids = []
+    qtvecs = []
+    camera_ids = []
+    names = []
     with open(path_to_model_file, "rb") as fid:
         num_reg_images = read_next_bytes(fid, 8, "Q")[0]
         for _ in range(num_reg_images):
             binary_image_properties = read_next_bytes(
                 fid, num_bytes=64, format_char_sequence="idddddddi")
-            image_id = binary_image_properties[0]
-            qvec = np.array(binary_image_properties[1:5])
-            tvec = np.array(binary_image_properties[5:8])
-            camera_id = binary_image_properties[8]
-            image_name = ""
-            current_char = read_next_bytes(fid, 1, "c")[0]
-            while current_char != b"\x00":   # look for the ASCII 0 entry
-                image_name += current_char.decode("utf-8")
-                current_char = read_next_bytes(fid, 1, "c")[0]
-            num_points2D = read_next_bytes(fid, num_bytes=8,
-                                           format_char_sequence="Q")[0]
-            x_y_id_s = read_next_bytes(fid, num_bytes=24*num_points2D,
-                                       format_char_sequence="ddq"*num_points2D)
-            xys = np.column_stack([tuple(map(float, x_y_id_s[0::3])),
-                                   tuple(map(float, x_y_id_s[1::3]))])
-            point3D_ids = np.array(tuple(map(int, x_y_id_s[2::3])))
-            images[image_id] = Image(
-                id=image_id, qvec=qvec, tvec=tvec,
-                camera_id=camera_id, name=image_name,
-                xys=xys, point3D_ids=point3D_ids)
-    return images
+            ids.append(binary_image_properties[0])
+            qtvecs.append(binary_image_properties[1:8])
+            camera_ids.append(binary_image_properties[8])
+            name = b""
+            while True:
+                chunk = fid.read(64)
+                name_end = chunk.find(b"\x00")   # look for the ASCII 0 entry
+                if name_end >= 0:
+                    name += chunk[:name_end]
+                    # rewind to the byte after the terminator
+                    fid.seek(name_end + 1 - len(chunk), 1)
+                    break
+                if len(chunk) == 0:
+                    raise ValueError(f"Unexpected end of file in {path_to_model_file}")
+                name += chunk
+            names.append(name.decode("utf-8"))
+            num_points2D = read_next_bytes(fid, num_bytes=8, format_char_sequence="Q")[0]
+            fid.seek(_POINT2D_DTYPE.itemsize * num_points2D, 1)
+
+    qtvecs = np.array(qtvecs, dtype=np.float64).reshape(-1, 7)
+    return ColumnarImages(
+        ids=ids,
+        qvecs=qtvecs[:, :4],
+        tvecs=qtvecs[:, 4:],
+        camera_ids=camera_ids,
+        names=names,
+        xys=np.zeros((0, 2)),
+        point3D_ids=np.zeros(0, dtype=np.int64),
+        points2D_offsets=np.zeros(len(ids) + 1, dtype=np.int64),
+    )
 
 
 def write_images_text(images, path):
@@ -470,7 +741,16 @@ def detect_model_format(path, ext):
     return False
 
 
-def read_model(path, ext="") -> Tuple[Dict[int, Camera], Dict[int, Image], Dict[int, Point3D]]:
+def read_model(path, ext="", pose_only=False, use_cache=False, columnar=False) -> Tuple[Dict[int, Camera], Dict[int, Image], Dict[int, Point3D]]:
+    """
+    pose_only: only read the cameras and the image poses, the images have no 2D points
+        and points3D is empty
+    use_cache: load a text model from its binary cache, see colmap_cache.py. The cache is
+        (re)built from the text files if it is missing or outdated
+    columnar: return the images as ColumnarImages (and the points of the cache as
+        ColumnarPoints3D), read-only mappings backed by arrays. Otherwise the images and
+        points are dicts
+    """
     # try to detect the extension automatically
     if ext == "":
         if detect_model_format(path, ".bin"):
@@ -480,14 +760,24 @@ def read_model(path, ext="") -> Tuple[Dict[int, Camera], Dict[int, Image], Dict[
         else:
             raise ValueError("Provide model format: '.bin' or '.txt'")
 
+    if ext == ".txt" and use_cache:
+        # imported here, the cache module builds on this one
+        from .colmap_cache import read_cached_model
+        cameras, images, points3D = read_cached_model(path, pose_only=pose_only)
+        if not columnar:
+            images = images.to_dict()
+            if isinstance(points3D, ColumnarPoints3D):
+                points3D = points3D.to_dict()
+        return cameras, images, points3D
+
     if ext == ".txt":
         cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
-        images = read_images_text(os.path.join(path, "images" + ext))
-        points3D = read_points3D_text(os.path.join(path, "points3D") + ext)
+        images = read_images_text(os.path.join(path, "images" + ext), pose_only=pose_only, columnar=columnar)
+        points3D = {} if pose_only else read_points3D_text(os.path.join(path, "points3D") + ext)
     else:
         cameras = read_cameras_binary(os.path.join(path, "cameras" + ext))
-        images = read_images_binary(os.path.join(path, "images" + ext))
-        points3D = read_points3D_binary(os.path.join(path, "points3D") + ext)
+        images = read_images_binary(os.path.join(path, "images" + ext), pose_only=pose_only, columnar=columnar)
+        points3D = {} if pose_only else read_points3D_binary(os.path.join(path, "points3D") + ext)
     return cameras, images, points3D
 
 
@@ -516,6 +806,83 @@ def qvec2rotmat(qvec):
          1 - 2 * qvec[1]**2 - 2 * qvec[2]**2]])
 
 
+def qvec2rotmat_batch(qvecs):
+    """Rotation matrices of a stack of quaternions, vectorized qvec2rotmat.
+
+    Args:
+        qvecs: (N, 4) quaternions (w, x, y, z).
+    Returns:
+        (N, 3, 3) rotation matrices.
+    """
+    qvecs = np.asarray(qvecs, dtype=np.float64).reshape(-1, 4)
+    w, x, y, z = qvecs.T
+    R = np.empty((len(qvecs), 3, 3))
+    R[:, 0, 0] = 1 - 2 * y**2 - 2 * z**2
+    R[:, 0, 1] = 2 * x * y - 2 * w * z
+    R[:, 0, 2] = 2 * z * x + 2 * w * y
+    R[:, 1, 0] = 2 * x * y + 2 * w * z
+    R[:, 1, 1] = 1 - 2 * x**2 - 2 * z**2
+    R[:, 1, 2] = 2 * y * z - 2 * w * x
+    R[:, 2, 0] = 2 * z * x - 2 * w * y
+    R[:, 2, 1] = 2 * y * z + 2 * w * x
+    R[:, 2, 2] = 1 - 2 * x**2 - 2 * y**2
+    return R
+
+
+def world_to_camera_batch(qvecs, tvecs):
+    """World to camera transforms of a stack of poses, see Image.world_to_camera.
+
+    Args:
+        qvecs: (N, 4) quaternions.
+        tvecs: (N, 3) translations.
+    Returns:
+        (N, 4, 4) world to camera matrices.
+    """
+    tvecs = np.asarray(tvecs, dtype=np.float64).reshape(-1, 3)
+    T = np.zeros((len(tvecs), 4, 4))
+    T[:, :3, :3] = qvec2rotmat_batch(qvecs)
+    T[:, :3, 3] = tvecs
+    T[:, 3, 3] = 1
+    return T
+
+
+def camera_to_world_batch(qvecs, tvecs):
+    """Camera to world transforms of a stack of poses, the rigid inverse [R^T | -R^T t]
+    of world_to_camera_batch. The quaternions must be normalized, as in COLMAP models.
+
+    Args:
+        qvecs: (N, 4) quaternions.
+        tvecs: (N, 3) translations.
+    Returns:
+        (N, 4, 4) camera to world matrices.
+    """
+    tvecs = np.asarray(tvecs, dtype=np.float64).reshape(-1, 3)
+    R_inv = qvec2rotmat_batch(qvecs).transpose(0, 2, 1)
+    T = np.zeros((len(tvecs), 4, 4))
+    T[:, :3, :3] = R_inv
+    T[:, :3, 3] = -np.einsum("nij,nj->ni", R_inv, tvecs)
+    T[:, 3, 3] = 1
+    return T
+
+
+def image_poses(images):
+    """Stacked poses of images.
+
+    Args:
+        images: ColumnarImages, dict image_id -> Image or list of Image.
+    Returns:
+        qvecs (N, 4) and tvecs (N, 3) in the iteration order of images.
+    """
+    if isinstance(images, ColumnarImages):
+        return images.qvecs, images.tvecs
+    if isinstance(images, collections.abc.Mapping):
+        images = images.values()
+    images = list(images)
+    if len(images) == 0:
+        return np.zeros((0, 4)), np.zeros((0, 3))
+    return np.array([image.qvec for image in images]), np.array([image.tvec for image in images])
+
+
 def rotmat2qvec(R):
     Rxx, Ryx, Rzx, Rxy, Ryy, Rzy, Rxz, Ryz, Rzz = R.flat
     K = np.array([
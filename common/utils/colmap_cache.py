@@ -0,0 +1,247 @@
+'''
+Binary cache of COLMAP text models (cameras.txt, images.txt, points3D.txt)
+
+The cache is a directory "cache" next to the text files with one .npy file per array
+of the columnar images and points and a meta.json with the cameras, the image names
+and the size and modification time of the text files. It is rebuilt when a text
+file changes. The arrays are memory-mapped on load, so loading a cached model does
+not parse or copy anything.
+
+Prebuild the caches of the DSLR and iPhone models of a split:
+    python -m common.utils.colmap_cache --data_root DATA_ROOT --splits nvs_sem_train nvs_sem_val
+'''
+
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from .colmap import Camera, ColumnarImages, ColumnarPoints3D, read_model
+from common.scene_release import ScannetppScene_Release
+from common.utils.utils import read_txt_list
+
+CACHE_VERSION = 1
+SOURCE_FILES = ("cameras.txt", "images.txt", "points3D.txt")
+IMAGE_ARRAYS = ("ids", "qvecs", "tvecs", "camera_ids", "xys", "point3D_ids", "points2D_offsets")
+POINT_ARRAYS = ("ids", "xyzs", "rgbs", "errors", "track_image_ids", "track_point2D_idxs", "track_offsets")
+
+
+def model_cache_dir(model_dir):
+    '''
+    colmap -> colmap/cache
+    '''
+    return Path(model_dir) / "cache"
+
+
+def source_signatures(model_dir):
+    '''
+    size and modification time of the text files of a model
+    '''
+    signatures = {}
+    for name in SOURCE_FILES:
+        stat = os.stat(Path(model_dir) / name)
+        signatures[name] = [stat.st_size, stat.st_mtime_ns]
+    return signatures
+
+
+def _read_meta(model_dir):
+    try:
+        with open(model_cache_dir(model_dir) / "meta.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_cache_valid(model_dir):
+    meta = _read_meta(model_dir)
+    try:
+        return (meta is not None and meta.get("version") == CACHE_VERSION
+                and meta.get("sources") == source_signatures(model_dir))
+    except OSError:
+        return False
+
+
+def _load_array(path):
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # empty arrays cannot be memory-mapped
+        return np.load(path)
+
+
+def write_model_cache(model_dir, cameras, images, points3D, signatures):
+    """Write the cache of a model.
+
+    The cache is written to a temporary dir that replaces the cache dir, a reader never
+    sees a partial cache.
+
+    Args:
+        model_dir: Dir of the text model.
+        cameras, images, points3D: The model, as returned by read_model.
+        signatures: source_signatures of the text files taken before reading them.
+    """
+    if not isinstance(images, ColumnarImages):
+        images = ColumnarImages.from_images(images)
+    if not isinstance(points3D, ColumnarPoints3D):
+        points3D = ColumnarPoints3D.from_points3D(points3D)
+
+    cache_dir = model_cache_dir(model_dir)
+    tmp_dir = cache_dir.parent / f".{cache_dir.name}.tmp{os.getpid()}"
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    try:
+        for name in IMAGE_ARRAYS:
+            np.save(tmp_dir / f"images_{name}.npy", np.ascontiguousarray(getattr(images, name)))
+        for name in POINT_ARRAYS:
+            np.save(tmp_dir / f"points3D_{name}.npy", np.ascontiguousarray(getattr(points3D, name)))
+        meta = {
+            "version": CACHE_VERSION,
+            "sources": signatures,
+            "cameras": [
+                {"id": int(camera.id), "model": camera.model, "width": int(camera.width),
+                 "height": int(camera.height), "params": [float(p) for p in camera.params]}
+                for camera in cameras.values()
+            ],
+            "image_names": list(images.names),
+        }
+        with open(tmp_dir / "meta.json", "w") as f:
+            json.dump(meta, f)
+
+        old_dir = cache_dir.parent / f".{cache_dir.name}.old{os.getpid()}"
+        if cache_dir.exists():
+            os.replace(cache_dir, old_dir)
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            # another process wrote the cache in the meantime
+            pass
+        if old_dir.exists():
+            shutil.rmtree(old_dir, ignore_errors=True)
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_model_cache(model_dir, pose_only=False):
+    """Load a model from its cache.
+
+    Args:
+        model_dir: Dir of the text model.
+        pose_only: See read_model.
+    Returns:
+        cameras, images, points3D as ColumnarImages and ColumnarPoints3D backed by
+        memory maps, None if the cache is missing or outdated.
+    """
+    if not is_cache_valid(model_dir):
+        return None
+    cache_dir = model_cache_dir(model_dir)
+    meta = _read_meta(model_dir)
+
+    cameras = {
+        camera["id"]: Camera(id=camera["id"], model=camera["model"], width=camera["width"],
+                             height=camera["height"], params=np.array(camera["params"]))
+        for camera in meta["cameras"]
+    }
+
+    def load_points():
+        return tuple(_load_array(cache_dir / f"images_{name}.npy") for name in IMAGE_ARRAYS[4:])
+
+    image_arrays = {name: _load_array(cache_dir / f"images_{name}.npy") for name in IMAGE_ARRAYS[:4]}
+    if pose_only:
+        num_images = len(image_arrays["ids"])
+        images = ColumnarImages(**image_arrays, names=meta["image_names"], xys=np.zeros((0, 2)),
+                                point3D_ids=np.zeros(0), points2D_offsets=np.zeros(num_images + 1))
+        return cameras, images, {}
+
+    images = ColumnarImages(**image_arrays, names=meta["image_names"], load_points=load_points)
+    points3D = ColumnarPoints3D(
+        **{name: _load_array(cache_dir / f"points3D_{name}.npy") for name in POINT_ARRAYS}
+    )
+    return cameras, images, points3D
+
+
+def read_cached_model(model_dir, pose_only=False):
+    """read_model of a text model through its cache, the cache is built if needed.
+
+    If the cache cannot be written (e.g. read-only data), the parsed model is returned.
+    """
+    model = load_model_cache(model_dir, pose_only=pose_only)
+    if model is not None:
+        return model
+
+    signatures = source_signatures(model_dir)
+    cameras, images, points3D = read_model(model_dir, ".txt", columnar=True)
+    try:
+        write_model_cache(model_dir, cameras, images, points3D, signatures)
+    except OSError as e:
+        print(f"Failed to write the COLMAP cache of {model_dir}: {e}")
+
+    if pose_only:
+        images = ColumnarImages(images.ids, images.qvecs, images.tvecs, images.camera_ids, images.names,
+                                xys=np.zeros((0, 2)), point3D_ids=np.zeros(0),
+                                points2D_offsets=np.zeros(len(images) + 1))
+        points3D = {}
+    return cameras, images, points3D
+
+
+def build_model_cache(model_dir, force=False):
+    '''
+    build the cache of a text model if it is missing or outdated
+    returns: True if the cache was built
+    '''
+    if not force and is_cache_valid(model_dir):
+        return False
+    signatures = source_signatures(model_dir)
+    cameras, images, points3D = read_model(model_dir, ".txt", columnar=True)
+    write_model_cache(model_dir, cameras, images, points3D, signatures)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prebuild the binary caches of the COLMAP text models")
+    parser.add_argument("--data_root", required=True, help="folder where the data is downloaded")
+    parser.add_argument("--splits", nargs="*", default=[], help="splits in data_root/splits")
+    parser.add_argument("--scene_ids", nargs="*", default=[], help="scene ids, in addition to the splits")
+    parser.add_argument("--devices", nargs="+", choices=["dslr", "iphone"], default=["dslr", "iphone"])
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--force", action="store_true", help="rebuild valid caches")
+    args = parser.parse_args()
+
+    scene_ids = list(args.scene_ids)
+    for split in args.splits:
+        scene_ids += read_txt_list(Path(args.data_root) / "splits" / f"{split}.txt")
+
+    model_dirs = []
+    for scene_id in dict.fromkeys(scene_ids):
+        scene = ScannetppScene_Release(scene_id, data_root=Path(args.data_root) / "data")
+        for device in args.devices:
+            model_dir = scene.dslr_colmap_dir if device == "dslr" else scene.iphone_colmap_dir
+            if all((model_dir / name).is_file() for name in SOURCE_FILES):
+                model_dirs.append(model_dir)
+            else:
+                print(f"No COLMAP text model in {model_dir}")
+
+    num_built, failed = 0, []
+    # parsing is CPU bound, build the caches in processes
+    with ProcessPoolExecutor(max_workers=max(args.num_workers, 1)) as executor:
+        futures = {executor.submit(build_model_cache, model_dir, args.force): model_dir
+                   for model_dir in model_dirs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="model"):
+            try:
+                num_built += int(future.result())
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"Failed to build the cache of {futures[future]}: {e!r}")
+
+    print(f"Built {num_built} caches, {len(model_dirs) - num_built - len(failed)} up to date, "
+          f"{len(failed)} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,527 @@
+'''
+Z-buffer rasterization of triangle meshes on the CPU, a backend for machines without
+a GPU (pytorch3d) or GL context (renderpy).
+
+The vertices are projected with a pinhole, OPENCV or OPENCV_FISHEYE camera and the
+triangles are rasterized with straight edges in image space, like pytorch3d does. The
+image is split into tiles, every face is binned into the tiles its bounding box covers
+and the tiles are rasterized in parallel. With numba (if installed) each tile is one
+compiled loop. Otherwise the edge functions are evaluated vectorized in numpy, spread
+over threads: faces larger than a tile against all pixels of their tiles, the (many)
+smaller faces against the pixels of their bounding box.
+
+The outputs follow rasterize_mesh in common/rasterize_utils.py with faces_per_pixel=1:
+pix_to_face (-1 for empty pixels), zbuf (depth along the camera z axis, -1 for empty
+pixels), perspective-correct bary_coords and dists (negative squared distance in NDC
+units of the pixel to the closest face edge).
+
+Faces with a vertex in front of the near plane are culled instead of clipped.
+'''
+
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# pixels at which faces are binned, and faces of a tile rasterized per numpy step
+DEFAULT_TILE_SIZE = 32
+FACE_CHUNK_SIZE = 256
+# (face, pixel) pairs tested per numpy step of the faces smaller than a tile
+PIXEL_CHUNK_SIZE = 1 << 21
+
+# camera of the CPU backend, world_to_camera (4, 4), K (3, 3) and COLMAP camera model
+# with its distortion params (k1, k2, p1, p2 for OPENCV, k1-k4 for OPENCV_FISHEYE)
+CPUCamera = namedtuple("CPUCamera", ["world_to_camera", "K", "height", "width", "camera_model", "dist_params"])
+
+
+def project_points(points, K, camera_model="PINHOLE", dist_params=None):
+    """Project points in camera coordinates to pixels.
+
+    Args:
+        points: (N, 3) points with z > 0.
+        K: (3, 3) intrinsic matrix.
+        camera_model: PINHOLE, SIMPLE_PINHOLE, OPENCV or OPENCV_FISHEYE.
+        dist_params: Distortion params of the OPENCV and OPENCV_FISHEYE models.
+    Returns:
+        (N, 2) pixel coordinates, the top left corner of the image is (0, 0).
+    """
+    a = points[:, 0] / points[:, 2]
+    b = points[:, 1] / points[:, 2]
+    if camera_model == "OPENCV":
+        k1, k2, p1, p2 = dist_params[:4]
+        r2 = a * a + b * b
+        radial = 1 + k1 * r2 + k2 * r2 * r2
+        a, b = (
+            a * radial + 2 * p1 * a * b + p2 * (r2 + 2 * a * a),
+            b * radial + p1 * (r2 + 2 * b * b) + 2 * p2 * a * b,
+        )
+    elif camera_model == "OPENCV_FISHEYE":
+        k1, k2, k3, k4 = dist_params[:4]
+        r = np.sqrt(a * a + b * b)
+        theta = np.arctan(r)
+        theta2 = theta * theta
+        theta_d = theta * (1 + theta2 * (k1 + theta2 * (k2 + theta2 * (k3 + theta2 * k4))))
+        scale = np.where(r > 1e-8, theta_d / np.maximum(r, 1e-8), 1.0)
+        a, b = a * scale, b * scale
+    elif camera_model not in ("PINHOLE", "SIMPLE_PINHOLE"):
+        raise NotImplementedError(f"Camera model not supported: {camera_model}")
+    return np.stack([K[0, 0] * a + K[0, 2], K[1, 1] * b + K[1, 2]], axis=1)
+
+
+def unproject_pixels(uv, K, camera_model="PINHOLE", dist_params=None, num_iters=20):
+    """Viewing rays of pixels, the inverse of project_points.
+
+    Args:
+        uv: (N, 2) pixel coordinates.
+        K, camera_model, dist_params: See project_points.
+        num_iters: Iterations to invert the distortion.
+    Returns:
+        (N, 3) unit rays in camera coordinates.
+    """
+    a = (uv[:, 0] - K[0, 2]) / K[0, 0]
+    b = (uv[:, 1] - K[1, 2]) / K[1, 1]
+    if camera_model == "OPENCV":
+        k1, k2, p1, p2 = dist_params[:4]
+        x, y = a.copy(), b.copy()
+        # fixed point iteration like cv2.undistortPoints
+        for _ in range(num_iters):
+            r2 = x * x + y * y
+            radial = 1 + k1 * r2 + k2 * r2 * r2
+            x = (a - 2 * p1 * x * y - p2 * (r2 + 2 * x * x)) / radial
+            y = (b - p1 * (r2 + 2 * y * y) - 2 * p2 * x * y) / radial
+        a, b = x, y
+    elif camera_model == "OPENCV_FISHEYE":
+        k1, k2, k3, k4 = dist_params[:4]
+        theta_d = np.sqrt(a * a + b * b)
+        theta = theta_d.copy()
+        # newton iteration on theta_d(theta)
+        for _ in range(num_iters):
+            theta2 = theta * theta
+            f = theta * (1 + theta2 * (k1 + theta2 * (k2 + theta2 * (k3 + theta2 * k4)))) - theta_d
+            df = 1 + theta2 * (3 * k1 + theta2 * (5 * k2 + theta2 * (7 * k3 + theta2 * 9 * k4)))
+            theta = theta - f / df
+        scale = np.where(theta_d > 1e-8, np.tan(theta) / np.maximum(theta_d, 1e-8), 1.0)
+        a, b = a * scale, b * scale
+    elif camera_model not in ("PINHOLE", "SIMPLE_PINHOLE"):
+        raise NotImplementedError(f"Camera model not supported: {camera_model}")
+    rays = np.stack([a, b, np.ones_like(a)], axis=1)
+    return rays / np.linalg.norm(rays, axis=1, keepdims=True)
+
+
+def _screen_faces(vertices, faces, world_to_camera, K, height, width, camera_model, dist_params, near, far,
+                  subset=False):
+    '''
+    project the mesh, cull the faces behind the near plane, beyond the far plane, outside
+    of the image or without area. with subset, only the vertices of the faces are projected
+    returns: indices of the kept faces, (V, 2) pixel coordinates and (V,) inverse depths
+    '''
+    world_to_camera = np.asarray(world_to_camera, dtype=np.float64)
+    vertices = np.asarray(vertices)
+    faces = np.asarray(faces)
+    if subset:
+        used = np.zeros(len(vertices), dtype=bool)
+        used[faces.reshape(-1)] = True
+    else:
+        used = slice(None)
+    points = np.zeros((len(vertices), 3))
+    points[used] = vertices[used].astype(np.float64) @ world_to_camera[:3, :3].T + world_to_camera[:3, 3]
+
+    in_front = points[:, 2] > near
+    face_z = points[:, 2][faces]
+    keep = in_front[faces].all(axis=1) & (face_z.min(axis=1) <= far)
+
+    uv = np.zeros((len(points), 2))
+    uv[in_front] = project_points(points[in_front], K, camera_model, dist_params)
+    inv_z = np.zeros(len(points))
+    inv_z[in_front] = 1 / points[in_front, 2]
+
+    face_ids = np.flatnonzero(keep)
+    face_uv = uv[faces[face_ids]]
+    # pixel j covers the center j + 0.5
+    u_min = np.ceil(face_uv[..., 0].min(axis=1) - 0.5)
+    u_max = np.floor(face_uv[..., 0].max(axis=1) - 0.5)
+    v_min = np.ceil(face_uv[..., 1].min(axis=1) - 0.5)
+    v_max = np.floor(face_uv[..., 1].max(axis=1) - 0.5)
+    e1 = face_uv[:, 1] - face_uv[:, 0]
+    e2 = face_uv[:, 2] - face_uv[:, 0]
+    area = e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0]
+    visible = (
+        (u_min <= u_max) & (v_min <= v_max) & (u_max >= 0) & (u_min <= width - 1)
+        & (v_max >= 0) & (v_min <= height - 1) & (area != 0)
+    )
+    return face_ids[visible], uv, inv_z
+
+
+def face_pixel_bounds(face_uv, height, width):
+    '''
+    first and last pixel column (u0, u1) and row (v0, v1) in the bounding box of each
+    face, clipped to the image. pixel j covers the center j + 0.5
+    '''
+    u = face_uv[..., 0]
+    v = face_uv[..., 1]
+    return (
+        np.clip(np.ceil(u.min(axis=1) - 0.5), 0, width - 1).astype(np.int64),
+        np.clip(np.floor(u.max(axis=1) - 0.5), 0, width - 1).astype(np.int64),
+        np.clip(np.ceil(v.min(axis=1) - 0.5), 0, height - 1).astype(np.int64),
+        np.clip(np.floor(v.max(axis=1) - 0.5), 0, height - 1).astype(np.int64),
+    )
+
+
+def _expand_boxes(u0, u1, v0, v1):
+    '''
+    enumerate the cells of boxes
+    returns: box index, column and row of every cell
+    '''
+    num_x = u1 - u0 + 1
+    counts = num_x * (v1 - v0 + 1)
+    box = np.repeat(np.arange(len(u0)), counts)
+    local = np.arange(len(box)) - np.repeat(np.cumsum(counts) - counts, counts)
+    num_x = num_x[box]
+    return box, u0[box] + local % num_x, v0[box] + local // num_x
+
+
+def bin_faces(face_uv, height, width, tile_size):
+    """Bin faces into the image tiles their bounding box covers.
+
+    Args:
+        face_uv: (F, 3, 2) pixel coordinates of the face vertices.
+    Returns:
+        offsets (T + 1,) and tile_faces, the faces (indices into face_uv) of tile t are
+        tile_faces[offsets[t]:offsets[t + 1]], tiles are numbered row by row.
+    """
+    tiles_x = (width + tile_size - 1) // tile_size
+    tiles_y = (height + tile_size - 1) // tile_size
+    u0, u1, v0, v1 = face_pixel_bounds(face_uv, height, width)
+    # one entry per (face, covered tile)
+    entry_face, tx, ty = _expand_boxes(u0 // tile_size, u1 // tile_size, v0 // tile_size, v1 // tile_size)
+    entry_tile = ty * tiles_x + tx
+    order = np.argsort(entry_tile, kind="stable")
+    offsets = np.zeros(tiles_x * tiles_y + 1, dtype=np.int64)
+    np.cumsum(np.bincount(entry_tile, minlength=tiles_x * tiles_y), out=offsets[1:])
+    return offsets, entry_face[order]
+
+
+def _raster_small_faces(faces, bounds, width, face_uv, face_inv_z, far):
+    '''
+    rasterize faces by testing the pixels of their bounding boxes, vectorized over
+    (face, pixel) pairs
+    returns: flat pixel index, depth, face, barycentrics and edge distance in pixels of the
+    nearest face at each covered pixel
+    '''
+    box, u, v = _expand_boxes(*(b[faces] for b in bounds))
+    face = faces[box]
+    px = u + 0.5
+    py = v + 0.5
+    x = face_uv[face, :, 0]
+    y = face_uv[face, :, 1]
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (y[:, 1] - y[:, 0]) * (x[:, 2] - x[:, 0])
+    w = np.stack([
+        ((x[:, (i + 2) % 3] - x[:, (i + 1) % 3]) * (py - y[:, (i + 1) % 3])
+         - (y[:, (i + 2) % 3] - y[:, (i + 1) % 3]) * (px - x[:, (i + 1) % 3])) / area
+        for i in range(3)
+    ], axis=1)
+    inside = (w >= 0).all(axis=1)
+    w, face, area, x, y = w[inside], face[inside], area[inside], x[inside], y[inside]
+    pixel = v[inside] * width + u[inside]
+
+    bary = w * face_inv_z[face]
+    z = 1 / bary.sum(axis=1)
+    front = z <= far
+    # nearest face per pixel: sort by pixel, then depth
+    order = np.lexsort((z[front], pixel[front]))
+    sel = np.flatnonzero(front)[order]
+    first = np.ones(len(sel), dtype=bool)
+    first[1:] = pixel[sel[1:]] != pixel[sel[:-1]]
+    sel = sel[first]
+
+    edge_len = np.stack([
+        np.hypot(x[sel, (i + 2) % 3] - x[sel, (i + 1) % 3], y[sel, (i + 2) % 3] - y[sel, (i + 1) % 3])
+        for i in range(3)
+    ], axis=1)
+    dist = (w[sel] * np.abs(area[sel])[:, None] / edge_len).min(axis=1)
+    return pixel[sel], z[sel], face[sel], bary[sel] * z[sel, None], dist
+
+
+def _raster_tile_numpy(tile, offsets, tile_faces, tiles_x, tile_size, face_uv, face_inv_z, far, ndc_scale, out):
+    '''
+    rasterize the faces of a tile, vectorized over faces x pixels
+    '''
+    start, end = offsets[tile], offsets[tile + 1]
+    if start == end:
+        return
+    pix_to_face, zbuf, bary_coords, dists = out
+    height, width = zbuf.shape
+    y0, x0 = (tile // tiles_x) * tile_size, (tile % tiles_x) * tile_size
+    y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+    py, px = np.mgrid[y0:y1, x0:x1]
+    px = px.reshape(-1) + 0.5
+    py = py.reshape(-1) + 0.5
+    num_pixels = len(px)
+    pixels = np.arange(num_pixels)
+
+    best_z = np.full(num_pixels, np.inf)
+    best_face = np.full(num_pixels, -1, dtype=np.int64)
+    best_bary = np.zeros((num_pixels, 3))
+    best_dist = np.zeros(num_pixels)
+
+    faces = tile_faces[start:end]
+    for chunk_start in range(0, len(faces), FACE_CHUNK_SIZE):
+        chunk = faces[chunk_start:chunk_start + FACE_CHUNK_SIZE]
+        # (C, 1) vertex coordinates against (P,) pixels
+        x = face_uv[chunk, :, 0][:, :, None]
+        y = face_uv[chunk, :, 1][:, :, None]
+        inv_z = face_inv_z[chunk]
+        area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (y[:, 1] - y[:, 0]) * (x[:, 2] - x[:, 0])
+        # edge functions of the edges opposite to each vertex, divided by the area
+        # they are the screen space barycentrics and >= 0 inside for both windings
+        w = []
+        for i in range(3):
+            xa, ya, xb, yb = x[:, (i + 1) % 3], y[:, (i + 1) % 3], x[:, (i + 2) % 3], y[:, (i + 2) % 3]
+            w.append(((xb - xa) * (py - ya) - (yb - ya) * (px - xa)) / area)
+        inside = (w[0] >= 0) & (w[1] >= 0) & (w[2] >= 0)
+        if not inside.any():
+            continue
+        pixel_inv_z = w[0] * inv_z[:, 0:1] + w[1] * inv_z[:, 1:2] + w[2] * inv_z[:, 2:3]
+        z = np.where(inside, 1 / np.where(inside, pixel_inv_z, 1), np.inf)
+        z[z > far] = np.inf
+        nearest = np.argmin(z, axis=0)
+        nearest_z = z[nearest, pixels]
+        update = nearest_z < best_z
+        if not update.any():
+            continue
+        pix, face = pixels[update], nearest[update]
+        best_z[pix] = nearest_z[update]
+        best_face[pix] = chunk[face]
+        screen_bary = np.stack([w[i][face, pix] for i in range(3)], axis=1)
+        bary = screen_bary * inv_z[face]
+        best_bary[pix] = bary / bary.sum(axis=1, keepdims=True)
+        # distance to an edge = barycentric * 2 * area / edge length
+        best_dist[pix] = np.min(np.stack([
+            screen_bary[:, i] * np.abs(area[face, 0]) / np.hypot(
+                x[face, (i + 2) % 3, 0] - x[face, (i + 1) % 3, 0], y[face, (i + 2) % 3, 0] - y[face, (i + 1) % 3, 0]
+            )
+            for i in range(3)
+        ], axis=1), axis=1)
+
+    hit = best_face >= 0
+    shape = (y1 - y0, x1 - x0)
+    pix_to_face[y0:y1, x0:x1] = best_face.reshape(shape)
+    zbuf[y0:y1, x0:x1] = np.where(hit, best_z, -1).reshape(shape)
+    bary_coords[y0:y1, x0:x1] = np.where(hit[:, None], best_bary, -1).reshape(shape + (3,))
+    dists[y0:y1, x0:x1] = np.where(hit, -(best_dist * ndc_scale) ** 2, -1).reshape(shape)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _raster_tiles_numba(offsets, tile_faces, tiles_x, tile_size, face_uv, face_inv_z, far, ndc_scale,
+                            pix_to_face, zbuf, bary_coords, dists):
+        height, width = zbuf.shape
+        for tile in numba.prange(len(offsets) - 1):
+            y0 = (tile // tiles_x) * tile_size
+            x0 = (tile % tiles_x) * tile_size
+            y1 = min(y0 + tile_size, height)
+            x1 = min(x0 + tile_size, width)
+            for k in range(offsets[tile], offsets[tile + 1]):
+                f = tile_faces[k]
+                xa, ya = face_uv[f, 0, 0], face_uv[f, 0, 1]
+                xb, yb = face_uv[f, 1, 0], face_uv[f, 1, 1]
+                xc, yc = face_uv[f, 2, 0], face_uv[f, 2, 1]
+                area = (xb - xa) * (yc - ya) - (yb - ya) * (xc - xa)
+                # bounding box of the face in the tile
+                u0 = max(x0, int(np.ceil(min(xa, xb, xc) - 0.5)))
+                u1 = min(x1 - 1, int(np.floor(max(xa, xb, xc) - 0.5)))
+                v0 = max(y0, int(np.ceil(min(ya, yb, yc) - 0.5)))
+                v1 = min(y1 - 1, int(np.floor(max(ya, yb, yc) - 0.5)))
+                len_a = np.hypot(xc - xb, yc - yb)
+                len_b = np.hypot(xa - xc, ya - yc)
+                len_c = np.hypot(xb - xa, yb - ya)
+                for v in range(v0, v1 + 1):
+                    py = v + 0.5
+                    for u in range(u0, u1 + 1):
+                        px = u + 0.5
+                        w0 = ((xc - xb) * (py - yb) - (yc - yb) * (px - xb)) / area
+                        w1 = ((xa - xc) * (py - yc) - (ya - yc) * (px - xc)) / area
+                        w2 = ((xb - xa) * (py - ya) - (yb - ya) * (px - xa)) / area
+                        if w0 < 0 or w1 < 0 or w2 < 0:
+                            continue
+                        b0 = w0 * face_inv_z[f, 0]
+                        b1 = w1 * face_inv_z[f, 1]
+                        b2 = w2 * face_inv_z[f, 2]
+                        z = 1 / (b0 + b1 + b2)
+                        if z > far or z >= zbuf[v, u]:
+                            continue
+                        zbuf[v, u] = z
+                        pix_to_face[v, u] = f
+                        bary_coords[v, u, 0] = b0 * z
+                        bary_coords[v, u, 1] = b1 * z
+                        bary_coords[v, u, 2] = b2 * z
+                        dist = min(w0 * abs(area) / len_a, w1 * abs(area) / len_b, w2 * abs(area) / len_c)
+                        dists[v, u] = -(dist * ndc_scale) ** 2
+
+
+def rasterize_mesh_cpu(vertices, faces, world_to_camera, K, height, width, camera_model="PINHOLE",
+                       dist_params=None, near=0.05, far=np.inf, tile_size=DEFAULT_TILE_SIZE,
+                       num_threads=None, use_numba=None, face_ids=None):
+    """Rasterize a mesh with one camera on the CPU, see the module docstring.
+
+    Args:
+        vertices: (V, 3) vertices in world coordinates.
+        faces: (F, 3) vertex indices of the triangles.
+        world_to_camera: (4, 4) pose, OpenCV camera convention.
+        K: (3, 3) intrinsic matrix.
+        camera_model, dist_params: See project_points.
+        near, far: Faces with a vertex closer than near are culled, pixels beyond far are empty.
+        tile_size: Tile size in pixels.
+        num_threads: Threads of the numpy path, default all cores.
+        use_numba: Use the numba kernel, default if numba is installed.
+        face_ids: Optional ids of the faces to rasterize, pix_to_face refers to the ids
+            of all faces.
+    Returns:
+        Dict with pix_to_face (H, W) int64, zbuf (H, W), bary_coords (H, W, 3) and dists
+        (H, W) float32.
+    """
+    if use_numba is None:
+        use_numba = numba is not None
+    elif use_numba and numba is None:
+        raise ImportError("numba is not installed")
+
+    faces = np.asarray(faces)
+    if face_ids is not None:
+        # rasterize a subset, e.g. from FaceGrid.query
+        face_ids = np.asarray(face_ids)
+        kept, uv, inv_z = _screen_faces(
+            vertices, faces[face_ids], world_to_camera, K, height, width, camera_model, dist_params, near, far,
+            subset=True,
+        )
+        face_ids = face_ids[kept]
+    else:
+        face_ids, uv, inv_z = _screen_faces(
+            vertices, faces, world_to_camera, K, height, width, camera_model, dist_params, near, far
+        )
+    face_uv = np.ascontiguousarray(uv[faces[face_ids]])
+    face_inv_z = np.ascontiguousarray(inv_z[faces[face_ids]])
+    tiles_x = (width + tile_size - 1) // tile_size
+    # pixels to NDC units, the shorter side of the image spans [-1, 1]
+    ndc_scale = 2.0 / min(height, width)
+
+    if use_numba:
+        pix_to_face = np.full((height, width), -1, dtype=np.int64)
+        zbuf = np.full((height, width), np.inf)
+        bary_coords = np.full((height, width, 3), -1.0)
+        dists = np.full((height, width), -1.0)
+        offsets, tile_faces = bin_faces(face_uv, height, width, tile_size)
+        _raster_tiles_numba(offsets, tile_faces, tiles_x, tile_size, face_uv, face_inv_z, float(far), ndc_scale,
+                            pix_to_face, zbuf, bary_coords, dists)
+        zbuf[pix_to_face < 0] = -1
+    else:
+        pix_to_face = np.full((height, width), -1, dtype=np.int64)
+        zbuf = np.full((height, width), -1.0)
+        bary_coords = np.full((height, width, 3), -1.0)
+        dists = np.full((height, width), -1.0)
+        out = (pix_to_face, zbuf, bary_coords, dists)
+        # faces with a bounding box smaller than a tile are rasterized per face, the others per tile
+        bounds = face_pixel_bounds(face_uv, height, width)
+        box_size = (bounds[1] - bounds[0] + 1) * (bounds[3] - bounds[2] + 1)
+        small = box_size <= tile_size * tile_size
+        large_faces = np.flatnonzero(~small)
+        offsets, tile_faces = bin_faces(face_uv[large_faces], height, width, tile_size)
+        tile_faces = large_faces[tile_faces]
+        tiles = np.flatnonzero(np.diff(offsets) > 0)
+
+        small_faces = np.flatnonzero(small)
+        # chunks of about PIXEL_CHUNK_SIZE (face, pixel) pairs
+        chunk_ids = np.cumsum(box_size[small_faces]) // PIXEL_CHUNK_SIZE
+        splits = np.flatnonzero(np.diff(chunk_ids)) + 1
+        chunks = np.split(small_faces, splits) if len(small_faces) > 0 else []
+
+        # numpy releases the GIL in the array operations, tiles write disjoint regions
+        with ThreadPoolExecutor(max_workers=num_threads or os.cpu_count()) as executor:
+            list(executor.map(
+                lambda tile: _raster_tile_numpy(tile, offsets, tile_faces, tiles_x, tile_size, face_uv,
+                                                face_inv_z, far, ndc_scale, out),
+                tiles,
+            ))
+            # merge the small faces in the calling thread
+            flat_z = zbuf.reshape(-1)
+            for pixel, z, face, bary, dist in executor.map(
+                lambda chunk: _raster_small_faces(chunk, bounds, width, face_uv, face_inv_z, far), chunks
+            ):
+                current = flat_z[pixel]
+                update = (current < 0) | (z < current)
+                pixel = pixel[update]
+                flat_z[pixel] = z[update]
+                pix_to_face.reshape(-1)[pixel] = face[update]
+                bary_coords.reshape(-1, 3)[pixel] = bary[update]
+                dists.reshape(-1)[pixel] = -(dist[update] * ndc_scale) ** 2
+
+    # face indices of the culled face list to mesh face ids
+    hit = pix_to_face >= 0
+    pix_to_face[hit] = face_ids[pix_to_face[hit]]
+    return {
+        "pix_to_face": pix_to_face,
+        "zbuf": zbuf.astype(np.float32),
+        "bary_coords": bary_coords.astype(np.float32),
+        "dists": dists.astype(np.float32),
+    }
+
+
+class CPURender:
+    """Drop-in for renderpy.Render in common/render.py on the CPU.
+
+    renderAll returns the RGB interpolated from the vertex colors (0-255), the depth in m
+    (0 for empty pixels) and per pixel the vertex of the face closest to it (-1 for
+    empty pixels).
+    """
+
+    def __init__(self, num_threads=None, use_numba=None, tile_size=DEFAULT_TILE_SIZE):
+        self.num_threads = num_threads
+        self.use_numba = use_numba
+        self.tile_size = tile_size
+        self.mesh = None
+        self.face_index = None
+        self.camera = None
+
+    def setupMesh(self, mesh, face_index=None):
+        '''
+        mesh: MeshArrays, e.g. from ScannetppScene_Release.load_mesh
+        face_index: optional FaceGrid of the mesh, only the faces in the frustum are rasterized
+        '''
+        self.mesh = mesh
+        self.face_index = face_index
+
+    def setupCamera(self, height, width, fx, fy, cx, cy, camera_model, params):
+        K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
+        self.camera = CPUCamera(None, K, int(height), int(width), camera_model, np.asarray(params))
+
+    def renderAll(self, world_to_camera, near, far):
+        camera = self.camera
+        face_ids = None
+        if self.face_index is not None:
+            face_ids = self.face_index.query(
+                world_to_camera, camera.K, camera.height, camera.width, camera.camera_model, camera.dist_params,
+                near=near, far=far,
+            )
+        raster = rasterize_mesh_cpu(
+            self.mesh.vertices, self.mesh.triangles, world_to_camera, camera.K, camera.height, camera.width,
+            camera.camera_model, camera.dist_params, near=near, far=far, tile_size=self.tile_size,
+            num_threads=self.num_threads, use_numba=self.use_numba, face_ids=face_ids,
+        )
+        pix_to_face = raster["pix_to_face"]
+        hit = pix_to_face >= 0
+        face_verts = np.asarray(self.mesh.triangles)[pix_to_face[hit]]
+        bary = raster["bary_coords"][hit]
+
+        rgb = np.zeros((camera.height, camera.width, 3), dtype=np.float32)
+        if self.mesh.vertex_colors is not None:
+            colors = np.asarray(self.mesh.vertex_colors)[face_verts]
+            rgb[hit] = np.einsum("nk,nkc->nc", bary, colors) * 255
+        depth = np.where(hit, raster["zbuf"], 0)
+        vert_indices = np.full((camera.height, camera.width), -1, dtype=np.int64)
+        vert_indices[hit] = face_verts[np.arange(len(face_verts)), bary.argmax(axis=1)]
+        return rgb, depth, vert_indices
@@ -0,0 +1,209 @@
+'''
+Single-file container for a sequence of equally shaped frames, e.g. iPhone depth maps
+
+Layout:
+    preamble: magic, version and padding to DATA_OFFSET bytes
+    chunks: chunk_size frames each, raw (C order) or compressed with lz4
+    footer: JSON with the number of frames, frame shape, dtype, compression,
+        chunk offsets and frame names
+    trailer: footer size (uint64 little endian) and magic
+
+The container is written as a single sequential stream. Uncompressed frames are
+contiguous and aligned, so the reader memory-maps them without copying.
+'''
+
+import json
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+import lz4.block
+
+MAGIC = b"SNPPDCv1"
+VERSION = 1
+DATA_OFFSET = 64
+_TRAILER = struct.Struct("<Q8s")
+COMPRESSIONS = ("none", "lz4")
+
+
+class DepthContainerWriter:
+    """Write frames to a container, see the module docstring.
+
+    The container is written to a temporary file that is renamed to path on close,
+    an interrupted write never leaves a truncated container behind.
+
+    Args:
+        path: Output path.
+        frame_shape: Shape of each frame, e.g. (192, 256).
+        dtype: Data type of the frames.
+        compression: "none" or "lz4".
+        chunk_size: Number of frames compressed together.
+    """
+
+    def __init__(self, path, frame_shape, dtype=np.uint16, compression="none", chunk_size=64):
+        assert compression in COMPRESSIONS, f"Unknown compression: {compression}"
+        self.path = Path(path)
+        self.frame_shape = tuple(int(s) for s in frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.chunk_size = chunk_size if compression != "none" else 1
+        self.frame_nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+
+        self.names = []
+        self.chunks = []
+        self._pending = []
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._tmp_path = self.path.parent / f".{self.path.name}.tmp{os.getpid()}"
+        self._file = open(self._tmp_path, "wb")
+        preamble = MAGIC + struct.pack("<I", VERSION)
+        self._file.write(preamble + b"\0" * (DATA_OFFSET - len(preamble)))
+        self._offset = DATA_OFFSET
+
+    def write(self, frame, name=None):
+        """Append a frame.
+
+        Args:
+            frame: Array of frame_shape, converted to dtype.
+            name: Optional name of the frame, e.g. the name of the corresponding image.
+        """
+        frame = np.ascontiguousarray(frame, dtype=self.dtype)
+        assert frame.shape == self.frame_shape, f"Frame shape {frame.shape} != {self.frame_shape}"
+        self.names.append(name if name is not None else str(len(self.names)))
+        self._pending.append(frame.tobytes())
+        if len(self._pending) >= self.chunk_size:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        if len(self._pending) == 0:
+            return
+        data = b"".join(self._pending)
+        if self.compression == "lz4":
+            data = lz4.block.compress(data, store_size=False)
+        self._file.write(data)
+        self.chunks.append([self._offset, len(data), len(self._pending)])
+        self._offset += len(data)
+        self._pending = []
+
+    def close(self):
+        if self._file is None:
+            return
+        self._flush_chunk()
+        footer = {
+            "version": VERSION,
+            "num_frames": len(self.names),
+            "shape": list(self.frame_shape),
+            "dtype": self.dtype.str,
+            "compression": self.compression,
+            "chunk_size": self.chunk_size,
+            "names": self.names,
+        }
+        if self.compression != "none":
+            # raw frames are contiguous, their offsets follow from the frame index
+            footer["chunks"] = self.chunks
+        footer = json.dumps(footer).encode("utf-8")
+        self._file.write(footer)
+        self._file.write(_TRAILER.pack(len(footer), MAGIC))
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """Discard the container written so far."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class DepthContainer:
+    """Random access to the frames of a container written by DepthContainerWriter.
+
+    Uncompressed frames are returned as read-only views of a memory map. Compressed
+    frames are decoded per chunk, the last decoded chunk is kept.
+
+    Args:
+        path: Path of the container.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            preamble = f.read(len(MAGIC))
+            if preamble != MAGIC:
+                raise ValueError(f"Not a depth container: {self.path}")
+            f.seek(-_TRAILER.size, os.SEEK_END)
+            footer_size, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+            if magic != MAGIC:
+                raise ValueError(f"Truncated depth container: {self.path}")
+            f.seek(-_TRAILER.size - footer_size, os.SEEK_END)
+            footer = json.loads(f.read(footer_size).decode("utf-8"))
+
+        self.num_frames = footer["num_frames"]
+        self.shape = tuple(footer["shape"])
+        self.dtype = np.dtype(footer["dtype"])
+        self.compression = footer["compression"]
+        self.names = footer["names"]
+        self._name_to_index = None
+
+        self._frames = None
+        self._chunks = footer.get("chunks", [])
+        self._chunk_starts = np.cumsum([0] + [num for _, _, num in self._chunks])
+        self._cached_chunk = (None, None)
+        if self.compression == "none" and self.num_frames > 0:
+            self._frames = np.memmap(
+                self.path, dtype=self.dtype, mode="r", offset=DATA_OFFSET,
+                shape=(self.num_frames, *self.shape),
+            )
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, index):
+        """Frame at index, negative indices count from the end."""
+        if index < 0:
+            index += self.num_frames
+        if not 0 <= index < self.num_frames:
+            raise IndexError(f"Frame index {index} out of range for {self.num_frames} frames")
+        if self._frames is not None:
+            return self._frames[index]
+        chunk_idx = int(np.searchsorted(self._chunk_starts, index, side="right")) - 1
+        return self._read_chunk(chunk_idx)[index - self._chunk_starts[chunk_idx]]
+
+    def _read_chunk(self, chunk_idx):
+        cached_idx, cached = self._cached_chunk
+        if cached_idx == chunk_idx:
+            return cached
+        offset, size, num = self._chunks[chunk_idx]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            data = f.read(size)
+        frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        data = lz4.block.decompress(data, uncompressed_size=num * frame_nbytes)
+        frames = np.frombuffer(data, dtype=self.dtype).reshape(num, *self.shape)
+        self._cached_chunk = (chunk_idx, frames)
+        return frames
+
+    def index_of(self, name):
+        """Index of the frame with the given name."""
+        if self._name_to_index is None:
+            self._name_to_index = {n: i for i, n in enumerate(self.names)}
+        return self._name_to_index[name]
+
+    def get(self, name):
+        """Frame with the given name."""
+        return self[self.index_of(name)]
+
+    def __iter__(self):
+        for index in range(self.num_frames):
+            yield self[index]
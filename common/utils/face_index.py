@@ -0,0 +1,191 @@
+'''
+Uniform grid over the faces of a mesh to find the faces a camera can see.
+
+Each face is assigned to the grid cell containing its centroid, and each cell stores
+the bounding box of its faces. A frustum query tests the bounding spheres of the
+cells against the near and far planes and the side planes through the image border,
+and returns the faces of the cells that intersect the frustum. The result is
+conservative: every face the camera sees is returned, plus some faces that turn out
+to be hidden or outside the image.
+
+Build the grid once per scene (ScannetppScene_Release.load_face_index caches it) and
+rasterize only the returned faces, e.g. with the face_ids of rasterize_mesh_cpu.
+'''
+
+import numpy as np
+
+from .cpu_rasterizer import unproject_pixels
+
+# border pixels per image side that define the side planes of the frustum
+BORDER_SAMPLES = 16
+# angle in radians added to the side planes, the straight planes between the border
+# samples cut off the curved border of distorted images by less than this
+PLANE_MARGIN = 0.01
+
+
+def _convex_hull(points):
+    '''
+    indices of the 2D convex hull of points, counter-clockwise (monotone chain)
+    '''
+    order = np.lexsort((points[:, 1], points[:, 0]))
+
+    def half(indices):
+        hull = []
+        for i in indices:
+            while len(hull) >= 2:
+                a, b = points[hull[-2]], points[hull[-1]]
+                if (b[0] - a[0]) * (points[i][1] - a[1]) - (b[1] - a[1]) * (points[i][0] - a[0]) > 0:
+                    break
+                hull.pop()
+            hull.append(i)
+        return hull[:-1]
+
+    return np.array(half(order) + half(order[::-1]))
+
+
+def frustum_normals(K, height, width, camera_model="PINHOLE", dist_params=None):
+    """Inward normals of the side planes of a camera frustum.
+
+    The frustum of a distorted camera is not convex, the planes pass through the camera
+    center and the convex hull of the rays of border samples. Cameras with a field of
+    view close to 180 degrees get no side planes.
+
+    Returns:
+        (S, 3) unit normals in camera coordinates.
+    """
+    t = np.linspace(0, 1, BORDER_SAMPLES, endpoint=False)
+    border = np.concatenate([
+        np.stack([t * width, np.zeros_like(t)], axis=1),
+        np.stack([np.full_like(t, width), t * height], axis=1),
+        np.stack([(1 - t) * width, np.full_like(t, height)], axis=1),
+        np.stack([np.zeros_like(t), (1 - t) * height], axis=1),
+    ])
+    rays = unproject_pixels(border, K, camera_model, dist_params)
+    if rays[:, 2].min() < 0.05:
+        return np.zeros((0, 3))
+    plane_points = rays[:, :2] / rays[:, 2:]
+    hull = rays[_convex_hull(plane_points)]
+    normals = np.cross(hull, np.roll(hull, -1, axis=0))
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    # orient towards the principal ray, which is inside the frustum
+    normals *= np.sign(normals[:, 2:3] + (normals[:, 2:3] == 0))
+    return normals
+
+
+class FaceGrid:
+    """Uniform grid over the faces of a mesh, see the module docstring.
+
+    Args:
+        face_order: (F,) face ids sorted by cell.
+        cell_offsets: (C + 1,) the faces of cell c are face_order[cell_offsets[c]:cell_offsets[c + 1]].
+        cell_min, cell_max: (C, 3) bounding boxes of the faces of each (non-empty) cell.
+    """
+
+    def __init__(self, face_order, cell_offsets, cell_min, cell_max):
+        self.face_order = face_order
+        self.cell_offsets = cell_offsets
+        self.cell_min = cell_min
+        self.cell_max = cell_max
+
+    @classmethod
+    def build(cls, vertices, faces, faces_per_cell=512):
+        """Build the grid of a mesh.
+
+        Args:
+            vertices: (V, 3) vertices.
+            faces: (F, 3) vertex indices of the triangles.
+            faces_per_cell: Average number of faces per cell if the faces filled the bounding
+                box of the mesh, cells on the surfaces of a room hold more.
+        """
+        vertices = np.asarray(vertices, dtype=np.float32)
+        faces = np.asarray(faces)
+        if len(faces) == 0:
+            return cls(np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros((0, 3)), np.zeros((0, 3)))
+        face_verts = vertices[faces]
+        face_min = face_verts.min(axis=1)
+        face_max = face_verts.max(axis=1)
+        centroids = face_verts.mean(axis=1)
+
+        lo = face_min.min(axis=0)
+        extent = np.maximum(face_max.max(axis=0) - lo, 1e-6)
+        cell_size = (np.prod(extent) / max(len(faces) / faces_per_cell, 1)) ** (1 / 3)
+        dims = np.maximum(np.ceil(extent / cell_size), 1).astype(np.int64)
+
+        cell = np.minimum(((centroids - lo) / cell_size).astype(np.int64), dims - 1)
+        cell_id = (cell[:, 0] * dims[1] + cell[:, 1]) * dims[2] + cell[:, 2]
+        face_order = np.argsort(cell_id, kind="stable")
+        sorted_ids = cell_id[face_order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        cell_offsets = np.r_[starts, len(faces)].astype(np.int64)
+        cell_min = np.minimum.reduceat(face_min[face_order], starts)
+        cell_max = np.maximum.reduceat(face_max[face_order], starts)
+        return cls(face_order, cell_offsets, cell_min, cell_max)
+
+    @classmethod
+    def from_mesh(cls, mesh, **kwargs):
+        """Grid of a mesh with vertices and triangles, e.g. MeshArrays."""
+        return cls.build(mesh.vertices, mesh.triangles, **kwargs)
+
+    def __len__(self):
+        return len(self.face_order)
+
+    @property
+    def num_cells(self):
+        return len(self.cell_min)
+
+    @property
+    def nbytes(self):
+        return self.face_order.nbytes + self.cell_offsets.nbytes + self.cell_min.nbytes + self.cell_max.nbytes
+
+    def query_cells(self, world_to_camera, K, height, width, camera_model="PINHOLE", dist_params=None,
+                    near=0.05, far=np.inf):
+        """Mask of the cells intersecting the frustum of a camera, see query."""
+        world_to_camera = np.asarray(world_to_camera, dtype=np.float64)
+        centers = (self.cell_min + self.cell_max) / 2
+        radii = np.linalg.norm(self.cell_max - self.cell_min, axis=1) / 2
+        centers = centers @ world_to_camera[:3, :3].T + world_to_camera[:3, 3]
+
+        visible = (centers[:, 2] + radii >= near) & (centers[:, 2] - radii <= far)
+        margin = PLANE_MARGIN * np.linalg.norm(centers, axis=1)
+        for normal in frustum_normals(K, height, width, camera_model, dist_params):
+            visible &= centers @ normal >= -radii - margin
+        return visible
+
+    def query(self, world_to_camera, K, height, width, camera_model="PINHOLE", dist_params=None,
+              near=0.05, far=np.inf):
+        """Faces that a camera can see.
+
+        Args:
+            world_to_camera: (4, 4) pose, OpenCV camera convention.
+            K, camera_model, dist_params: See cpu_rasterizer.project_points.
+            near, far: Depth range of the camera.
+        Returns:
+            Sorted ids of the faces in the cells intersecting the frustum.
+        """
+        cells = np.flatnonzero(self.query_cells(
+            world_to_camera, K, height, width, camera_model, dist_params, near, far
+        ))
+        starts = self.cell_offsets[cells]
+        counts = self.cell_offsets[cells + 1] - starts
+        # concatenate the face ranges of the cells
+        positions = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return np.sort(self.face_order[positions])
+
+
+def remap_pix_to_face(pix_to_face, face_ids):
+    """pix_to_face of a rasterized face subset to the ids of all faces.
+
+    Args:
+        pix_to_face: Indices into face_ids, -1 for empty pixels, numpy array or torch tensor.
+        face_ids: Ids of the rasterized faces.
+    """
+    if isinstance(pix_to_face, np.ndarray):
+        face_ids = np.asarray(face_ids)
+        if len(face_ids) == 0:
+            return np.full_like(pix_to_face, -1)
+        return np.where(pix_to_face >= 0, face_ids[np.maximum(pix_to_face, 0)], -1)
+    import torch
+    face_ids = torch.as_tensor(face_ids, device=pix_to_face.device)
+    if len(face_ids) == 0:
+        return torch.full_like(pix_to_face, -1)
+    return torch.where(pix_to_face >= 0, face_ids[pix_to_face.clamp(min=0)], pix_to_face)
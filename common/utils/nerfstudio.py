@@ -1,9 +1,16 @@
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
+from json.encoder import encode_basestring_ascii
+import argparse
+import functools
 import json
+import os
 
 from pathlib import Path
 import numpy as np
-from common.utils.colmap import Camera, Image, read_model
+from tqdm import tqdm
+from common.scene_release import ScannetppScene_Release
+from common.utils.colmap import Camera, Image, read_model, camera_to_world_batch, image_poses
+from common.utils.utils import read_txt_list
 
 
 def convert_camera(camera: Camera) -> Dict[str, Any]:
@@ -46,26 +53,186 @@ def convert_camera(camera: Camera) -> Dict[str, Any]:
     return out
 
 
+def convert_poses(images: Dict[int, Image]) -> Tuple[List[str], np.ndarray]:
+    """Image names and (N, 4, 4) nerfstudio/instant-ngp camera to world matrices."""
+    c2ws = camera_to_world_batch(*image_poses(images))
+
+    # Convert from COLMAP's camera coordinate system to nerfstudio/instant-ngp
+    c2ws[:, 0:3, 1:3] *= -1
+    c2ws = c2ws[:, np.array([1, 0, 2, 3]), :]
+    c2ws[:, 2, :] *= -1
+
+    names = [image.name.split("/")[-1] for image in images.values()]
+    return names, c2ws
+
+
 def convert_frames(images: Dict[int, Image]) -> List[Dict[str, Any]]:
-    frames = []
-    for image_id, image in images.items():
-        w2c = image.world_to_camera
-        c2w = np.linalg.inv(w2c)
+    names, c2ws = convert_poses(images)
+    return [
+        {"file_path": name, "transform_matrix": c2w}
+        for name, c2w in zip(names, c2ws.tolist())
+    ]
+
+
+def _float_repr(o: float) -> str:
+    # same as the json encoder
+    if o != o:
+        return "NaN"
+    if o == float("inf"):
+        return "Infinity"
+    if o == -float("inf"):
+        return "-Infinity"
+    return float.__repr__(o)
+
+
+def _encode_scalar(o) -> str:
+    if isinstance(o, str):
+        return encode_basestring_ascii(o)
+    if o is None:
+        return "null"
+    if o is True:
+        return "true"
+    if o is False:
+        return "false"
+    if isinstance(o, int):
+        return int.__repr__(o)
+    if isinstance(o, float):
+        return _float_repr(o)
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+def _encode_scalars(values, separator: str) -> str:
+    if all(type(value) is float for value in values):
+        text = separator.join(map(float.__repr__, values))
+        # repr of nan and inf differs from the json encoding, finite floats contain no "n"
+        if "n" not in text:
+            return text
+    return separator.join(map(_encode_scalar, values))
+
+
+def _is_float_list(o) -> bool:
+    return isinstance(o, (list, tuple)) and all(type(value) is float for value in o)
+
+
+@functools.lru_cache(maxsize=None)
+def _matrix_template(num_rows: int, num_cols: int, indent: int, level: int) -> str:
+    newline = "\n" + " " * (indent * (level + 1))
+    row_newline = newline + " " * indent
+    row = "[" + row_newline + ("," + row_newline).join(["%s"] * num_cols) + newline + "]"
+    return "[" + newline + ("," + newline).join([row] * num_rows) + "\n" + " " * (indent * level) + "]"
+
+
+def iter_json(o, indent: int = 4, level: int = 0):
+    """Chunks of json.dumps(o, indent=indent), the concatenation is byte-identical.
+
+    Lists of scalars are encoded with a single join and float matrices (e.g. the
+    transform matrices) with a single format, instead of one step per number.
+    """
+    if isinstance(o, dict):
+        if len(o) == 0:
+            yield "{}"
+            return
+        newline = "\n" + " " * (indent * (level + 1))
+        separator = "{"
+        for key, value in o.items():
+            key = key if isinstance(key, str) else _encode_scalar(key)
+            if isinstance(value, (dict, list, tuple)):
+                yield separator + newline + encode_basestring_ascii(key) + ": "
+                yield from iter_json(value, indent, level + 1)
+            else:
+                yield separator + newline + encode_basestring_ascii(key) + ": " + _encode_scalar(value)
+            separator = ","
+        yield "\n" + " " * (indent * level) + "}"
+    elif isinstance(o, (list, tuple)):
+        if len(o) == 0:
+            yield "[]"
+            return
+        if _is_float_list(o[0]) and len(o[0]) > 0:
+            if all(_is_float_list(row) and len(row) == len(o[0]) for row in o):
+                # float matrix (e.g. a transform matrix), formatted at once
+                text = _matrix_template(len(o), len(o[0]), indent, level) % tuple(
+                    map(float.__repr__, [value for row in o for value in row])
+                )
+                # repr of nan and inf differs from the json encoding, finite floats contain no "n"
+                if "n" not in text:
+                    yield text
+                    return
+        newline = "\n" + " " * (indent * (level + 1))
+        if not any(isinstance(value, (dict, list, tuple)) for value in o):
+            yield "[" + newline + _encode_scalars(o, "," + newline)
+        else:
+            separator = "["
+            for value in o:
+                yield separator + newline
+                yield from iter_json(value, indent, level + 1)
+                separator = ","
+        yield "\n" + " " * (indent * level) + "]"
+    else:
+        yield _encode_scalar(o)
+
 
-        # Convert from COLMAP's camera coordinate system to nerfstudio/instant-ngp
-        c2w[0:3, 1:3] *= -1
-        c2w = c2w[np.array([1, 0, 2, 3]), :]
-        c2w[2, :] *= -1
+def write_transforms_json(data: Dict[str, Any], out_path: Path):
+    """Stream transforms to out_path, same content as json.dumps(data, indent=4)."""
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.parent / f".{out_path.name}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        f.writelines(iter_json(data, indent=4))
+    os.replace(tmp_path, out_path)
+
+
+def transforms_binary_path(transforms_path: Path) -> Path:
+    """transforms.json -> transforms.npz"""
+    return Path(transforms_path).with_suffix(".npz")
+
+
+def write_transforms_binary(data: Dict[str, Any], transforms_path: Path):
+    """Write the binary companion of a transforms.json: the frame names and float32
+    (N, 4, 4) poses of frames and test_frames, and has_mask if it is set. The size and
+    mtime of the json are stored, a companion of an older json is not used.
+    """
+    transforms_path = Path(transforms_path)
+    stat = os.stat(transforms_path)
+    arrays = {"json_size": stat.st_size, "json_mtime_ns": stat.st_mtime_ns}
+    for key in ("frames", "test_frames"):
+        frames = data.get(key, [])
+        arrays[f"{key}_names"] = np.array([frame["file_path"] for frame in frames], dtype=str)
+        arrays[f"{key}_poses"] = np.array(
+            [frame["transform_matrix"] for frame in frames], dtype=np.float32
+        ).reshape(-1, 4, 4)
+    if "has_mask" in data:
+        arrays["has_mask"] = bool(data["has_mask"])
+    out_path = transforms_binary_path(transforms_path)
+    tmp_path = out_path.parent / f".{out_path.stem}.tmp{os.getpid()}.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, out_path)
 
-        image_name = image.name.split("/")[-1]
-        frame = {
-            "file_path": image_name,
-            "transform_matrix": c2w.tolist(),
-        }
 
-        frames.append(frame)
-    return frames
+def load_transforms_binary(transforms_path: Path) -> Optional[Dict[str, Any]]:
+    """Load the binary companion of a transforms.json.
 
+    Returns:
+        Dict with frames_names, frames_poses, test_frames_names, test_frames_poses and
+        has_mask if present. None if there is no companion or the json changed since it
+        was written.
+    """
+    transforms_path = Path(transforms_path)
+    binary_path = transforms_binary_path(transforms_path)
+    if not binary_path.is_file():
+        return None
+    try:
+        stat = os.stat(transforms_path)
+        with np.load(binary_path) as f:
+            if int(f["json_size"]) != stat.st_size or int(f["json_mtime_ns"]) != stat.st_mtime_ns:
+                return None
+            out = {key: f[key] for key in f.files if not key.startswith("json_")}
+    except (OSError, ValueError, KeyError):
+        return None
+    out["frames_names"] = out["frames_names"].tolist()
+    out["test_frames_names"] = out["test_frames_names"].tolist()
+    if "has_mask" in out:
+        out["has_mask"] = bool(out["has_mask"])
+    return out
 
 
 def prepare_transforms_json(
@@ -74,27 +241,89 @@ def prepare_transforms_json(
     train_list: List[str],
     test_list: List[str],
     has_mask: bool = False,
+    write_binary: bool = True,
 ):
-    cameras, images, points3D = read_model(model_path, ".txt")
+    """Write the nerfstudio transforms.json of a COLMAP model.
+
+    Args:
+        write_binary: Also write the binary companion, see write_transforms_binary.
+    """
+    cameras, images, points3D = read_model(model_path, ".txt", pose_only=True, columnar=True)
     assert len(cameras) == 1, "Multiple cameras not supported"
     camera = next(iter(cameras.values()))
     data = convert_camera(camera)
     frame_data = convert_frames(images)
     train_frames = []
     test_frames = []
+    train_set = set(train_list)
+    test_set = set(test_list)
 
     for frame in frame_data:
         fn = frame["file_path"]
         if has_mask:
             frame["mask_path"] = fn.replace(".JPG", ".png")
-        if fn in train_list:
+        if fn in train_set:
             train_frames.append(frame)
-        elif fn in test_list:
+        elif fn in test_set:
             test_frames.append(frame)
 
     data["frames"] = train_frames
     data["test_frames"] = test_frames
 
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(out_path, 'w') as f:
-        f.write(json.dumps(data, indent=4))
+    write_transforms_json(data, out_path)
+    if write_binary:
+        write_transforms_binary(data, out_path)
+
+
+def build_transforms_binary(transforms_path: Path, force: bool = False) -> bool:
+    """Write the binary companion of an existing transforms.json if it is missing or outdated.
+
+    Returns:
+        True if the companion was written.
+    """
+    if not force and load_transforms_binary(transforms_path) is not None:
+        return False
+    with open(transforms_path, "r") as f:
+        data = json.load(f)
+    write_transforms_binary(data, transforms_path)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the binary companions of existing transforms.json files")
+    parser.add_argument("--data_root", required=True, help="folder where the data is downloaded")
+    parser.add_argument("--splits", nargs="*", default=[], help="splits in data_root/splits")
+    parser.add_argument("--scene_ids", nargs="*", default=[], help="scene ids, in addition to the splits")
+    parser.add_argument("--devices", nargs="+", choices=["dslr", "iphone"], default=["dslr", "iphone"])
+    parser.add_argument("--names", nargs="+", default=["nerfstudio/transforms.json"],
+                        help="transforms files relative to the device dir, e.g. nerfstudio/transforms_undistorted.json")
+    parser.add_argument("--force", action="store_true", help="rewrite valid companions")
+    args = parser.parse_args()
+
+    scene_ids = list(args.scene_ids)
+    for split in args.splits:
+        scene_ids += read_txt_list(Path(args.data_root) / "splits" / f"{split}.txt")
+
+    transforms_paths = []
+    for scene_id in dict.fromkeys(scene_ids):
+        scene = ScannetppScene_Release(scene_id, data_root=Path(args.data_root) / "data")
+        for device in args.devices:
+            device_dir = scene.dslr_dir if device == "dslr" else scene.iphone_data_dir
+            for name in args.names:
+                if (device_dir / name).is_file():
+                    transforms_paths.append(device_dir / name)
+
+    num_built, failed = 0, []
+    for transforms_path in tqdm(transforms_paths, desc="transforms"):
+        try:
+            num_built += int(build_transforms_binary(transforms_path, args.force))
+        except Exception as e:
+            failed.append(transforms_path)
+            print(f"Failed to build the companion of {transforms_path}: {e!r}")
+
+    print(f"Built {num_built} companions, {len(transforms_paths) - num_built - len(failed)} up to date, "
+          f"{len(failed)} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+'''
+Bounded producer/consumer pipeline for frame-level image jobs:
+reader threads -> compute (calling thread) -> writer threads
+
+cv2 and numpy release the GIL in decoding, encoding and most image operations,
+so reading, computing and writing of different frames overlap
+'''
+
+import queue
+import threading
+import time
+
+from tqdm import tqdm
+
+# marks the end of a stream
+_DONE = object()
+
+
+class PipelineStats:
+    """Per-stage timings and queue depths of a FramePipeline run."""
+
+    STAGES = ("read", "compute", "write")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # time spent inside the stage functions, summed over all threads
+        self.stage_time = {stage: 0.0 for stage in self.STAGES}
+        self.stage_count = {stage: 0 for stage in self.STAGES}
+        # time the compute stage waited for read data / for space in the write queue
+        self.wait_read_time = 0.0
+        self.wait_write_time = 0.0
+        # queue depths sampled before every compute step
+        self.read_queue_depths = []
+        self.write_queue_depths = []
+        self.wall_time = 0.0
+
+    def add(self, stage, duration):
+        with self._lock:
+            self.stage_time[stage] += duration
+            self.stage_count[stage] += 1
+
+    def bottleneck(self):
+        '''
+        guess the limiting stage: compute starving for input means the readers are too slow,
+        compute blocked on a full write queue means the writers are too slow
+        '''
+        if self.wait_read_time > max(self.wait_write_time, 0.1 * self.wall_time):
+            return "read"
+        if self.wait_write_time > 0.1 * self.wall_time:
+            return "write"
+        return "compute"
+
+    def summary(self):
+        lines = [f"pipeline wall time: {self.wall_time:.2f}s, bottleneck: {self.bottleneck()}"]
+        for stage in self.STAGES:
+            count = max(self.stage_count[stage], 1)
+            lines.append(
+                f"  {stage:<8} total {self.stage_time[stage]:.2f}s,"
+                f" {1000 * self.stage_time[stage] / count:.1f}ms/frame"
+            )
+        lines.append(
+            f"  compute waited {self.wait_read_time:.2f}s for reads, {self.wait_write_time:.2f}s for writes"
+        )
+        for name, depths in (("read", self.read_queue_depths), ("write", self.write_queue_depths)):
+            if len(depths) > 0:
+                lines.append(
+                    f"  {name} queue depth mean {sum(depths) / len(depths):.1f}, max {max(depths)}"
+                )
+        return "\n".join(lines)
+
+
+class FramePipeline:
+    """Run read_fn, compute_fn and write_fn over items with overlapping stages.
+
+    read_fn(item) runs in num_readers threads, compute_fn(item, data) in the calling
+    thread and write_fn(item, result) in num_writers threads. The queues between the
+    stages hold at most queue_size elements, so fast readers block instead of
+    loading the whole input into memory. Items may complete out of order.
+    """
+
+    def __init__(self, read_fn, compute_fn, write_fn, num_readers=2, num_writers=2, queue_size=8):
+        self.read_fn = read_fn
+        self.compute_fn = compute_fn
+        self.write_fn = write_fn
+        self.num_readers = max(num_readers, 1)
+        self.num_writers = max(num_writers, 1)
+        self.queue_size = queue_size
+        self.stats = PipelineStats()
+
+    def _timed(self, stage, fn, *args):
+        start = time.perf_counter()
+        out = fn(*args)
+        self.stats.add(stage, time.perf_counter() - start)
+        return out
+
+    def run(self, items, on_done=None, desc=None):
+        """Process all items.
+        args:
+            items: List of items, e.g. frames.
+            on_done: Optional callback on_done(item), called in the calling thread
+                after the item was written.
+            desc: Show a progress bar with this description if given.
+        returns:
+            PipelineStats of the run.
+        """
+        self.stats = PipelineStats()
+        items = list(items)
+        item_queue = queue.Queue()
+        for item in items:
+            item_queue.put(item)
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        done_queue = queue.Queue()
+        errors = []
+        stop = threading.Event()
+
+        def put(q, value):
+            # give up when another stage failed, the consumer may be gone
+            while not stop.is_set():
+                try:
+                    q.put(value, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    try:
+                        item = item_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    data = self._timed("read", self.read_fn, item)
+                    if not put(read_queue, (item, data)):
+                        return
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(read_queue, _DONE)
+
+        def writer():
+            try:
+                while True:
+                    entry = write_queue.get()
+                    if entry is _DONE:
+                        break
+                    item, result = entry
+                    self._timed("write", self.write_fn, item, result)
+                    done_queue.put(item)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+        readers = [threading.Thread(target=reader, daemon=True) for _ in range(self.num_readers)]
+        writers = [threading.Thread(target=writer, daemon=True) for _ in range(self.num_writers)]
+        for thread in readers + writers:
+            thread.start()
+
+        pbar = tqdm(total=len(items), desc=desc) if desc is not None else None
+
+        def drain_done():
+            while True:
+                try:
+                    item = done_queue.get_nowait()
+                except queue.Empty:
+                    return
+                if on_done is not None:
+                    on_done(item)
+                if pbar is not None:
+                    pbar.update(1)
+
+        start_time = time.perf_counter()
+        num_readers_done = 0
+        try:
+            while num_readers_done < self.num_readers and not stop.is_set():
+                self.stats.read_queue_depths.append(read_queue.qsize())
+                self.stats.write_queue_depths.append(write_queue.qsize())
+                wait_start = time.perf_counter()
+                try:
+                    entry = read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    self.stats.wait_read_time += time.perf_counter() - wait_start
+                    continue
+                self.stats.wait_read_time += time.perf_counter() - wait_start
+                if entry is _DONE:
+                    num_readers_done += 1
+                    continue
+                item, data = entry
+                result = self._timed("compute", self.compute_fn, item, data)
+                wait_start = time.perf_counter()
+                put(write_queue, (item, result))
+                self.stats.wait_write_time += time.perf_counter() - wait_start
+                drain_done()
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for _ in writers:
+                # writers that failed no longer consume the queue
+                while any(thread.is_alive() for thread in writers):
+                    try:
+                        write_queue.put(_DONE, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+            for thread in writers:
+                thread.join()
+            # unblock readers still waiting on a full queue after a failure
+            stop.set()
+            for thread in readers:
+                thread.join()
+            drain_done()
+            if pbar is not None:
+                pbar.close()
+            self.stats.wall_time = time.perf_counter() - start_time
+
+        if len(errors) > 0:
+            raise errors[0]
+        return self.stats
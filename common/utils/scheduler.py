@@ -0,0 +1,160 @@
+'''
+Run independent tasks (e.g. the extraction steps of many scenes) concurrently in threads,
+with a concurrency limit per task type and a global CPU budget shared by all tasks.
+Tasks are expected to spend their time in subprocesses or in code that releases the GIL
+'''
+
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class TaskResult:
+    def __init__(self, group, task_type, wall_time, error=None):
+        self.group = group
+        self.task_type = task_type
+        self.wall_time = wall_time
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class CPUBudget:
+    """Counting budget of CPU slots, a task acquires as many slots as it uses."""
+
+    def __init__(self, num_slots):
+        self.num_slots = max(int(num_slots), 1)
+        self._available = self.num_slots
+        self._cond = threading.Condition()
+
+    def acquire(self, cost):
+        # a task larger than the budget runs alone
+        cost = min(max(int(cost), 1), self.num_slots)
+        with self._cond:
+            self._cond.wait_for(lambda: self._available >= cost)
+            self._available -= cost
+        return cost
+
+    def release(self, cost):
+        with self._cond:
+            self._available += cost
+            self._cond.notify_all()
+
+
+class TaskScheduler:
+    """Run tasks concurrently under per-type limits and a global CPU budget.
+
+    Args:
+        type_limits: Dict with the maximum number of concurrent tasks of each type,
+            types without a limit run one at a time.
+        cpu_budget: Total number of CPU slots shared by all running tasks.
+        type_costs: Dict with the number of CPU slots a task of each type uses (default 1).
+    """
+
+    def __init__(self, type_limits=None, cpu_budget=1, type_costs=None):
+        self.type_limits = dict(type_limits or {})
+        self.type_costs = dict(type_costs or {})
+        self.budget = CPUBudget(cpu_budget)
+        self._tasks = []
+
+    def add(self, group, task_type, fn, *args, **kwargs):
+        """Add a task fn(*args, **kwargs).
+
+        Args:
+            group: Tasks are grouped for the summary, e.g. by scene id.
+            task_type: Type of the task for the limits and costs, e.g. "rgb".
+        """
+        self._tasks.append((group, task_type, fn, args, kwargs))
+
+    def __len__(self):
+        """Number of added tasks that were not run yet."""
+        return len(self._tasks)
+
+    def _run_task(self, group, task_type, fn, args, kwargs):
+        # the task was dispatched with a free slot of its type, only the budget is
+        # acquired here, so waiting tasks of a saturated type never hold budget slots
+        cost = self.budget.acquire(self.type_costs.get(task_type, 1))
+        start = time.perf_counter()
+        try:
+            fn(*args, **kwargs)
+            error = None
+        except (Exception, SystemExit) as e:
+            # sys.exit of a failed command is collected like any other failure
+            error = e
+            traceback.print_exc()
+        finally:
+            self.budget.release(cost)
+        return TaskResult(group, task_type, time.perf_counter() - start, error)
+
+    def run(self, progress=None):
+        """Run all added tasks.
+
+        Args:
+            progress: Optional callback progress(result) called after each task.
+        Returns:
+            List of TaskResult in the order the tasks were added.
+        """
+        tasks, self._tasks = self._tasks, []
+        if len(tasks) == 0:
+            return []
+        # one queue of task indices per type, a task is only submitted when its type
+        # has a free slot, so no pool thread waits for a slot of a saturated type
+        queues = {}
+        for idx, task in enumerate(tasks):
+            queues.setdefault(task[1], deque()).append(idx)
+        limits = {task_type: max(self.type_limits.get(task_type, 1), 1) for task_type in queues}
+        running = dict.fromkeys(queues, 0)
+        results = [None] * len(tasks)
+        futures = {}
+
+        with ThreadPoolExecutor(max_workers=sum(limits.values())) as executor:
+            def dispatch():
+                while True:
+                    ready = [t for t in queues if len(queues[t]) > 0 and running[t] < limits[t]]
+                    if len(ready) == 0:
+                        return
+                    # the earliest added task among the types with a free slot
+                    task_type = min(ready, key=lambda t: queues[t][0])
+                    idx = queues[task_type].popleft()
+                    running[task_type] += 1
+                    futures[executor.submit(self._run_task, *tasks[idx])] = idx
+
+            dispatch()
+            while len(futures) > 0:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results[futures.pop(future)] = result
+                    running[result.task_type] -= 1
+                    if progress is not None:
+                        progress(result)
+                dispatch()
+        return results
+
+
+def format_summary(results, wall_time=None):
+    """Per task type wall times and the failures per group."""
+    lines = []
+    if wall_time is not None:
+        lines.append(f"total wall time: {wall_time:.1f}s")
+    task_types = list(dict.fromkeys(r.task_type for r in results))
+    for task_type in task_types:
+        times = [r.wall_time for r in results if r.task_type == task_type]
+        num_failed = sum(1 for r in results if r.task_type == task_type and not r.ok)
+        lines.append(
+            f"  {task_type:<8} {len(times)} tasks, total {sum(times):.1f}s, "
+            f"mean {sum(times) / len(times):.1f}s, max {max(times):.1f}s, {num_failed} failed"
+        )
+    failures = {}
+    for r in results:
+        if not r.ok:
+            failures.setdefault(r.group, []).append(f"{r.task_type}: {r.error!r}")
+    if len(failures) > 0:
+        lines.append(f"failed: {len(failures)} groups")
+        for group, errors in failures.items():
+            lines.append(f"  {group}: " + "; ".join(errors))
+    return "\n".join(lines)
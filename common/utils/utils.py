@@ -26,12 +26,15 @@ def load_yaml_munch(path):
     return Munch.fromDict(y)
 
 
-def run_command(cmd: str, verbose=False, exit_on_error=True):
+def run_command(cmd: str, verbose=False, exit_on_error=True, raise_on_error=False):
     """Runs a command and returns the output.
 
     Args:
         cmd: Command to run.
         verbose: If True, logs the output of the command.
+        exit_on_error: If True, exits the program if the command fails.
+        raise_on_error: If True, raises subprocess.CalledProcessError if the command fails,
+            takes precedence over exit_on_error.
     Returns:
         The output of the command if return_output is True, otherwise None.
     """
@@ -39,6 +42,8 @@ def run_command(cmd: str, verbose=False, exit_on_error=True):
     if out.returncode != 0:
         if out.stderr is not None:
             print(out.stderr.decode("utf-8"))
+        if raise_on_error:
+            raise subprocess.CalledProcessError(out.returncode, cmd, out.stdout, out.stderr)
         if exit_on_error:
             sys.exit(1)
     if out.stdout is not None:
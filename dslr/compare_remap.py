@@ -0,0 +1,116 @@
+'''
+Compare the fixed-point remap mode of dslr.undistort against the float remap
+mode (benchmark ground-truth) and report the pixel deviations
+'''
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+from common.utils.utils import load_yaml_munch, read_txt_list
+from dslr.undistort import (
+    compute_undistort_maps,
+    prepare_scene_job,
+    undistort_image,
+    undistort_mask,
+)
+
+
+def compare_scene(job, max_frames=None):
+    """Undistort the frames of a scene with both remap modes in memory.
+    args:
+        job: Scene job as returned by dslr.undistort.prepare_scene_job.
+        max_frames: Only compare the first max_frames frames if given.
+    returns:
+        Dict with the max and mean absolute image deviation (in 0-255 intensity levels)
+        and the fraction of mask pixels with a different validity.
+    """
+    height, width = job["height"], job["width"]
+    maps = {}
+    for remap_mode in ("float", "fixed"):
+        _, map1, map2 = compute_undistort_maps(
+            job["K"], height, width, job["distortion_params"], remap_mode=remap_mode
+        )
+        maps[remap_mode] = (map1, map2)
+
+    frames = job["frames"]
+    if max_frames is not None:
+        frames = frames[:max_frames]
+
+    max_diff = 0
+    sum_diff = 0.0
+    num_values = 0
+    num_mask_mismatch = 0
+    num_mask_pixels = 0
+    for frame in tqdm(frames, desc="frame", leave=False):
+        image = cv2.imread(str(Path(job["input_image_dir"]) / frame["file_path"]))
+        image_float = undistort_image(image, *maps["float"]).astype(np.int16)
+        image_fixed = undistort_image(image, *maps["fixed"]).astype(np.int16)
+        diff = np.abs(image_float - image_fixed)
+        max_diff = max(max_diff, int(diff.max()))
+        sum_diff += float(diff.sum())
+        num_values += diff.size
+
+        mask = cv2.imread(str(Path(job["input_mask_dir"]) / frame["mask_path"]), cv2.IMREAD_GRAYSCALE)
+        mask_float = undistort_mask(mask, *maps["float"], height, width)
+        mask_fixed = undistort_mask(mask, *maps["fixed"], height, width)
+        num_mask_mismatch += int(np.count_nonzero(mask_float != mask_fixed))
+        num_mask_pixels += mask_float.size
+
+    return {
+        "num_frames": len(frames),
+        "max_abs_diff": max_diff,
+        "sum_abs_diff": sum_diff,
+        "num_values": num_values,
+        "num_mask_mismatch": num_mask_mismatch,
+        "num_mask_pixels": num_mask_pixels,
+    }
+
+
+def main(args):
+    cfg = load_yaml_munch(args.config_file)
+
+    # get the scenes to process
+    if cfg.get("scene_ids"):
+        scene_ids = cfg.scene_ids
+    elif cfg.get("splits"):
+        scene_ids = []
+        for split in cfg.splits:
+            split_path = Path(cfg.data_root) / "splits" / f"{split}.txt"
+            scene_ids += read_txt_list(split_path)
+
+    max_diff = 0
+    sum_diff = 0.0
+    num_values = 0
+    num_mask_mismatch = 0
+    num_mask_pixels = 0
+    for scene_id in tqdm(scene_ids, desc="scene"):
+        job = prepare_scene_job(cfg, scene_id)
+        result = compare_scene(job, max_frames=args.max_frames)
+        print(
+            f"{scene_id}: frames={result['num_frames']}"
+            f" image max abs diff={result['max_abs_diff']}"
+            f" mean abs diff={result['sum_abs_diff'] / max(result['num_values'], 1):.4f}"
+            f" mask mismatch={result['num_mask_mismatch'] / max(result['num_mask_pixels'], 1):.6f}"
+        )
+        max_diff = max(max_diff, result["max_abs_diff"])
+        sum_diff += result["sum_abs_diff"]
+        num_values += result["num_values"]
+        num_mask_mismatch += result["num_mask_mismatch"]
+        num_mask_pixels += result["num_mask_pixels"]
+
+    print(f"Overall image max abs diff: {max_diff}")
+    print(f"Overall image mean abs diff: {sum_diff / max(num_values, 1):.4f}")
+    print(f"Overall mask mismatch: {num_mask_mismatch / max(num_mask_pixels, 1):.6f}")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("config_file", help="Path to the undistortion config file")
+    p.add_argument("--max_frames", type=int, default=None, help="Number of frames to compare per scene")
+    args = p.parse_args()
+
+    main(args)
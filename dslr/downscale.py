@@ -8,24 +8,164 @@ import cv2
 from tqdm import tqdm
 
 from common.scene_release import ScannetppScene_Release
+from common.utils.pipeline import FramePipeline
+from common.utils.colmap import compute_resize_intrinsic
 from common.utils.utils import load_yaml_munch, load_json, read_txt_list
+from dslr.manifest import SceneManifest, atomic_imwrite, atomic_write_json, config_hash
+from dslr.mask_index import load_mask_index
 
 
-def compute_resize_intrinsic(K, height, width, scale_factor):
-    fx = K[0, 0]
-    fy = K[1, 1]
-    cx = K[0, 2]
-    cy = K[1, 2]
-    new_K = np.array(
-        [
-            [fx * scale_factor, 0, cx * scale_factor],
-            [0, fy * scale_factor, cy * scale_factor],
-            [0, 0, 1],
-        ]
+def resize_image(image, new_width, new_height):
+    return cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_CUBIC)
+
+
+def resize_mask(mask, new_width, new_height):
+    resized_mask = cv2.resize(
+        mask, (new_width, new_height), interpolation=cv2.INTER_CUBIC
     )
-    new_height = int(height * scale_factor)
-    new_width = int(width * scale_factor)
-    return new_K, new_height, new_width
+    # Filter the mask valid: 255, invalid: 0
+    resized_mask[resized_mask < 255] = 0
+    return resized_mask
+
+
+def format_factor(factor):
+    '''
+    2.0 -> "2", 1.5 -> "1.5"
+    '''
+    factor = float(factor)
+    if factor.is_integer():
+        return str(int(factor))
+    return str(factor)
+
+
+def build_pyramid(image, downscale_factors, is_mask=False):
+    """Resize an image to several downscale factors from a single decode.
+
+    The smallest factor is resized from the input with INTER_CUBIC, exactly as for a
+    single downscale factor. Each following level whose factor is an integer multiple
+    of a previous one is derived from the closest such level with INTER_AREA. The other
+    levels are resized from the input with INTER_CUBIC.
+    args:
+        image: Input image or mask.
+        downscale_factors: Factors sorted in increasing order.
+        is_mask: Threshold the resized masks, valid: 255, invalid: 0.
+    returns:
+        List of resized images, one for each factor.
+    """
+    height, width = image.shape[:2]
+    levels = []
+    for level_idx, downscale_factor in enumerate(downscale_factors):
+        _, new_height, new_width = compute_resize_intrinsic(
+            np.eye(3), height, width, 1 / downscale_factor
+        )
+        # closest previous level that can be area-averaged into this one
+        source = None
+        for prev_idx in reversed(range(level_idx)):
+            ratio = downscale_factor / downscale_factors[prev_idx]
+            if ratio >= 2 and float(ratio).is_integer():
+                source = levels[prev_idx]
+                break
+
+        if source is not None:
+            resized = cv2.resize(
+                source, (new_width, new_height), interpolation=cv2.INTER_AREA
+            )
+            if is_mask:
+                # Any area containing an invalid pixel becomes invalid
+                resized[resized < 255] = 0
+        elif is_mask:
+            resized = resize_mask(image, new_width, new_height)
+        else:
+            resized = resize_image(image, new_width, new_height)
+        levels.append(resized)
+    return levels
+
+
+def downscale_frames_pyramid(
+    frames,
+    K,
+    height,
+    width,
+    downscale_factors,
+    input_image_dir,
+    input_mask_dir,
+    out_image_dirs,
+    out_mask_dirs,
+    manifest=None,
+    pipeline_args=None,
+    report_stats=False,
+    mask_index=None,
+):
+    """Downscale frames to several factors in one pass, see build_pyramid.
+    Reading, resizing and writing of the frames overlap in a FramePipeline.
+    args:
+        downscale_factors: Factors sorted in increasing order.
+        out_image_dirs, out_mask_dirs: Output dirs for each factor.
+        manifest: Optional SceneManifest, frames recorded as done are skipped.
+        mask_index: Optional MaskIndex of input_mask_dir, masks that are entirely valid
+            are not decoded.
+        pipeline_args: Optional dict with num_readers, num_writers and queue_size of the pipeline.
+        report_stats: Print the per-stage timings of the pipeline.
+    returns:
+        List of (new_K, new_height, new_width) for each factor.
+    """
+    assert list(downscale_factors) == sorted(downscale_factors)
+    outputs = [
+        compute_resize_intrinsic(K, height, width, 1 / downscale_factor)
+        for downscale_factor in downscale_factors
+    ]
+
+    def io_paths(frame):
+        input_paths = [Path(input_image_dir) / frame["file_path"], Path(input_mask_dir) / frame["mask_path"]]
+        out_image_paths = [Path(d) / frame["file_path"] for d in out_image_dirs]
+        out_mask_paths = [Path(d) / frame["mask_path"] for d in out_mask_dirs]
+        return input_paths, out_image_paths + out_mask_paths
+
+    def is_full_mask(frame):
+        # entirely 255, the resized masks are 255 as well
+        if mask_index is None:
+            return False
+        mask_info = mask_index.get(frame["mask_path"])
+        return mask_info is not None and mask_info["bbox"] is None
+
+    def read(frame):
+        (image_path, mask_path), _ = io_paths(frame)
+        image = cv2.imread(str(image_path))
+        mask = None
+        if not is_full_mask(frame):
+            mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+        return image, mask
+
+    def compute(frame, data):
+        image, mask = data
+        if mask is None:
+            resized_masks = [
+                np.zeros((new_height, new_width), dtype=np.uint8) + 255
+                for _, new_height, new_width in outputs
+            ]
+        else:
+            resized_masks = build_pyramid(mask, downscale_factors, is_mask=True)
+        # images of all factors followed by masks of all factors, as in io_paths
+        return build_pyramid(image, downscale_factors) + resized_masks
+
+    def write(frame, resized):
+        _, output_paths = io_paths(frame)
+        for out_path, image in zip(output_paths, resized):
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_imwrite(out_path, image)
+
+    def on_done(frame):
+        if manifest is not None:
+            manifest.mark_frame_done(frame["file_path"], *io_paths(frame))
+
+    if manifest is not None:
+        frames = [frame for frame in frames if not manifest.is_frame_done(frame["file_path"], *io_paths(frame))]
+
+    pipeline = FramePipeline(read, compute, write, **(pipeline_args or {}))
+    stats = pipeline.run(frames, on_done=on_done, desc="frame")
+    if report_stats:
+        print(stats.summary())
+    return outputs
 
 
 def downscale_frames(
@@ -39,32 +179,17 @@ def downscale_frames(
     out_image_dir,
     out_mask_dir,
 ):
-    scale_factor = 1 / downscale_factor
-    new_K, new_height, new_width = compute_resize_intrinsic(
-        K, height, width, scale_factor
-    )
-
-    for frame in tqdm(frames, desc="frame"):
-        image_path = Path(input_image_dir) / frame["file_path"]
-        image = cv2.imread(str(image_path))
-        resized_image = cv2.resize(
-            image, (new_width, new_height), interpolation=cv2.INTER_CUBIC
-        )
-        out_image_path = Path(out_image_dir) / frame["file_path"]
-        out_image_path.parent.mkdir(parents=True, exist_ok=True)
-        cv2.imwrite(str(out_image_path), resized_image)
-
-        mask_path = Path(input_mask_dir) / frame["mask_path"]
-        mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
-        resized_mask = cv2.resize(
-            mask, (new_width, new_height), interpolation=cv2.INTER_CUBIC
-        )
-        # Filter the mask valid: 255, invalid: 0
-        resized_mask[resized_mask < 255] = 0
-        out_mask_path = Path(out_mask_dir) / frame["mask_path"]
-        out_mask_path.parent.mkdir(parents=True, exist_ok=True)
-        cv2.imwrite(str(out_mask_path), resized_mask)
-    return new_K, new_height, new_width
+    return downscale_frames_pyramid(
+        frames,
+        K,
+        height,
+        width,
+        [downscale_factor],
+        input_image_dir,
+        input_mask_dir,
+        [out_image_dir],
+        [out_mask_dir],
+    )[0]
 
 
 def update_transforms_json(transforms, new_K, new_height, new_width):
@@ -91,6 +216,15 @@ def main(args):
             scene_ids += read_txt_list(split_path)
 
     # get the options to process
+    if cfg.get("downscale_factors"):
+        downscale_factors = sorted(float(f) for f in cfg.downscale_factors)
+    else:
+        downscale_factors = [float(cfg.get("downscale_factor", 2))]
+    if len(downscale_factors) > 1:
+        for key in ("out_image_dir", "out_mask_dir", "out_transforms_path"):
+            assert "{factor}" in cfg[key], f"{key} must contain {{factor}} for multiple downscale factors"
+    factor_strs = [format_factor(f) for f in downscale_factors]
+
     # go through each scene
     for scene_id in tqdm(scene_ids, desc="scene"):
         scene = ScannetppScene_Release(scene_id, data_root=Path(cfg.data_root) / "data")
@@ -112,9 +246,11 @@ def main(args):
         else:
             input_transforms_path = scene.dslr_dir / input_transforms_path
 
-        out_image_dir = scene.dslr_dir / cfg.out_image_dir
-        out_mask_dir = scene.dslr_dir / cfg.out_mask_dir
-        out_transforms_path = scene.dslr_dir / cfg.out_transforms_path
+        out_image_dirs = [scene.dslr_dir / cfg.out_image_dir.format(factor=f) for f in factor_strs]
+        out_mask_dirs = [scene.dslr_dir / cfg.out_mask_dir.format(factor=f) for f in factor_strs]
+        out_transforms_paths = [
+            scene.dslr_dir / cfg.out_transforms_path.format(factor=f) for f in factor_strs
+        ]
 
         transforms = load_json(input_transforms_path)
         assert len(transforms["frames"]) > 0
@@ -143,22 +279,48 @@ def main(args):
                 [0, 0, 1],
             ]
         )
-        downscale_factor = float(cfg.get("downscale_factor", 2))
-        new_K, new_height, new_width = downscale_frames(
+        manifest = None
+        if cfg.get("incremental", False):
+            params = {
+                "script": "downscale",
+                "downscale_factors": downscale_factors,
+                "out_image_dirs": out_image_dirs,
+                "out_mask_dirs": out_mask_dirs,
+            }
+            manifest = SceneManifest(
+                out_transforms_paths[0].with_suffix(".manifest.json"),
+                config_hash(params),
+                use_hash=cfg.get("incremental_hash", False),
+            )
+            if manifest.is_scene_done([input_transforms_path], out_transforms_paths):
+                print(f"{scene_id} is up to date, skipping")
+                continue
+
+        outputs = downscale_frames_pyramid(
             frames,
             K,
             height,
             width,
-            downscale_factor,
+            downscale_factors,
             input_image_dir,
             input_mask_dir,
-            out_image_dir,
-            out_mask_dir,
+            out_image_dirs,
+            out_mask_dirs,
+            manifest=manifest,
+            pipeline_args={
+                "num_readers": cfg.get("io_readers", 2),
+                "num_writers": cfg.get("io_writers", 2),
+                "queue_size": cfg.get("io_queue_size", 8),
+            },
+            report_stats=cfg.get("report_pipeline_stats", False),
+            mask_index=load_mask_index(input_mask_dir, frames) if cfg.get("use_mask_index", False) else None,
         )
-        new_trasforms = update_transforms_json(transforms, new_K, new_height, new_width)
-        out_transforms_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(out_transforms_path, "w") as f:
-            json.dump(new_trasforms, f, indent=4)
+        for (new_K, new_height, new_width), out_transforms_path in zip(outputs, out_transforms_paths):
+            new_trasforms = update_transforms_json(transforms, new_K, new_height, new_width)
+            out_transforms_path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_json(out_transforms_path, new_trasforms)
+        if manifest is not None:
+            manifest.mark_scene_done([input_transforms_path], out_transforms_paths)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+'''
+Incremental processing for the DSLR preprocessing scripts: atomic writes and a
+per-scene manifest of the produced outputs
+'''
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import cv2
+
+
+def _tmp_path(path):
+    # keep the suffix, cv2.imwrite picks the encoder from it
+    path = Path(path)
+    return path.parent / f".{path.stem}.tmp{os.getpid()}{path.suffix}"
+
+
+def atomic_imwrite(path, image):
+    '''
+    write an image to a temp file and rename it, so that a crash never leaves
+    a truncated image at path
+    '''
+    path = Path(path)
+    tmp_path = _tmp_path(path)
+    if not cv2.imwrite(str(tmp_path), image):
+        raise IOError(f"Failed to write image: {path}")
+    os.replace(tmp_path, path)
+
+
+def atomic_write_json(path, data, indent=4):
+    path = Path(path)
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=indent)
+    os.replace(tmp_path, path)
+
+
+def file_signature(path, use_hash=False):
+    '''
+    size and modification time of a file, plus the sha1 of its content if use_hash
+    '''
+    stat = os.stat(path)
+    signature = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if use_hash:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        signature["sha1"] = h.hexdigest()
+    return signature
+
+
+def config_hash(config):
+    '''
+    hash of the JSON-serializable parameters that determine the outputs
+    '''
+    data = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class SceneManifest:
+    """Record of the frames a preprocessing script produced for a scene.
+
+    A frame is done if it was recorded with the same config hash, its inputs still
+    have the recorded signatures and all its outputs exist. The manifest is saved
+    atomically every save_every recorded frames, so an interrupted run resumes at
+    the first frame that was not recorded.
+    """
+
+    def __init__(self, path, config_hash, use_hash=False, save_every=50):
+        self.path = Path(path)
+        self.config_hash = config_hash
+        self.use_hash = use_hash
+        self.save_every = save_every
+        self._num_unsaved = 0
+
+        self.frames = {}
+        self.scene = None
+        if self.path.is_file():
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except ValueError:
+                data = {}
+            # outputs of a different config are not reused
+            if data.get("config_hash") == config_hash:
+                self.frames = data.get("frames", {})
+                self.scene = data.get("scene")
+
+    def _signatures(self, input_paths):
+        return {str(p): file_signature(p, self.use_hash) for p in input_paths}
+
+    def is_frame_done(self, key, input_paths, output_paths):
+        record = self.frames.get(key)
+        if record is None:
+            return False
+        if sorted(record["outputs"]) != sorted(str(p) for p in output_paths):
+            return False
+        if not all(Path(p).is_file() for p in output_paths):
+            return False
+        try:
+            return record["inputs"] == self._signatures(input_paths)
+        except OSError:
+            return False
+
+    def mark_frame_done(self, key, input_paths, output_paths):
+        self.frames[key] = {
+            "inputs": self._signatures(input_paths),
+            "outputs": [str(p) for p in output_paths],
+        }
+        self._num_unsaved += 1
+        if self._num_unsaved >= self.save_every:
+            self.save()
+
+    def is_scene_done(self, input_paths, output_paths):
+        '''
+        True if the whole scene was finished with the same inputs and outputs, and
+        all recorded frames are still done: their inputs (e.g. images and masks) have
+        the recorded signatures and their outputs exist
+        '''
+        if self.scene is None:
+            return False
+        if not all(Path(p).exists() for p in output_paths):
+            return False
+        for record in self.frames.values():
+            if not all(Path(p).is_file() for p in record["outputs"]):
+                return False
+        try:
+            if self.scene != {
+                "inputs": self._signatures(input_paths),
+                "outputs": [str(p) for p in output_paths],
+            }:
+                return False
+            return all(
+                record["inputs"] == self._signatures(record["inputs"]) for record in self.frames.values()
+            )
+        except OSError:
+            return False
+
+    def mark_scene_done(self, input_paths, output_paths):
+        # frames whose inputs were removed are no longer part of the scene
+        self.frames = {
+            key: record for key, record in self.frames.items()
+            if all(Path(p).is_file() for p in record["inputs"])
+        }
+        self.scene = {
+            "inputs": self._signatures(input_paths),
+            "outputs": [str(p) for p in output_paths],
+        }
+        self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_json(
+            self.path,
+            {"config_hash": self.config_hash, "scene": self.scene, "frames": self.frames},
+            indent=None,
+        )
+        self._num_unsaved = 0
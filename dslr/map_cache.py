@@ -0,0 +1,112 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+
+class RectifyMapCache:
+    """On-disk cache of undistortion (rectification) maps.
+
+    Entries are addressed by a hash of the camera intrinsics, distortion
+    parameters, image size, map type and output scale. Each entry is
+    a directory with the new intrinsic matrix and the two remap maps stored as
+    .npy files, which are memory-mapped when loaded. The least recently used entries are
+    evicted when the total size exceeds max_size_gb, None for no limit.
+    """
+
+    MAP_FILES = ("new_K.npy", "map1.npy", "map2.npy")
+
+    def __init__(self, cache_dir, max_size_gb=4.0):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = None if max_size_gb is None else int(max_size_gb * 1024**3)
+
+    @staticmethod
+    def make_key(
+        K, height, width, distortion_params, map_type="CV_32FC1", scale=1.0
+    ):
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(K, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(distortion_params, dtype=np.float64).tobytes())
+        h.update(f"{int(height)}_{int(width)}_{map_type}".encode("utf-8"))
+        if scale != 1.0:
+            # Maps that also resize the output
+            h.update(f"_scale{float(scale)!r}".encode("utf-8"))
+        return h.hexdigest()
+
+    def entry_dir(self, key):
+        return self.cache_dir / key
+
+    def get(self, key):
+        """Load an entry as (new_K, map1, map2) with memory-mapped maps, None if not cached."""
+        entry_dir = self.entry_dir(key)
+        if not all((entry_dir / fname).is_file() for fname in self.MAP_FILES):
+            return None
+        try:
+            new_K = np.load(entry_dir / "new_K.npy")
+            map1 = np.load(entry_dir / "map1.npy", mmap_mode="r")
+            map2 = np.load(entry_dir / "map2.npy", mmap_mode="r")
+        except (OSError, ValueError):
+            # The entry was evicted or is corrupted
+            return None
+        # Mark as recently used
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            pass
+        return new_K, map1, map2
+
+    def put(self, key, new_K, map1, map2):
+        entry_dir = self.entry_dir(key)
+        # Write into a temporary dir and rename it, so that concurrent readers
+        # never see a partially written entry
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f".{key}.", dir=self.cache_dir))
+        np.save(tmp_dir / "new_K.npy", np.asarray(new_K))
+        np.save(tmp_dir / "map1.npy", np.asarray(map1))
+        np.save(tmp_dir / "map2.npy", np.asarray(map2))
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process already created the entry
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def get_or_compute(self, key, compute_fn):
+        """Return the cached entry for key, computing and storing it with compute_fn if missing."""
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        self.put(key, *compute_fn())
+        entry = self.get(key)
+        if entry is None:
+            # The entry was evicted right away (e.g. larger than the cache)
+            entry = compute_fn()
+        return entry
+
+    def entries(self):
+        """List (mtime, size, path) of all cache entries."""
+        entries = []
+        for entry_dir in self.cache_dir.iterdir():
+            if entry_dir.name.startswith(".") or not entry_dir.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry_dir.iterdir())
+                entries.append((entry_dir.stat().st_mtime, size, entry_dir))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits into max_size_gb."""
+        if self.max_size_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,173 @@
+'''
+Per-scene index of the anonymization masks. Most masks are entirely valid (255),
+the index records this and the bounding box of the invalid pixels of each mask,
+so that the DSLR scripts can skip decoding trivial masks and only remap the
+region around the invalid pixels
+'''
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from dslr.manifest import atomic_write_json, file_signature
+
+
+def mask_index_path(mask_dir):
+    '''
+    resized_anon_masks -> resized_anon_masks_index.json in the same dir
+    '''
+    mask_dir = Path(mask_dir)
+    return mask_dir.parent / f"{mask_dir.name}_index.json"
+
+
+def compute_mask_info(mask):
+    '''
+    all_valid: the mask has no invalid (0) pixel
+    bbox: [x0, y0, x1, y1] (exclusive) of the pixels below 255, None if the mask is entirely 255
+    '''
+    not_full = mask < 255
+    rows = np.flatnonzero(not_full.any(axis=1))
+    if len(rows) == 0:
+        return {"all_valid": True, "bbox": None}
+    cols = np.flatnonzero(not_full.any(axis=0))
+    bbox = [int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1]
+    return {"all_valid": bool(np.all(mask > 0)), "bbox": bbox}
+
+
+class MaskIndex:
+    """Mask info of all masks of a scene, see compute_mask_info.
+
+    The index is stored as JSON next to the mask dir. Each entry keeps the size and
+    modification time of its mask, entries of masks that changed are recomputed.
+    """
+
+    def __init__(self, mask_dir, index_path=None):
+        self.mask_dir = Path(mask_dir)
+        self.path = Path(index_path) if index_path is not None else mask_index_path(mask_dir)
+        self.entries = {}
+        if self.path.is_file():
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+
+    def _is_valid(self, mask_path):
+        entry = self.entries.get(mask_path)
+        if entry is None:
+            return False
+        try:
+            return entry["signature"] == file_signature(self.mask_dir / mask_path)
+        except OSError:
+            return False
+
+    def _index_mask(self, mask_path):
+        full_path = self.mask_dir / mask_path
+        signature = file_signature(full_path)
+        mask = cv2.imread(str(full_path), cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise IOError(f"Failed to read mask: {full_path}")
+        return {"signature": signature, **compute_mask_info(mask)}
+
+    def update(self, mask_paths, num_threads=8):
+        """Index the given masks (relative to mask_dir) that are missing or outdated.
+        returns:
+            Number of masks that were decoded.
+        """
+        todo = [p for p in dict.fromkeys(mask_paths) if not self._is_valid(p)]
+        if len(todo) == 0:
+            return 0
+        # cv2 releases the GIL while decoding
+        with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+            for mask_path, entry in zip(todo, executor.map(self._index_mask, todo)):
+                self.entries[mask_path] = entry
+        self.save()
+        return len(todo)
+
+    def get(self, mask_path):
+        """Mask info of a mask, None if it is not indexed."""
+        entry = self.entries.get(mask_path)
+        if entry is None:
+            return None
+        return {"all_valid": entry["all_valid"], "bbox": entry["bbox"]}
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_json(self.path, self.entries, indent=None)
+
+
+def load_mask_index(mask_dir, frames, num_threads=8):
+    """Load the index of a mask dir and bring it up to date for the masks of the frames."""
+    index = MaskIndex(mask_dir)
+    num_indexed = index.update([frame["mask_path"] for frame in frames], num_threads=num_threads)
+    if num_indexed > 0:
+        print(f"Indexed {num_indexed} masks in {mask_dir}")
+    return index
+
+
+def compute_map_tile_bounds(map1, map2, tile_size=32):
+    """Range of the source coordinates of each tile of rectification maps.
+    args:
+        map1, map2: Float (CV_32FC1) or fixed-point (CV_16SC2) maps.
+    returns:
+        Array (num tile rows, num tile cols, 4) with min x, max x, min y, max y of each tile.
+    """
+    map1 = np.asarray(map1)
+    if map1.ndim == 3:
+        # fixed-point: integer part in map1, the fractional part adds less than 1
+        map_x = map1[..., 0].astype(np.float32)
+        map_y = map1[..., 1].astype(np.float32)
+        frac = 1.0
+    else:
+        map_x = np.asarray(map1)
+        map_y = np.asarray(map2)
+        frac = 0.0
+    height, width = map_x.shape
+    row_starts = np.arange(0, height, tile_size)
+    col_starts = np.arange(0, width, tile_size)
+
+    def reduce(op, m):
+        return op.reduceat(op.reduceat(m, row_starts, axis=0), col_starts, axis=1)
+
+    return np.stack(
+        [
+            reduce(np.minimum, map_x),
+            reduce(np.maximum, map_x) + frac,
+            reduce(np.minimum, map_y),
+            reduce(np.maximum, map_y) + frac,
+        ],
+        axis=-1,
+    )
+
+
+def mask_remap_region(tile_bounds, bbox, height, width, tile_size=32, margin=2):
+    """Output region of a remap that can be affected by the pixels in bbox.
+    Output pixels outside the region only sample source pixels farther than margin from
+    bbox, i.e. valid pixels or the (valid) border.
+    args:
+        tile_bounds: See compute_map_tile_bounds.
+        bbox: [x0, y0, x1, y1] of the invalid source pixels.
+        height, width: Output size.
+    returns:
+        (row0, row1, col0, col1) of the output region, None if no output pixel is affected.
+    """
+    x0, y0, x1, y1 = bbox
+    hit = (
+        (tile_bounds[..., 1] >= x0 - margin)
+        & (tile_bounds[..., 0] <= x1 - 1 + margin)
+        & (tile_bounds[..., 3] >= y0 - margin)
+        & (tile_bounds[..., 2] <= y1 - 1 + margin)
+    )
+    rows = np.flatnonzero(hit.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(hit.any(axis=0))
+    return (
+        int(rows[0]) * tile_size,
+        min((int(rows[-1]) + 1) * tile_size, height),
+        int(cols[0]) * tile_size,
+        min((int(cols[-1]) + 1) * tile_size, width),
+    )
@@ -2,15 +2,25 @@ import argparse
 import os
 import tempfile
 from pathlib import Path
-import json
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import cv2
 from tqdm import tqdm
 
 from common.scene_release import ScannetppScene_Release
+from common.utils.pipeline import FramePipeline
+from common.utils.colmap import compute_resize_intrinsic
 from common.utils.utils import load_yaml_munch, load_json, read_txt_list
+from dslr.downscale import resize_image, resize_mask
+from dslr.manifest import SceneManifest, atomic_imwrite, atomic_write_json, config_hash
+from dslr.map_cache import RectifyMapCache
+from dslr.mask_index import (
+    compute_map_tile_bounds,
+    load_mask_index,
+    mask_remap_region,
+)
 
 
 def compute_undistort_intrinsic(K, height, width, distortion_params):
@@ -30,6 +40,245 @@ def compute_undistort_intrinsic(K, height, width, distortion_params):
     return new_K
 
 
+# Map types used by cv2.remap for each remap mode. "float" is the official
+# benchmark path, "fixed" uses OpenCV's packed fixed-point maps which halve
+# the memory traffic of the remap at the cost of small interpolation errors.
+REMAP_MODES = {
+    "float": "CV_32FC1",
+    "fixed": "CV_16SC2",
+}
+
+
+def compute_undistort_maps(
+    K, height, width, distortion_params, map_cache=None, remap_mode="float", scale=1.0
+):
+    """Compute the undistorted intrinsic and the rectification maps.
+    args:
+        map_cache: Optional RectifyMapCache. Cached maps are memory-mapped instead of recomputed.
+        remap_mode: "float" for CV_32FC1 maps, "fixed" for fixed-point CV_16SC2 maps.
+        scale: Resolution scale of the output. The maps then combine the undistortion with
+            the resizing, and the returned intrinsic is the one of the resized image.
+    """
+    if remap_mode not in REMAP_MODES:
+        raise ValueError(f"Unknown remap mode: {remap_mode}, expected one of {list(REMAP_MODES)}")
+
+    def compute():
+        new_K = compute_undistort_intrinsic(K, height, width, distortion_params)
+        new_K, new_height, new_width = compute_resize_intrinsic(new_K, height, width, scale)
+        map1, map2 = cv2.fisheye.initUndistortRectifyMap(
+            K, distortion_params, np.eye(3), new_K, (new_width, new_height), cv2.CV_32FC1
+        )
+        if remap_mode == "fixed":
+            map1, map2 = cv2.convertMaps(map1, map2, cv2.CV_16SC2)
+        return new_K, map1, map2
+
+    if map_cache is None:
+        return compute()
+    key = RectifyMapCache.make_key(
+        K, height, width, distortion_params, map_type=REMAP_MODES[remap_mode], scale=scale
+    )
+    return map_cache.get_or_compute(key, compute)
+
+
+def undistort_image(image, map1, map2):
+    return cv2.remap(
+        image,
+        map1,
+        map2,
+        interpolation=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_REFLECT_101,
+    )
+
+
+def undistort_mask(mask, map1, map2, height, width, mask_info=None, tile_bounds=None):
+    """Undistort an anonymization mask, valid: 255, invalid: 0.
+    args:
+        mask: Decoded mask, may be None if mask_info says it is all valid.
+        mask_info: Optional entry of the MaskIndex of the mask.
+        tile_bounds: Optional compute_map_tile_bounds of the maps. With mask_info, only
+            the output region around the invalid pixels is remapped.
+    """
+    all_valid = mask_info["all_valid"] if mask_info is not None else np.all(mask > 0)
+    if all_valid:
+        # No invalid pixels. Just use empty mask
+        return np.zeros((height, width), dtype=np.uint8) + 255
+    if mask_info is not None and tile_bounds is not None:
+        region = mask_remap_region(tile_bounds, mask_info["bbox"], height, width)
+        undistorted_mask = np.zeros((height, width), dtype=np.uint8) + 255
+        if region is None:
+            return undistorted_mask
+        row0, row1, col0, col1 = region
+        undistorted_mask[row0:row1, col0:col1] = cv2.remap(
+            mask,
+            np.ascontiguousarray(map1[row0:row1, col0:col1]),
+            np.ascontiguousarray(map2[row0:row1, col0:col1]),
+            interpolation=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=255,
+        )
+    else:
+        undistorted_mask = cv2.remap(
+            mask,
+            map1,
+            map2,
+            interpolation=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=255,
+        )
+    # Filter the mask valid: 255, invalid: 0
+    # Any pixel interpolated from an invalid pixel becomes invalid, this also holds
+    # for the fixed-point maps where the interpolation weights are quantized
+    undistorted_mask[undistorted_mask < 255] = 0
+    return undistorted_mask
+
+
+def compute_level_maps(
+    K, height, width, distortion_params, scales, direct_remap=False, map_cache=None, remap_mode="float"
+):
+    """Compute the rectification maps needed to produce the given output scales.
+    args:
+        scales: List of output resolution scales, 1.0 is the undistorted full resolution.
+        direct_remap: If True, every scale gets its own maps that undistort and resize
+            in a single remap. Otherwise the full-resolution undistorted frame is resized.
+    returns:
+        full_maps: (map1, map2) of the full resolution, None if not needed.
+        level_maps: List with (map1, map2) for each scale, None if the level is resized
+            from the full-resolution undistorted frame.
+    """
+    full_maps = None
+    level_maps = []
+    for scale in scales:
+        if scale == 1.0 or direct_remap:
+            _, map1, map2 = compute_undistort_maps(
+                K, height, width, distortion_params,
+                map_cache=map_cache, remap_mode=remap_mode, scale=scale,
+            )
+            level_maps.append((map1, map2))
+            if scale == 1.0:
+                full_maps = (map1, map2)
+        else:
+            level_maps.append(None)
+
+    if full_maps is None and any(maps is None for maps in level_maps):
+        _, map1, map2 = compute_undistort_maps(
+            K, height, width, distortion_params, map_cache=map_cache, remap_mode=remap_mode
+        )
+        full_maps = (map1, map2)
+    return full_maps, level_maps
+
+
+def compute_level_tile_bounds(full_maps, level_maps):
+    """compute_map_tile_bounds of the maps returned by compute_level_maps, in the same layout."""
+    full_bounds = compute_map_tile_bounds(*full_maps) if full_maps is not None else None
+    level_bounds = [
+        compute_map_tile_bounds(*maps) if maps is not None else None for maps in level_maps
+    ]
+    return full_bounds, level_bounds
+
+
+def read_frame(frame, input_image_dir, input_mask_dir, mask_info=None):
+    """Decode the image and mask of a frame. The mask is None if mask_info says it is all valid."""
+    image_path = Path(input_image_dir) / frame["file_path"]
+    image = cv2.imread(str(image_path))
+    if mask_info is not None and mask_info["all_valid"]:
+        return image, None
+    mask_path = Path(input_mask_dir) / frame["mask_path"]
+    mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+    return image, mask
+
+
+def undistort_frame_outputs(
+    frame, image, mask, full_maps, levels, height, width, mask_info=None, tile_bounds=None
+):
+    """Undistort a decoded frame at several resolutions.
+    args:
+        full_maps: (map1, map2) of the full resolution, see compute_level_maps.
+        levels: List of (maps, scale, out_image_dir, out_mask_dir) for each output.
+        mask_info: Optional entry of the MaskIndex of the mask.
+        tile_bounds: Optional (full_bounds, level_bounds), see compute_level_tile_bounds.
+    returns:
+        List of (output path, image) to write.
+    """
+    full_bounds, level_bounds = tile_bounds if tile_bounds is not None else (None, [None] * len(levels))
+    outputs = []
+    full_image = None
+    full_mask = None
+    for (maps, scale, out_image_dir, out_mask_dir), bounds in zip(levels, level_bounds):
+        _, new_height, new_width = compute_resize_intrinsic(np.eye(3), height, width, scale)
+        if maps is not None:
+            undistorted_image = undistort_image(image, *maps)
+            undistorted_mask = undistort_mask(
+                mask, *maps, new_height, new_width, mask_info=mask_info, tile_bounds=bounds
+            )
+        else:
+            if full_image is None:
+                full_image = undistort_image(image, *full_maps)
+                full_mask = undistort_mask(
+                    mask, *full_maps, height, width, mask_info=mask_info, tile_bounds=full_bounds
+                )
+            undistorted_image = resize_image(full_image, new_width, new_height)
+            if mask_info is not None and mask_info["all_valid"]:
+                undistorted_mask = np.zeros((new_height, new_width), dtype=np.uint8) + 255
+            else:
+                undistorted_mask = resize_mask(full_mask, new_width, new_height)
+
+        outputs.append((Path(out_image_dir) / frame["file_path"], undistorted_image))
+        outputs.append((Path(out_mask_dir) / frame["mask_path"], undistorted_mask))
+    return outputs
+
+
+def write_frame_outputs(outputs):
+    for out_path, image in outputs:
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_imwrite(out_path, image)
+
+
+def undistort_frame_levels(
+    frame,
+    full_maps,
+    levels,
+    height,
+    width,
+    input_image_dir,
+    input_mask_dir,
+    mask_info=None,
+    tile_bounds=None,
+):
+    """Undistort a frame and write it at several resolutions from a single decode.
+    args:
+        full_maps: (map1, map2) of the full resolution, see compute_level_maps.
+        levels: List of (maps, scale, out_image_dir, out_mask_dir) for each output.
+        mask_info, tile_bounds: Optional, see undistort_frame_outputs.
+    """
+    image, mask = read_frame(frame, input_image_dir, input_mask_dir, mask_info)
+    outputs = undistort_frame_outputs(
+        frame, image, mask, full_maps, levels, height, width, mask_info, tile_bounds
+    )
+    write_frame_outputs(outputs)
+
+
+def undistort_frame(
+    frame,
+    map1,
+    map2,
+    height,
+    width,
+    input_image_dir,
+    input_mask_dir,
+    out_image_dir,
+    out_mask_dir,
+):
+    undistort_frame_levels(
+        frame,
+        (map1, map2),
+        [((map1, map2), 1.0, out_image_dir, out_mask_dir)],
+        height,
+        width,
+        input_image_dir,
+        input_mask_dir,
+    )
+
+
 def undistort_frames(
     frames,
     K,
@@ -40,48 +289,215 @@ def undistort_frames(
     input_mask_dir,
     out_image_dir,
     out_mask_dir,
+    map_cache=None,
+    remap_mode="float",
 ):
-    new_K = compute_undistort_intrinsic(K, height, width, distortion_params)
-    map1, map2 = cv2.fisheye.initUndistortRectifyMap(
-        K, distortion_params, np.eye(3), new_K, (width, height), cv2.CV_32FC1
+    new_K, map1, map2 = compute_undistort_maps(
+        K, height, width, distortion_params, map_cache=map_cache, remap_mode=remap_mode
     )
 
     for frame in tqdm(frames, desc="frame"):
-        image_path = Path(input_image_dir) / frame["file_path"]
-        image = cv2.imread(str(image_path))
-        undistorted_image = cv2.remap(
-            image,
+        undistort_frame(
+            frame,
             map1,
             map2,
-            interpolation=cv2.INTER_LINEAR,
-            borderMode=cv2.BORDER_REFLECT_101,
+            height,
+            width,
+            input_image_dir,
+            input_mask_dir,
+            out_image_dir,
+            out_mask_dir,
         )
-        out_image_path = Path(out_image_dir) / frame["file_path"]
-        out_image_path.parent.mkdir(parents=True, exist_ok=True)
-        cv2.imwrite(str(out_image_path), undistorted_image)
-
-        # Mask
-        mask_path = Path(input_mask_dir) / frame["mask_path"]
-        mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
-        if np.all(mask > 0):
-            # No invalid pixels. Just use empty mask
-            undistorted_mask = np.zeros((height, width), dtype=np.uint8) + 255
-        else:
-            undistorted_mask = cv2.remap(
-                mask,
-                map1,
-                map2,
-                interpolation=cv2.INTER_LINEAR,
-                borderMode=cv2.BORDER_CONSTANT,
-                borderValue=255,
+    return new_K
+
+
+def frame_io_paths(job, frame):
+    """Input and output paths of a frame of a scene job."""
+    input_paths = [
+        Path(job["input_image_dir"]) / frame["file_path"],
+        Path(job["input_mask_dir"]) / frame["mask_path"],
+    ]
+    output_paths = []
+    for level in job["levels"]:
+        output_paths.append(Path(level["out_image_dir"]) / frame["file_path"])
+        output_paths.append(Path(level["out_mask_dir"]) / frame["mask_path"])
+    return input_paths, output_paths
+
+
+def mark_frames_done(job, frames):
+    manifest = job.get("manifest")
+    if manifest is None:
+        return
+    for frame in frames:
+        manifest.mark_frame_done(frame["file_path"], *frame_io_paths(job, frame))
+
+
+def undistort_scene(job, map_cache=None, remap_mode="float", pipeline_args=None, report_stats=False):
+    """Undistort all frames of a scene job into all of its output levels.
+    Reading, undistortion and writing of the frames overlap in a FramePipeline.
+    args:
+        pipeline_args: Optional dict with num_readers, num_writers and queue_size of the pipeline.
+        report_stats: Print the per-stage timings of the pipeline.
+    """
+    full_maps, level_maps = compute_level_maps(
+        job["K"],
+        job["height"],
+        job["width"],
+        job["distortion_params"],
+        [level["scale"] for level in job["levels"]],
+        direct_remap=job["direct_remap"],
+        map_cache=map_cache,
+        remap_mode=remap_mode,
+    )
+    levels = [
+        (maps, level["scale"], level["out_image_dir"], level["out_mask_dir"])
+        for maps, level in zip(level_maps, job["levels"])
+    ]
+    mask_index = job.get("mask_index")
+    tile_bounds = None
+    if mask_index is not None:
+        tile_bounds = compute_level_tile_bounds(full_maps, level_maps)
+
+    def mask_info(frame):
+        return mask_index.get(frame["mask_path"]) if mask_index is not None else None
+
+    pipeline = FramePipeline(
+        read_fn=lambda frame: read_frame(
+            frame, job["input_image_dir"], job["input_mask_dir"], mask_info(frame)
+        ),
+        compute_fn=lambda frame, data: undistort_frame_outputs(
+            frame, *data, full_maps, levels, job["height"], job["width"],
+            mask_info(frame), tile_bounds,
+        ),
+        write_fn=lambda frame, outputs: write_frame_outputs(outputs),
+        **(pipeline_args or {}),
+    )
+    stats = pipeline.run(
+        job["frames"], on_done=lambda frame: mark_frames_done(job, [frame]), desc="frame"
+    )
+    if report_stats:
+        print(f"{job['scene_id']} {stats.summary()}")
+
+
+# Rectification maps of the worker process, keyed by the camera parameters.
+# The maps are memory-mapped from the RectifyMapCache once per scene in each
+# worker instead of being pickled and sent along with every task.
+_worker_maps = {}
+_worker_map_cache = None
+
+
+def _init_worker(map_cache_dir=None, map_cache_max_gb=4.0):
+    global _worker_map_cache
+    # Parallelism comes from the process pool, avoid oversubscribing the cores
+    cv2.setNumThreads(1)
+    if map_cache_dir is not None:
+        _worker_map_cache = RectifyMapCache(map_cache_dir, map_cache_max_gb)
+
+
+def _undistort_frames_worker(camera, frames, input_dirs, outputs, mask_infos=None):
+    K, height, width, distortion_params, scales, direct_remap, remap_mode = camera
+    if camera not in _worker_maps:
+        # Only keep the maps of the current scene
+        _worker_maps.clear()
+        full_maps, level_maps = compute_level_maps(
+            np.array(K), height, width, np.array(distortion_params), scales,
+            direct_remap=direct_remap, map_cache=_worker_map_cache, remap_mode=remap_mode,
+        )
+        _worker_maps[camera] = (full_maps, level_maps, None)
+    full_maps, level_maps, tile_bounds = _worker_maps[camera]
+    if mask_infos is not None and tile_bounds is None:
+        tile_bounds = compute_level_tile_bounds(full_maps, level_maps)
+        _worker_maps[camera] = (full_maps, level_maps, tile_bounds)
+    levels = [
+        (maps, scale, *output_dirs)
+        for maps, scale, output_dirs in zip(level_maps, scales, outputs)
+    ]
+    if mask_infos is None:
+        mask_infos = [None] * len(frames)
+    for frame, mask_info in zip(frames, mask_infos):
+        undistort_frame_levels(
+            frame, full_maps, levels, height, width, *input_dirs, mask_info, tile_bounds
+        )
+    return len(frames)
+
+
+def undistort_scenes_parallel(
+    jobs, num_workers, frames_per_task=16, map_cache=None, remap_mode="float"
+):
+    """Undistort the frames of several scenes with a process pool.
+    args:
+        jobs: List of scene jobs as returned by prepare_scene_job.
+        num_workers: Number of worker processes.
+        frames_per_task: Number of frames sent to a worker at once.
+        map_cache: Optional RectifyMapCache shared with the workers, a temporary one
+            without size limit is used if not given. The maps of a scene are built once in the main process and
+            memory-mapped by the workers.
+        remap_mode: "float" or "fixed", see compute_undistort_maps.
+    returns:
+        Iterator over the jobs, yielded as soon as all frames of a scene are done.
+    """
+    with tempfile.TemporaryDirectory(prefix="rectify_maps_") as tmp_cache_dir:
+        if map_cache is None:
+            # no size limit, the maps of all scenes are computed before the workers open them
+            map_cache = RectifyMapCache(tmp_cache_dir, max_size_gb=None)
+        yield from _undistort_scenes_parallel(jobs, num_workers, frames_per_task, map_cache, remap_mode)
+
+
+def _undistort_scenes_parallel(jobs, num_workers, frames_per_task, map_cache, remap_mode):
+    num_frames = sum(len(job["frames"]) for job in jobs)
+    pending = {}
+    max_size_gb = None if map_cache.max_size_bytes is None else map_cache.max_size_bytes / 1024**3
+    initargs = (str(map_cache.cache_dir), max_size_gb)
+    with ProcessPoolExecutor(
+        max_workers=num_workers, initializer=_init_worker, initargs=initargs
+    ) as executor:
+        futures = {}
+        for job_idx, job in enumerate(jobs):
+            scales = tuple(level["scale"] for level in job["levels"])
+            compute_level_maps(
+                job["K"], job["height"], job["width"], job["distortion_params"], scales,
+                direct_remap=job["direct_remap"], map_cache=map_cache, remap_mode=remap_mode,
             )
-            # Filter the mask valid: 255, invalid: 0
-            undistorted_mask[undistorted_mask < 255] = 0
+            # Hashable camera key, identical for all tasks of the scene
+            camera = (
+                tuple(map(tuple, job["K"].tolist())),
+                job["height"],
+                job["width"],
+                tuple(job["distortion_params"].tolist()),
+                scales,
+                job["direct_remap"],
+                remap_mode,
+            )
+            input_dirs = (job["input_image_dir"], job["input_mask_dir"])
+            outputs = [(level["out_image_dir"], level["out_mask_dir"]) for level in job["levels"]]
+            frames = job["frames"]
+            pending[job_idx] = 0
+            for start in range(0, len(frames), frames_per_task):
+                chunk = frames[start:start + frames_per_task]
+                mask_infos = None
+                if job.get("mask_index") is not None:
+                    mask_infos = [job["mask_index"].get(frame["mask_path"]) for frame in chunk]
+                future = executor.submit(
+                    _undistort_frames_worker,
+                    camera,
+                    chunk,
+                    input_dirs,
+                    outputs,
+                    mask_infos,
+                )
+                futures[future] = (job_idx, chunk)
+                pending[job_idx] += 1
+            if pending[job_idx] == 0:
+                yield job
 
-        out_mask_path = Path(out_mask_dir) / frame["mask_path"]
-        out_mask_path.parent.mkdir(parents=True, exist_ok=True)
-        cv2.imwrite(str(out_mask_path), undistorted_mask)
-    return new_K
+        with tqdm(total=num_frames, desc="frame") as pbar:
+            for future in as_completed(futures):
+                pbar.update(future.result())
+                job_idx, chunk = futures[future]
+                mark_frames_done(jobs[job_idx], chunk)
+                pending[job_idx] -= 1
+                if pending[job_idx] == 0:
+                    yield jobs[job_idx]
 
 
 def update_transforms_json(transforms, new_K, new_height, new_width):
@@ -100,7 +516,169 @@ def update_transforms_json(transforms, new_K, new_height, new_width):
     return new_transforms
 
 
-def main(args):
+def prepare_scene_job(cfg, scene_id, levels=None):
+    """Collect the frames, camera and paths of a scene.
+    args:
+        levels: List of dicts with scale, out_image_dir, out_mask_dir and out_transforms_path
+            (relative to the dslr dir) for each output. Defaults to the single full-resolution
+            output given in the config.
+    """
+    scene = ScannetppScene_Release(scene_id, data_root=Path(cfg.data_root) / "data")
+    input_image_dir = cfg.get("input_image_dir", None)
+    if input_image_dir is None:
+        input_image_dir = scene.dslr_resized_dir
+    else:
+        input_image_dir = scene.dslr_dir / input_image_dir
+
+    input_mask_dir = cfg.get("input_mask_dir", None)
+    if input_mask_dir is None:
+        input_mask_dir = scene.dslr_resized_mask_dir
+    else:
+        input_mask_dir = scene.dslr_dir / input_mask_dir
+
+    input_transforms_path = cfg.get("input_transforms_path", None)
+    if input_transforms_path is None:
+        input_transforms_path = scene.dslr_nerfstudio_transform_path
+    else:
+        input_transforms_path = scene.dslr_dir / input_transforms_path
+
+    if levels is None:
+        levels = [
+            {
+                "scale": 1.0,
+                "out_image_dir": cfg.out_image_dir,
+                "out_mask_dir": cfg.out_mask_dir,
+                "out_transforms_path": cfg.out_transforms_path,
+            }
+        ]
+    levels = [
+        {
+            "scale": level["scale"],
+            "out_image_dir": scene.dslr_dir / level["out_image_dir"],
+            "out_mask_dir": scene.dslr_dir / level["out_mask_dir"],
+            "out_transforms_path": scene.dslr_dir / level["out_transforms_path"],
+        }
+        for level in levels
+    ]
+
+    transforms = load_json(input_transforms_path)
+    assert len(transforms["frames"]) > 0
+    frames = deepcopy(transforms["frames"])
+    if "test_frames" not in transforms:
+        print(f"{scene_id} has no test split")
+    elif not (input_image_dir / transforms["test_frames"][0]["file_path"]).exists():
+        print(
+            f"{scene_id} test image not found. Might due to the scene belonging to testing scenes. "
+            "The resizing will skip those images."
+        )
+    else:
+        assert len(transforms["test_frames"]) > 0
+        frames += transforms["test_frames"]
+
+    height = int(transforms["h"])
+    width = int(transforms["w"])
+    distortion_params = np.array(
+        [
+            float(transforms["k1"]),
+            float(transforms["k2"]),
+            float(transforms["k3"]),
+            float(transforms["k4"]),
+        ]
+    )
+    fx = float(transforms["fl_x"])
+    fy = float(transforms["fl_y"])
+    cx = float(transforms["cx"])
+    cy = float(transforms["cy"])
+    K = np.array(
+        [
+            [fx, 0, cx],
+            [0, fy, cy],
+            [0, 0, 1],
+        ]
+    )
+    return {
+        "scene_id": scene_id,
+        "transforms": transforms,
+        "frames": frames,
+        "K": K,
+        "height": height,
+        "width": width,
+        "distortion_params": distortion_params,
+        "input_image_dir": input_image_dir,
+        "input_mask_dir": input_mask_dir,
+        "input_transforms_path": input_transforms_path,
+        "levels": levels,
+        "direct_remap": cfg.get("direct_remap", False),
+    }
+
+
+def open_scene_manifest(job, remap_mode="float", use_hash=False):
+    """Attach the manifest of a scene job and drop the frames that are already done.
+    The manifest is stored next to the transforms.json of the first output level.
+    returns:
+        False if the whole scene is already done, True otherwise.
+    """
+    levels = job["levels"]
+    manifest_path = levels[0]["out_transforms_path"].with_suffix(".manifest.json")
+    params = {
+        "script": "undistort",
+        "K": job["K"].tolist(),
+        "distortion_params": job["distortion_params"].tolist(),
+        "height": job["height"],
+        "width": job["width"],
+        "levels": [[level["scale"], level["out_image_dir"], level["out_mask_dir"]] for level in levels],
+        "direct_remap": job["direct_remap"],
+        "remap_mode": remap_mode,
+    }
+    manifest = SceneManifest(manifest_path, config_hash(params), use_hash=use_hash)
+    job["manifest"] = manifest
+    out_transforms_paths = [level["out_transforms_path"] for level in levels]
+    if manifest.is_scene_done([job["input_transforms_path"]], out_transforms_paths):
+        return False
+    job["frames"] = [
+        frame for frame in job["frames"]
+        if not manifest.is_frame_done(frame["file_path"], *frame_io_paths(job, frame))
+    ]
+    return True
+
+
+def write_scene_transforms(job):
+    """Write the transforms.json of every output level of a scene job."""
+    new_K = compute_undistort_intrinsic(
+        job["K"], job["height"], job["width"], job["distortion_params"]
+    )
+    for level in job["levels"]:
+        level_K, new_height, new_width = compute_resize_intrinsic(
+            new_K, job["height"], job["width"], level["scale"]
+        )
+        new_trasforms = update_transforms_json(
+            job["transforms"], level_K, new_height, new_width
+        )
+        out_transforms_path = level["out_transforms_path"]
+        out_transforms_path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_json(out_transforms_path, new_trasforms)
+
+    manifest = job.get("manifest")
+    if manifest is not None:
+        manifest.mark_scene_done(
+            [job["input_transforms_path"]],
+            [level["out_transforms_path"] for level in job["levels"]],
+        )
+
+
+def get_pipeline_args(cfg):
+    return {
+        "num_readers": cfg.get("io_readers", 2),
+        "num_writers": cfg.get("io_writers", 2),
+        "queue_size": cfg.get("io_queue_size", 8),
+    }
+
+
+def main(args, levels=None):
+    """Undistort the scenes given in the config.
+    args:
+        levels: Output levels passed to prepare_scene_job, defaults to the full resolution.
+    """
     cfg = load_yaml_munch(args.config_file)
 
     # get the scenes to process
@@ -112,83 +690,56 @@ def main(args):
             split_path = Path(cfg.data_root) / "splits" / f"{split}.txt"
             scene_ids += read_txt_list(split_path)
 
-    # get the options to process
-    # go through each scene
-    for scene_id in tqdm(scene_ids, desc="scene"):
-        scene = ScannetppScene_Release(scene_id, data_root=Path(cfg.data_root) / "data")
-        input_image_dir = cfg.get("input_image_dir", None)
-        if input_image_dir is None:
-            input_image_dir = scene.dslr_resized_dir
-        else:
-            input_image_dir = scene.dslr_dir / input_image_dir
+    num_workers = cfg.get("num_workers", 0)
+    if num_workers == -1:
+        num_workers = os.cpu_count()
 
-        input_mask_dir = cfg.get("input_mask_dir", None)
-        if input_mask_dir is None:
-            input_mask_dir = scene.dslr_resized_mask_dir
-        else:
-            input_mask_dir = scene.dslr_dir / input_mask_dir
+    map_cache = None
+    if cfg.get("map_cache_dir"):
+        map_cache = RectifyMapCache(cfg.map_cache_dir, cfg.get("map_cache_max_gb", 4.0))
+    remap_mode = cfg.get("remap_mode", "float")
+    incremental = cfg.get("incremental", False)
+    use_hash = cfg.get("incremental_hash", False)
 
-        input_transforms_path = cfg.get("input_transforms_path", None)
-        if input_transforms_path is None:
-            input_transforms_path = scene.dslr_nerfstudio_transform_path
-        else:
-            input_transforms_path = scene.dslr_dir / input_transforms_path
-
-        out_image_dir = scene.dslr_dir / cfg.out_image_dir
-        out_mask_dir = scene.dslr_dir / cfg.out_mask_dir
-        out_transforms_path = scene.dslr_dir / cfg.out_transforms_path
-
-        transforms = load_json(input_transforms_path)
-        assert len(transforms["frames"]) > 0
-        frames = deepcopy(transforms["frames"])
-        if "test_frames" not in transforms:
-            print(f"{scene_id} has no test split")
-        elif not (input_image_dir / transforms["test_frames"][0]["file_path"]).exists():
-            print(
-                f"{scene_id} test image not found. Might due to the scene belonging to testing scenes. "
-                "The resizing will skip those images."
-            )
-        else:
-            assert len(transforms["test_frames"]) > 0
-            frames += transforms["test_frames"]
-
-        height = int(transforms["h"])
-        width = int(transforms["w"])
-        distortion_params = np.array(
-            [
-                float(transforms["k1"]),
-                float(transforms["k2"]),
-                float(transforms["k3"]),
-                float(transforms["k4"]),
-            ]
-        )
-        fx = float(transforms["fl_x"])
-        fy = float(transforms["fl_y"])
-        cx = float(transforms["cx"])
-        cy = float(transforms["cy"])
-        K = np.array(
-            [
-                [fx, 0, cx],
-                [0, fy, cy],
-                [0, 0, 1],
-            ]
-        )
+    def skip_scene(job):
+        if incremental and not open_scene_manifest(job, remap_mode, use_hash):
+            print(f"{job['scene_id']} is up to date, skipping")
+            return True
+        if cfg.get("use_mask_index", False):
+            job["mask_index"] = load_mask_index(job["input_mask_dir"], job["frames"])
+        return False
 
-        new_K = undistort_frames(
-            frames,
-            K,
-            height,
-            width,
-            distortion_params,
-            input_image_dir,
-            input_mask_dir,
-            out_image_dir,
-            out_mask_dir,
+    if num_workers > 1:
+        # fan out the frames of all scenes over the process pool
+        jobs = [
+            prepare_scene_job(cfg, scene_id, levels=levels)
+            for scene_id in tqdm(scene_ids, desc="scene")
+        ]
+        jobs = [job for job in jobs if not skip_scene(job)]
+        for job in undistort_scenes_parallel(
+            jobs,
+            num_workers,
+            frames_per_task=cfg.get("frames_per_task", 16),
+            map_cache=map_cache,
+            remap_mode=remap_mode,
+        ):
+            write_scene_transforms(job)
+        return
+
+    # get the options to process
+    # go through each scene
+    for scene_id in tqdm(scene_ids, desc="scene"):
+        job = prepare_scene_job(cfg, scene_id, levels=levels)
+        if skip_scene(job):
+            continue
+        undistort_scene(
+            job,
+            map_cache=map_cache,
+            remap_mode=remap_mode,
+            pipeline_args=get_pipeline_args(cfg),
+            report_stats=cfg.get("report_pipeline_stats", False),
         )
-        new_trasforms = update_transforms_json(transforms, new_K, height, width)
-        out_transforms_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(out_transforms_path, "w") as f:
-            json.dump(new_trasforms, f, indent=4)
+        write_scene_transforms(job)
 
 
 if __name__ == "__main__":
@@ -13,6 +13,16 @@ from common.utils.colmap import read_model, write_model, Image
 from common.scene_release import ScannetppScene_Release
 from common.utils.utils import run_command, load_yaml_munch, load_json, read_txt_list
 from common.utils.nerfstudio import convert_camera
+from dslr.manifest import SceneManifest, atomic_write_json, config_hash
+
+
+def list_files(dir_path: Path):
+    '''
+    sorted files in a dir, empty if it does not exist
+    '''
+    if not Path(dir_path).is_dir():
+        return []
+    return sorted(p for p in Path(dir_path).iterdir() if p.is_file())
 
 
 def undistort_anon_masks(
@@ -75,7 +85,7 @@ def undistort_anon_masks(
         # )
 
         # Go through all the image masks and make sure they are all 0 or 255
-        cameras, images, points3D = read_model(undistort_dir / "sparse")
+        cameras, images, points3D = read_model(undistort_dir / "sparse", pose_only=True)
         for image_id, image in images.items():
             image_path = undistort_dir / "images" / image.name
             mask = imageio.imread(image_path)
@@ -143,7 +153,7 @@ def undistort_images(
 
 
 def update_transforms_json(model_path, old_json, output_json):
-    cameras, images, points3D = read_model(model_path, ".txt")
+    cameras, images, points3D = read_model(model_path, ".txt", pose_only=True)
     assert len(cameras) == 1, "Multiple cameras not supported"
     camera = next(iter(cameras.values()))
     transforms = load_json(old_json)
@@ -151,8 +161,7 @@ def update_transforms_json(model_path, old_json, output_json):
     new_transforms.update(convert_camera(camera))
     print(convert_camera(camera))
     output_json.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_json, "w") as f:
-        json.dump(new_transforms, f, indent=4)
+    atomic_write_json(output_json, new_transforms)
 
 
 def main(args):
@@ -179,6 +188,35 @@ def main(args):
 
         output_dir = Path(cfg.output_dir) / scene_id
         output_dir.mkdir(exist_ok=True, parents=True)
+
+        manifest = None
+        if cfg.get('incremental', False):
+            # COLMAP undistorts a whole scene at once, so scenes are either done or redone
+            params = {'script': 'undistort_colmap', 'max_size': cfg.max_size, 'crop_border': cfg.crop_border}
+            manifest = SceneManifest(output_dir / 'manifest.json', config_hash(params),
+                                     use_hash=cfg.get('incremental_hash', False))
+            input_paths = [
+                scene.dslr_colmap_dir / 'cameras.txt',
+                scene.dslr_colmap_dir / 'images.txt',
+                scene.dslr_colmap_dir / 'points3D.txt',
+                scene.dslr_nerfstudio_transform_path,
+                scene.dslr_train_test_lists_path,
+            ]
+            # every image and mask that COLMAP reads, like the per-frame inputs of dslr/undistort.py
+            input_paths += list_files(scene.dslr_resized_dir) + list_files(scene.dslr_resized_mask_dir)
+            output_paths = [
+                output_dir / 'masks',
+                output_dir / 'images',
+                output_dir / 'colmap',
+                output_dir / 'nerfstudio/transforms.json',
+            ]
+            if manifest.is_scene_done(input_paths, output_paths):
+                print(f'{scene_id} is up to date, skipping')
+                continue
+            # remove the outputs of an interrupted run, the results are moved into these dirs
+            for output_path in output_paths[:3]:
+                if output_path.is_dir():
+                    shutil.rmtree(output_path)
         undistort_anon_masks(
             image_dir=scene.dslr_resized_mask_dir,
             input_model_dir=scene.dslr_colmap_dir,
@@ -200,6 +238,8 @@ def main(args):
             scene.dslr_nerfstudio_transform_path,
             output_dir / "nerfstudio/transforms.json",
         )
+        if manifest is not None:
+            manifest.mark_scene_done(input_paths, output_paths)
 
 
 if __name__ == '__main__':
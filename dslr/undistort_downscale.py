@@ -0,0 +1,47 @@
+'''
+Undistort and downscale DSLR images in a single pass. Every frame is decoded
+once and written at all requested downscale factors, without intermediate files
+'''
+
+import argparse
+
+from common.utils.utils import load_yaml_munch
+from dslr import undistort
+from dslr.downscale import format_factor
+
+
+def get_levels(cfg):
+    '''
+    output levels for dslr.undistort from the downscale factors in the config,
+    the output paths may contain {factor} which is replaced by each factor
+    '''
+    factors = cfg.get("downscale_factors", [1])
+    if len(factors) > 1:
+        for key in ("out_image_dir", "out_mask_dir", "out_transforms_path"):
+            assert "{factor}" in cfg[key], f"{key} must contain {{factor}} for multiple downscale factors"
+
+    levels = []
+    for factor in factors:
+        factor_str = format_factor(factor)
+        levels.append(
+            {
+                "scale": 1 / float(factor),
+                "out_image_dir": cfg.out_image_dir.format(factor=factor_str),
+                "out_mask_dir": cfg.out_mask_dir.format(factor=factor_str),
+                "out_transforms_path": cfg.out_transforms_path.format(factor=factor_str),
+            }
+        )
+    return levels
+
+
+def main(args):
+    cfg = load_yaml_munch(args.config_file)
+    undistort.main(args, levels=get_levels(cfg))
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("config_file", help="Path to config file")
+    args = p.parse_args()
+
+    main(args)
@@ -1,6 +1,5 @@
 import argparse
 from typing import List, Optional, Union, Callable
-import json
 import os
 from pathlib import Path
 
@@ -10,6 +9,8 @@ import torch
 from torchmetrics.image import PeakSignalNoiseRatio
 
 from common.scene_release import ScannetppScene_Release
+from common.data_manifest import load_data_manifest
+from common.utils.nerfstudio import load_transforms_binary
 from eval.ssim import ssim as SSIM
 from eval.lpips.lpips import LPIPS
 
@@ -145,17 +146,21 @@ def evaluate_scene(
     return psnr_values, ssim_values, lpips_values
 
 
-def get_test_images(transforms_path: str):
-    with open(transforms_path, "r") as f:
-        transforms = json.load(f)
+def get_test_images(scene: ScannetppScene_Release):
+    # the binary companion of transforms.json avoids parsing the json, if it is up to date
+    transforms = load_transforms_binary(scene.dslr_nerfstudio_transform_path)
+    if transforms is not None:
+        return transforms["test_frames_names"]
+    transforms = scene.load_transforms("dslr")
     image_list = [x["file_path"] for x in transforms["test_frames"]]
     return image_list
 
 
-def scene_has_mask(transforms_path: str):
-    with open(transforms_path, "r") as f:
-        transforms = json.load(f)
-    return transforms["has_mask"]
+def scene_has_mask(scene: ScannetppScene_Release):
+    transforms = load_transforms_binary(scene.dslr_nerfstudio_transform_path)
+    if transforms is not None and "has_mask" in transforms:
+        return transforms["has_mask"]
+    return scene.load_transforms("dslr")["has_mask"]
 
 
 def evaluate_all(data_root, pred_dir, scene_list, device="cpu", verbose=True):
@@ -164,14 +169,19 @@ def evaluate_all(data_root, pred_dir, scene_list, device="cpu", verbose=True):
     all_ssim = []
     all_lpips = []
 
+    # existence checks of the data are answered by the manifest of data_root, if any
+    manifest = load_data_manifest(data_root)
     for scene_id in scene_list:
         assert (
             Path(pred_dir) / scene_id
         ).exists(), f"Prediction dir of scene {scene_id} does not exist"
-        num_images_pred = len(os.listdir(Path(pred_dir) / scene_id))
-        assert num_images_pred > 0, f"Prediction dir of scene {scene_id} is empty"
-        scene = ScannetppScene_Release(scene_id, data_root=data_root)
-        image_list = get_test_images(scene.dslr_nerfstudio_transform_path)
+        # only check for a first entry instead of listing the whole dir
+        with os.scandir(Path(pred_dir) / scene_id) as it:
+            assert next(it, None) is not None, f"Prediction dir of scene {scene_id} is empty"
+        scene = ScannetppScene_Release(scene_id, data_root=data_root, manifest=manifest)
+        assert scene.has(
+            "dslr_nerfstudio_transform_path"
+        ), f"transforms.json of scene {scene_id} does not exist"
 
         # assert num_images_pred == len(
         #     image_list
@@ -184,11 +194,11 @@ def evaluate_all(data_root, pred_dir, scene_list, device="cpu", verbose=True):
     for i, scene_id in enumerate(scene_list):
         if verbose:
             print(f"({i+1} / {len(scene_list)}) scene_id: {scene_id}")
-        scene = ScannetppScene_Release(scene_id, data_root=data_root)
-        image_list = get_test_images(scene.dslr_nerfstudio_transform_path)
+        scene = ScannetppScene_Release(scene_id, data_root=data_root, manifest=manifest)
+        image_list = get_test_images(scene)
 
         mask_dir = None
-        if scene_has_mask(scene.dslr_nerfstudio_transform_path):
+        if scene_has_mask(scene):
             mask_dir = scene.dslr_resized_mask_dir
         scene_psnr, scene_ssim, scene_lpips = evaluate_scene(
             Path(pred_dir) / scene_id,
@@ -0,0 +1,225 @@
+'''
+Decoder for the iPhone depth.bin files
+
+depth.bin is either a single raw zlib stream of float32 depth in m, or a sequence of
+length-prefixed records (uint32 little endian size + data), one per frame, compressed
+with lz4 (uint16 depth in mm) or raw zlib (float32 depth in m).
+
+The single stream is decompressed incrementally, one frame at a time.
+
+For the per-frame format the record offsets and the codec are determined once and cached
+next to depth.bin, the frames are then decoded in a process pool.
+'''
+
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import imageio as iio
+import lz4.block
+
+# codecs of depth.bin
+GLOBAL_ZLIB = "zlib_global"
+FRAME_LZ4 = "lz4"
+FRAME_ZLIB = "zlib"
+
+
+def depth_index_path(depth_path):
+    '''
+    depth.bin -> depth.bin.index.npz
+    '''
+    depth_path = Path(depth_path)
+    return depth_path.parent / f"{depth_path.name}.index.npz"
+
+
+def scan_depth_records(depth_path):
+    '''
+    offsets and sizes of the data of all length-prefixed records,
+    None if the file is not a sequence of records
+    '''
+    file_size = Path(depth_path).stat().st_size
+    offsets = []
+    sizes = []
+    with open(depth_path, 'rb') as infile:
+        position = 0
+        while position < file_size:
+            size = infile.read(4)
+            if len(size) < 4:
+                return None
+            size = int.from_bytes(size, byteorder='little')
+            position += 4
+            if size == 0 or position + size > file_size:
+                return None
+            offsets.append(position)
+            sizes.append(size)
+            position += size
+            infile.seek(position)
+    return np.array(offsets, dtype=np.int64), np.array(sizes, dtype=np.int64)
+
+
+def decode_depth_record(data, codec, height, width):
+    '''
+    decode a single record to uint16 depth in mm
+    '''
+    if codec == FRAME_LZ4:
+        data = lz4.block.decompress(data, uncompressed_size=height * width * 2)  # UInt16 = 2bytes
+        return np.frombuffer(data, dtype=np.uint16).reshape(height, width)
+    data = zlib.decompress(data, wbits=-zlib.MAX_WBITS)
+    depth = np.frombuffer(data, dtype=np.float32).reshape(height, width)
+    return (depth * 1000).astype(np.uint16)
+
+
+def detect_depth_codec(depth_path, records, height, width):
+    '''
+    records: output of scan_depth_records
+    returns: GLOBAL_ZLIB, FRAME_LZ4 or FRAME_ZLIB
+    '''
+    if records is None or len(records[0]) == 0:
+        return GLOBAL_ZLIB
+    offsets, sizes = records
+    with open(depth_path, 'rb') as infile:
+        infile.seek(offsets[0])
+        data = infile.read(sizes[0])
+    for codec in (FRAME_LZ4, FRAME_ZLIB):
+        try:
+            decode_depth_record(data, codec, height, width)
+            return codec
+        except (lz4.block.LZ4BlockError, zlib.error, ValueError):
+            continue
+    return GLOBAL_ZLIB
+
+
+def load_depth_index(depth_path, height=192, width=256):
+    """Codec and record offsets of a depth.bin file, cached next to it.
+
+    Args:
+        depth_path: Path of depth.bin.
+    Returns:
+        codec: GLOBAL_ZLIB, FRAME_LZ4 or FRAME_ZLIB.
+        offsets, sizes: Data offset and size of each frame record, empty for GLOBAL_ZLIB.
+    """
+    depth_path = Path(depth_path)
+    index_path = depth_index_path(depth_path)
+    stat = os.stat(depth_path)
+    if index_path.is_file():
+        try:
+            index = np.load(index_path)
+            if (int(index['size']) == stat.st_size and int(index['mtime_ns']) == stat.st_mtime_ns
+                    and int(index['height']) == height and int(index['width']) == width):
+                return str(index['codec']), index['offsets'], index['sizes']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    records = scan_depth_records(depth_path)
+    codec = detect_depth_codec(depth_path, records, height, width)
+    if codec == GLOBAL_ZLIB:
+        offsets, sizes = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    else:
+        offsets, sizes = records
+    try:
+        np.savez(index_path, codec=codec, offsets=offsets, sizes=sizes, height=height, width=width,
+                 size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    except OSError:
+        # read-only data dir, index again next time
+        pass
+    return codec, offsets, sizes
+
+
+def depth_png_path(out_dir, frame_id):
+    # 6 digit frame id = 277 minute video at 60 fps
+    return Path(out_dir) / f"frame_{frame_id:06}.png"
+
+
+def _decode_depth_chunk(depth_path, records, codec, height, width, out_dir=None):
+    '''
+    decode records [(frame_id, offset, size)] of depth.bin
+    out_dir: write the frames as png there and return (frame_id, None),
+        otherwise return (frame_id, depth)
+    '''
+    results = []
+    with open(depth_path, 'rb') as infile:
+        for frame_id, offset, size in records:
+            infile.seek(offset)
+            depth = decode_depth_record(infile.read(size), codec, height, width)
+            if out_dir is not None:
+                iio.imwrite(depth_png_path(out_dir, frame_id), depth)
+                depth = None
+            results.append((frame_id, depth))
+    return results
+
+
+def _iter_global_depth_frames(depth_path, height, width, sample_rate, read_size=1 << 20):
+    '''
+    stream the frames of a single zlib stream, keeps at most about two frames in memory.
+    frames that are not sampled still have to be decompressed, but are not converted
+    '''
+    frame_nbytes = height * width * 4  # float32
+    decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+    buffer = bytearray()
+    frame_id = 0
+    with open(depth_path, 'rb') as infile:
+        while True:
+            data = decompressor.unconsumed_tail or infile.read(read_size)
+            if len(data) > 0:
+                # bound the decompressed output, the rest of the input stays in unconsumed_tail
+                buffer += decompressor.decompress(data, frame_nbytes)
+            else:
+                buffer += decompressor.flush()
+            while len(buffer) >= frame_nbytes:
+                if frame_id % sample_rate == 0:
+                    depth = np.frombuffer(bytes(buffer[:frame_nbytes]), dtype=np.float32).reshape(height, width)
+                    yield frame_id, (depth * 1000).astype(np.uint16)
+                del buffer[:frame_nbytes]
+                frame_id += 1
+            if len(data) == 0:
+                break
+    if len(buffer) > 0:
+        raise ValueError(f"{depth_path} does not contain a whole number of {height}x{width} frames")
+
+
+def iter_depth_frames(depth_path, height=192, width=256, sample_rate=1, num_workers=0,
+                      out_dir=None, frames_per_task=32):
+    """Decode the frames of a depth.bin file in order.
+
+    Args:
+        depth_path: Path of depth.bin.
+        sample_rate: Only decode every sample_rate-th frame.
+        num_workers: Decode per-frame records in a pool of this many processes if > 1.
+        out_dir: If given, write each frame as uint16 png to out_dir (in the workers)
+            and yield None instead of the depth.
+        frames_per_task: Number of records decoded by a worker at once.
+    Returns:
+        Iterator over (frame_id, depth) with uint16 depth in mm.
+    """
+    codec, offsets, sizes = load_depth_index(depth_path, height, width)
+    if codec == GLOBAL_ZLIB:
+        for frame_id, depth in _iter_global_depth_frames(depth_path, height, width, sample_rate):
+            if out_dir is not None:
+                iio.imwrite(depth_png_path(out_dir, frame_id), depth)
+                depth = None
+            yield frame_id, depth
+        return
+
+    frame_ids = range(0, len(offsets), sample_rate)
+    records = [(frame_id, int(offsets[frame_id]), int(sizes[frame_id])) for frame_id in frame_ids]
+    chunks = [records[i:i + frames_per_task] for i in range(0, len(records), frames_per_task)]
+
+    if num_workers <= 1:
+        for chunk in chunks:
+            yield from _decode_depth_chunk(depth_path, chunk, codec, height, width, out_dir)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # keep a bounded number of chunks in flight, decoded frames are yielded in order
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(
+                _decode_depth_chunk, depth_path, chunk, codec, height, width, out_dir
+            ))
+            if len(pending) >= 2 * num_workers:
+                yield from pending.popleft().result()
+        while len(pending) > 0:
+            yield from pending.popleft().result()
@@ -8,6 +8,8 @@ and semantic tasks on the mesh
 '''
 
 import argparse
+import os
+import time
 from pathlib import Path
 import yaml
 from munch import Munch
@@ -15,68 +17,72 @@ from tqdm import tqdm
 import json
 import sys
 import subprocess
-import zlib
 import numpy as np
-import imageio as iio
-import lz4.block
 
 from common.scene_release import ScannetppScene_Release
+from common.utils.depth_container import DepthContainerWriter
+from common.utils.scheduler import TaskScheduler, format_summary
 from common.utils.utils import run_command, load_yaml_munch, load_json, read_txt_list
+from iphone.depth_decoder import iter_depth_frames
+from iphone.video_frames import ffmpeg_extract_frames, get_frame_ids, write_video_frames
 
 
-def extract_rgb(scene):
+def extract_rgb(scene, frame_subset=None, video_backend='ffmpeg'):
+    '''
+    frame_subset: None extracts all frames, otherwise (stride, frame_ids), see get_frame_ids
+    video_backend: ffmpeg or inprocess, see iphone.video_frames
+    '''
     scene.iphone_rgb_dir.mkdir(parents=True, exist_ok=True)
-    cmd = f"ffmpeg -i {scene.iphone_video_path} -start_number 0 -q:v 1 {scene.iphone_rgb_dir}/frame_%06d.jpg"
-    run_command(cmd, verbose=True)
-
-def extract_masks(scene):
+    if frame_subset is None and video_backend == 'ffmpeg':
+        cmd = f"ffmpeg -i {scene.iphone_video_path} -start_number 0 -q:v 1 {scene.iphone_rgb_dir}/frame_%06d.jpg"
+        run_command(cmd, verbose=True, raise_on_error=True)
+        return
+    stride, frame_ids = frame_subset if frame_subset is not None else (1, None)
+    if video_backend == 'ffmpeg':
+        ffmpeg_extract_frames(scene.iphone_video_path, scene.iphone_rgb_dir, '.jpg', stride, frame_ids,
+                              ffmpeg_args='-q:v 1')
+    else:
+        write_video_frames(scene.iphone_video_path, scene.iphone_rgb_dir, '.jpg', stride, frame_ids)
+
+def extract_masks(scene, frame_subset=None, video_backend='ffmpeg'):
     scene.iphone_video_mask_dir.mkdir(parents=True, exist_ok=True)
-    cmd = f"ffmpeg -i {str(scene.iphone_video_mask_path)} -pix_fmt gray -start_number 0 {scene.iphone_video_mask_dir}/frame_%06d.png"
-    run_command(cmd, verbose=True)
-
-def extract_depth(scene):
-    # global compression with zlib
+    if frame_subset is None and video_backend == 'ffmpeg':
+        cmd = f"ffmpeg -i {str(scene.iphone_video_mask_path)} -pix_fmt gray -start_number 0 {scene.iphone_video_mask_dir}/frame_%06d.png"
+        run_command(cmd, verbose=True, raise_on_error=True)
+        return
+    stride, frame_ids = frame_subset if frame_subset is not None else (1, None)
+    if video_backend == 'ffmpeg':
+        ffmpeg_extract_frames(scene.iphone_video_mask_path, scene.iphone_video_mask_dir, '.png', stride, frame_ids,
+                              ffmpeg_args='-pix_fmt gray')
+    else:
+        write_video_frames(scene.iphone_video_mask_path, scene.iphone_video_mask_dir, '.png', stride, frame_ids,
+                           gray=True)
+
+def extract_depth(scene, depth_format='png', compression='none', num_workers=0, sample_rate=1):
+    '''
+    depth_format: png writes one uint16 png per frame to iphone/depth,
+        container writes all frames to a single DepthContainer file
+    compression: none or lz4, only used for the container
+    num_workers: decode (and encode the pngs of) per-frame compressed depth in a process pool
+    sample_rate: only extract every sample_rate-th frame, keeping the original frame ids
+    '''
     height, width = 192, 256
-    sample_rate = 1
-    scene.iphone_depth_dir.mkdir(parents=True, exist_ok=True)
 
-    try:
-        with open(scene.iphone_depth_path, 'rb') as infile:
-            data = infile.read()
-            data = zlib.decompress(data, wbits=-zlib.MAX_WBITS)
-            depth = np.frombuffer(data, dtype=np.float32).reshape(-1, height, width)
-
-        for frame_id in tqdm(range(0, depth.shape[0], sample_rate), desc='decode_depth'):
-            iio.imwrite(f"{scene.iphone_depth_dir}/frame_{frame_id:06}.png", (depth * 1000).astype(np.uint16))
-    # per frame compression with lz4/zlib
-    except:
-        frame_id = 0
-        with open(scene.iphone_depth_path, 'rb') as infile:
-            while True:
-                size = infile.read(4)   # 32-bit integer
-                if len(size) == 0:
-                    break
-                size = int.from_bytes(size, byteorder='little')
-                if frame_id % sample_rate != 0:
-                    infile.seek(size, 1)
-                    frame_id += 1
-                    continue
-
-                # read the whole file
-                data = infile.read(size)
-                try:
-                    # try using lz4
-                    data = lz4.block.decompress(data, uncompressed_size=height * width * 2)  # UInt16 = 2bytes
-                    depth = np.frombuffer(data, dtype=np.uint16).reshape(height, width)
-                except:
-                    # try using zlib
-                    data = zlib.decompress(data, wbits=-zlib.MAX_WBITS)
-                    depth = np.frombuffer(data, dtype=np.float32).reshape(height, width)
-                    depth = (depth * 1000).astype(np.uint16)
-
-                # 6 digit frame id = 277 minute video at 60 fps
-                iio.imwrite(f"{scene.iphone_depth_dir}/frame_{frame_id:06}.png", depth)
-                frame_id += 1
+    if depth_format == 'container':
+        frames = iter_depth_frames(scene.iphone_depth_path, height, width, sample_rate,
+                                   num_workers=num_workers)
+        with DepthContainerWriter(scene.iphone_depth_container_path, (height, width),
+                                  dtype=np.uint16, compression=compression) as writer:
+            for frame_id, depth in tqdm(frames, desc='decode_depth'):
+                writer.write(depth, name=f"frame_{frame_id:06}")
+        return
+
+    assert depth_format == 'png', f'Unknown depth format: {depth_format}'
+    scene.iphone_depth_dir.mkdir(parents=True, exist_ok=True)
+    frames = iter_depth_frames(scene.iphone_depth_path, height, width, sample_rate,
+                               num_workers=num_workers, out_dir=scene.iphone_depth_dir)
+    for _ in tqdm(frames, desc='decode_depth'):
+        pass
 
 def main(args):
     cfg = load_yaml_munch(args.config_file)
@@ -90,19 +96,47 @@ def main(args):
             split_path = Path(cfg.data_root) / 'splits' / f'{split}.txt'
             scene_ids += read_txt_list(split_path)
 
-    # get the options to process
+    num_workers = cfg.get('num_workers', 0)
+    if num_workers == -1:
+        num_workers = os.cpu_count()
+    cpu_budget = cfg.get('cpu_budget', 1)
+    if cpu_budget == -1:
+        cpu_budget = os.cpu_count()
+
+    # the extraction tasks of all scenes run concurrently, limited per task type
+    # and by the total cpu budget
+    scheduler = TaskScheduler(
+        type_limits=cfg.get('task_limits', {}),
+        cpu_budget=cpu_budget,
+        type_costs=cfg.get('task_costs', {}),
+    )
+    video_backend = cfg.get('video_backend', 'ffmpeg')
+
+    def extract_video(extract_fn, scene):
+        extract_fn(scene, get_frame_ids(scene, cfg), video_backend)
+
     # go through each scene
-    for scene_id in tqdm(scene_ids, desc='scene'):
+    for scene_id in scene_ids:
         scene = ScannetppScene_Release(scene_id, data_root=Path(cfg.data_root) / 'data')
 
         if cfg.extract_rgb:
-            extract_rgb(scene)
+            scheduler.add(scene_id, 'rgb', extract_video, extract_rgb, scene)
 
         if cfg.extract_masks:
-            extract_masks(scene)
+            scheduler.add(scene_id, 'masks', extract_video, extract_masks, scene)
 
         if cfg.extract_depth:
-            extract_depth(scene)
+            scheduler.add(scene_id, 'depth', extract_depth, scene,
+                          depth_format=cfg.get('depth_format', 'png'),
+                          compression=cfg.get('depth_compression', 'none'),
+                          num_workers=num_workers, sample_rate=cfg.get('sample_rate', 1))
+
+    start_time = time.perf_counter()
+    with tqdm(total=len(scheduler), desc='task') as pbar:
+        results = scheduler.run(progress=lambda result: pbar.update(1))
+    print(format_summary(results, time.perf_counter() - start_time))
+    if not all(result.ok for result in results):
+        sys.exit(1)
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser()
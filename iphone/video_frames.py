@@ -0,0 +1,180 @@
+'''
+Extract a subset of the frames of the iPhone videos (rgb.mp4, rgb_mask.mkv)
+
+Frames are identified by their index in the video, frame n is stored as frame_{n:06}.
+The subset is given by a stride or an explicit list of frame ids, e.g. the images of
+the COLMAP model. Frames are either extracted with the ffmpeg select filter, or decoded
+in-process (PyAV if installed, otherwise OpenCV) and written or passed to a consumer
+'''
+
+import shutil
+import tempfile
+from pathlib import Path
+
+import cv2
+
+from common.utils.colmap import read_images_text
+from common.utils.utils import run_command
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+def frame_name(frame_id, ext):
+    # 6 digit frame id = 277 minute video at 60 fps
+    return f"frame_{frame_id:06}{ext}"
+
+
+def frame_id_from_name(name):
+    '''
+    frame_000123.jpg -> 123
+    '''
+    return int(Path(name).stem.split("_")[-1])
+
+
+def frame_ids_from_colmap(images_txt_path):
+    '''
+    sorted ids of the frames registered in a COLMAP images.txt
+    '''
+    images = read_images_text(images_txt_path, pose_only=True, columnar=True)
+    return sorted({frame_id_from_name(name) for name in images.names})
+
+
+def get_frame_ids(scene, cfg):
+    '''
+    frame subset given by the config: None (all frames), a stride (frame_stride)
+    or the frames of the COLMAP model (frames_from_colmap), subsampled with the stride
+    returns: None for all frames, or (stride, frame_ids) with frame_ids None for a plain stride
+    '''
+    stride = cfg.get('frame_stride', 1)
+    if cfg.get('frames_from_colmap', False):
+        frame_ids = frame_ids_from_colmap(scene.iphone_colmap_dir / 'images.txt')
+        return 1, frame_ids[::stride]
+    if stride == 1:
+        return None
+    return stride, None
+
+
+def _is_selected(frame_id, stride, frame_ids):
+    if frame_ids is not None:
+        return frame_id in frame_ids
+    return frame_id % stride == 0
+
+
+def _last_frame_id(frame_ids):
+    return max(frame_ids) if frame_ids is not None and len(frame_ids) > 0 else None
+
+
+def iter_video_frames(video_path, stride=1, frame_ids=None, gray=False):
+    """Decode a subset of the frames of a video in-process.
+
+    Frames that are not selected are decoded (the video is inter-frame compressed) but
+    not converted, and decoding stops after the last selected frame.
+
+    Args:
+        video_path: Path of the video.
+        stride: Select every stride-th frame, ignored if frame_ids is given.
+        frame_ids: Optional ids (indices in the video) of the selected frames.
+        gray: Return single-channel images, e.g. for the masks.
+    Returns:
+        Iterator over (frame_id, image) with BGR or gray uint8 images.
+    """
+    if frame_ids is not None:
+        frame_ids = set(frame_ids)
+        if len(frame_ids) == 0:
+            return
+    last_frame_id = _last_frame_id(frame_ids)
+
+    if av is not None:
+        with av.open(str(video_path)) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            for frame_id, frame in enumerate(container.decode(stream)):
+                if _is_selected(frame_id, stride, frame_ids):
+                    yield frame_id, frame.to_ndarray(format="gray" if gray else "bgr24")
+                if last_frame_id is not None and frame_id >= last_frame_id:
+                    break
+        return
+
+    capture = cv2.VideoCapture(str(video_path))
+    if not capture.isOpened():
+        raise IOError(f"Failed to open video: {video_path}")
+    try:
+        frame_id = 0
+        # grab() decodes without converting the frame
+        while capture.grab():
+            if _is_selected(frame_id, stride, frame_ids):
+                ok, image = capture.retrieve()
+                if not ok:
+                    raise IOError(f"Failed to decode frame {frame_id} of {video_path}")
+                if gray and image.ndim == 3:
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                yield frame_id, image
+            if last_frame_id is not None and frame_id >= last_frame_id:
+                break
+            frame_id += 1
+    finally:
+        capture.release()
+
+
+def write_video_frames(video_path, out_dir, ext, stride=1, frame_ids=None, gray=False, jpeg_quality=100):
+    '''
+    decode the selected frames in-process and write them as out_dir/frame_{id:06}{ext}
+    returns: number of written frames
+    '''
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if ext.lower() in (".jpg", ".jpeg") else []
+    num_frames = 0
+    for frame_id, image in iter_video_frames(video_path, stride, frame_ids, gray):
+        cv2.imwrite(str(out_dir / frame_name(frame_id, ext)), image, params)
+        num_frames += 1
+    return num_frames
+
+
+def select_filter(stride=1, frame_ids=None):
+    '''
+    ffmpeg select filter for the frame subset, consecutive frame ids are merged into ranges
+    '''
+    if frame_ids is None:
+        return f"select='not(mod(n,{stride}))'"
+    frame_ids = sorted(set(frame_ids))
+    ranges = []
+    for frame_id in frame_ids:
+        if len(ranges) > 0 and ranges[-1][1] == frame_id - 1:
+            ranges[-1][1] = frame_id
+        else:
+            ranges.append([frame_id, frame_id])
+    terms = [f"eq(n,{a})" if a == b else f"between(n,{a},{b})" for a, b in ranges]
+    return f"select='{'+'.join(terms)}'"
+
+
+def ffmpeg_extract_frames(video_path, out_dir, ext, stride=1, frame_ids=None, ffmpeg_args="", verbose=True):
+    '''
+    extract the selected frames with the ffmpeg select filter, the filter is passed in a
+    script file since lists of frame ids exceed the command line length. ffmpeg numbers
+    the output frames sequentially, they are renamed to the ids of the selected frames
+    returns: number of extracted frames
+    '''
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=out_dir, prefix=".extract") as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        filter_path = tmp_dir / "select.txt"
+        filter_path.write_text(select_filter(stride, frame_ids))
+        cmd = (
+            f"ffmpeg -i {video_path} -filter_script:v {filter_path} -vsync 0 {ffmpeg_args} "
+            f"-start_number 0 {tmp_dir}/out_%06d{ext}"
+        )
+        run_command(cmd, verbose=verbose, raise_on_error=True)
+
+        outputs = sorted(tmp_dir.glob(f"out_*{ext}"))
+        if frame_ids is not None:
+            selected_ids = sorted(set(frame_ids))
+        else:
+            selected_ids = [i * stride for i in range(len(outputs))]
+        for output, frame_id in zip(outputs, selected_ids):
+            shutil.move(str(output), str(out_dir / frame_name(frame_id, ext)))
+    return len(outputs)
@@ -5,8 +5,8 @@ from torch.utils.data import Dataset
 from tqdm import tqdm
 import open3d as o3d
 
-from common.file_io import load_json
 from common.scene_release import ScannetppScene_Release
+from common.data_manifest import load_data_manifest
 
 class ScannetPP_Release_Dataset(Dataset):
     def __init__(self, data_root, list_file=None, transform=None,
@@ -25,22 +25,28 @@ class ScannetPP_Release_Dataset(Dataset):
         self.samples = []
         self.no_mesh = no_mesh
 
+        # with a manifest, the existence checks do not touch the filesystem
+        manifest = load_data_manifest(data_root)
+
         if list_file is not None:
             with open(list_file) as f:
                 scene_list = f.read().splitlines()
+        elif manifest is not None:
+            scene_list = manifest.scene_ids
         else:
             scene_list = os.listdir(data_root)
 
         for scene_id in tqdm(scene_list, 'dataset'):
-            scene = ScannetppScene_Release(scene_id, data_root=data_root)
+            scene = ScannetppScene_Release(scene_id, data_root=data_root, manifest=manifest)
 
             anno_path = scene.scan_anno_json_path
             mesh_path = scene.scan_mesh_path
             segs_path = scene.scan_mesh_segs_path
 
-            if anno_path.is_file() and mesh_path.is_file() and segs_path.is_file():
+            if scene.has('scan_anno_json_path') and scene.has('scan_mesh_path') and scene.has('scan_mesh_segs_path'):
                 self.samples.append({
                     'scene_id': scene_id,
+                    'scene': scene,
                     'anno': anno_path,
                     'mesh': mesh_path,
                     'segs': segs_path
@@ -56,10 +62,13 @@ class ScannetPP_Release_Dataset(Dataset):
         else:
             # load mesh vertices and colors
             mesh = o3d.io.read_triangle_mesh(str(sample['mesh']))
-        # load segments = vertices per segment ID
-        segments = load_json(sample['segs'])
+        scene = sample['scene']
+        # load segments = vertices per segment ID, shared through the asset cache
+        segments = scene.load_segments()
         # load anno = (instance, groups of segments)
-        anno = load_json(sample['anno'])
+        # the transforms add labels to the seg groups, copy them instead of the cached ones
+        anno = scene.load_annotations()
+        anno = {**anno, 'segGroups': [dict(group) for group in anno['segGroups']]}
 
         sample = {
             'scene_id': sample['scene_id'],
@@ -37,8 +37,6 @@ from common.file_io import load_json, load_yaml_munch, read_txt_list
 from common.scene_release import ScannetppScene_Release
 from common.utils.rle import rle_decode
 
-import warnings
-
 
 def evaluate_matches(matches, label_info, eval_opts):
     '''
@@ -426,10 +424,8 @@ def evaluate(pred_files, gt_files, preds_dir, data_root, label_info, eval_opts):
         # create scene object to get the mesh mask
         scene = ScannetppScene_Release(scene_id, data_root=data_root)
 
-        # vertices to ignore for eval
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=UserWarning, append=1)
-            ignore_mask = np.loadtxt(scene.scan_mesh_mask_path, dtype=np.int32)
+        # vertices to ignore for eval, cached across evaluations in this process
+        ignore_mask = scene.load_mesh_mask()
 
         matches_key = os.path.abspath(gt_files[scene_ndx])
 
@@ -7,6 +7,7 @@ from tqdm import tqdm
 from pathlib import Path
 
 import matplotlib.pyplot as plt
+from PIL import Image
 import open3d as o3d
 import numpy as np
 import torch
@@ -15,19 +16,11 @@ import sys
 import pickle
 sys.path.append('/usr/prakt/s0090')
 
-from pytorch3d.structures import Meshes
-from pytorch3d.utils import cameras_from_opencv_projection
-from pytorch3d.renderer import (
-    RasterizationSettings, 
-    MeshRasterizer,  
-    fisheyecameras
-)
-
-
-from scannetpp.common.scene_release import ScannetppScene_Release
+from scannetpp.common.scene_release import ScannetppScene_Release, mesh_to_o3d
 from scannetpp.common.file_io import load_json, load_yaml_munch, read_txt_list
+from scannetpp.common.rasterize_utils import prep_pt3d_inputs, rasterize_mesh_batched
 
-from semantic.utils.colmap_utils import read_cameras_text, read_images_text, camera_to_intrinsic
+from semantic.utils.colmap_utils import camera_to_intrinsic, world_to_camera_batch, image_poses
 
 if torch.cuda.is_available():
     device = torch.device("cuda:0")
@@ -43,61 +36,51 @@ def main(args):
     scene_list = read_txt_list(cfg.scene_list)
 
     pth_data_dir = Path(cfg.pth_data_dir)
+    # pytorch3d or cpu (common/utils/cpu_rasterizer.py)
+    raster_backend = cfg.get('raster_backend', 'pytorch3d')
+    # rasterize only the faces in the frustum of each image
+    cull_faces = cfg.get('cull_faces', True)
     semantic_classes = read_txt_list(cfg.semantic_labels_path)
 
     for scene_id in tqdm(scene_list, desc='scene'):
         # print('Scene:', scene_id)
         scene = ScannetppScene_Release(scene_id, data_root=cfg.data_root)
-        # read mesh
-        mesh = o3d.io.read_triangle_mesh(str(scene.scan_mesh_path)) 
+        # read mesh, MeshArrays with read-only vertices and triangles
+        mesh = scene.load_mesh()
         # read annotation
         pth_data = torch.load(pth_data_dir / f'{scene_id}.pth')
 
         # list of dslr images
-        dslr_names_all = load_json(scene.dslr_train_test_lists_path)['train']
+        dslr_names_all = scene.load_train_test_lists()['train']
         # pick every nth dslr image and corresponding camera pose
         dslr_indices = list(range(0, len(dslr_names_all), cfg.dslr_subsample_factor))
         dslr_names = [dslr_names_all[i] for i in dslr_indices]
 
-        # read camera intrinsics
-        intrinsics_file = scene.dslr_colmap_dir / 'cameras.txt'
+        # read camera intrinsics and extrinsics, shared through the asset cache
+        cameras, all_extrinsics, _ = scene.load_colmap_model('dslr', pose_only=True)
         # there is only 1 camera model, get it
-        colmap_camera = list(read_cameras_text(intrinsics_file).values())[0]
+        colmap_camera = list(cameras.values())[0]
         # params [0,1,2,3] give the intrinsic
         intrinsic_mat = camera_to_intrinsic(colmap_camera)
         # rest are the distortion params
-        # need 6 radial params
-        distort_params = list(colmap_camera.params[4:]) + [0, 0]
+        distort_params = colmap_camera.params[4:]
 
-        extrinsics_file = scene.dslr_colmap_dir / 'images.txt'
-        all_extrinsics = read_images_text(extrinsics_file)
         # get the extrinsics for the selected images into a dict with filename as key
-        all_extrinsics_dict = {v.name: v.to_transform_mat() for v in all_extrinsics.values()}
-
-        # create meshes object
-        verts = torch.Tensor(np.array(mesh.vertices))
-        faces = torch.Tensor(np.array(mesh.triangles))
-        meshes = Meshes(verts=[verts.to(device)], faces=[faces.to(device)])
-        
-        # go through dslr images
-        for _, image_name in enumerate(tqdm(dslr_names, desc='image')):
+        all_extrinsics_dict = dict(zip(
+            [v.name for v in all_extrinsics.values()],
+            world_to_camera_batch(*image_poses(all_extrinsics)),
+        ))
+
+        mesh_faces_np = mesh.triangles
+        # grid over the mesh faces, built once per scene
+        face_index = scene.load_face_index() if cull_faces else None
+        # create meshes object once, (vertices, faces) for the cpu backend
+        _, _, meshes = prep_pt3d_inputs(mesh, device=device, backend=raster_backend)
+
+        def process_image(image_name, img_height, img_width, pix_to_face):
             # draw the camera frustum on the mesh
             camera_pose = all_extrinsics_dict[image_name]
 
-            # read image and get dims
-            image_path = scene.dslr_resized_dir / image_name
-            image = plt.imread(image_path)
-            # get h, w from image
-            img_height, img_width = image.shape[:2]
-
-            raster_settings = RasterizationSettings(image_size=(img_height, img_width), 
-                                                blur_radius=0.0, 
-                                                faces_per_pixel=1,
-                                                cull_to_frustum=True)
-            rasterizer = MeshRasterizer(
-                raster_settings=raster_settings
-            )
-
             camera_lines = o3d.geometry.LineSet.create_camera_visualization(
                 view_width_px=img_width,
                 view_height_px=img_height,
@@ -105,58 +88,8 @@ def main(args):
                 extrinsic=camera_pose
             )
             
-            # get 2d-3d mapping of this image by rasterizing, add a dimension in the beginning
-            R = torch.Tensor(camera_pose[:3, :3]).unsqueeze(0)
-            T = torch.Tensor(camera_pose[:3, 3]).unsqueeze(0)
-
-            # create camera with opencv function
-            image_size = torch.Tensor((img_height, img_width))
-            image_size_repeat = torch.tile(image_size.reshape(-1, 2), (1, 1))
-            intrinsic_repeat = torch.Tensor(intrinsic_mat).unsqueeze(0).expand(1, -1, -1)
-            
-            opencv_cameras = cameras_from_opencv_projection(
-                # N, 3, 3
-                R=R,
-                # N, 3
-                tvec=T,
-                # N, 3, 3
-                camera_matrix=intrinsic_repeat,
-                # N, 2 h,w
-                image_size=image_size_repeat
-            )
-
-            # apply the same transformation for fisheye cameras 
-            # transpose R, then negate 1st and 2nd columns
-            fisheye_R = R.mT
-            fisheye_R[:, :, :2] *= -1
-            # negate x and y in the transformation T
-            # negate everything
-            fisheye_T = -T
-            # negate z back
-            fisheye_T[:, -1] *= -1
-
-            # focal, center, radial_params, R, T, use_radial
-            fisheye_cameras = fisheyecameras.FishEyeCameras(
-                focal_length=opencv_cameras.focal_length,
-                principal_point=opencv_cameras.principal_point,
-                radial_params=torch.Tensor([distort_params]),
-                use_radial=True,
-                R=fisheye_R,
-                T=fisheye_T,
-                image_size=image_size_repeat,
-                # need to specify world coordinates, otherwise camera coordinates
-                world_coordinates=True
-            )  
-
-            # rasterize
-            with torch.no_grad():
-                raster_out = rasterizer(meshes, cameras=fisheye_cameras.to(device))
-                # H, W
-                pix_to_face = raster_out.pix_to_face.squeeze().cpu().numpy()
-
             valid_pix_to_face =  pix_to_face[:, :] != -1
             face_ndx = pix_to_face[valid_pix_to_face]
-            mesh_faces_np = np.array(mesh.triangles) 
             faces_in_img = mesh_faces_np[face_ndx]
 
             # get the set of vertices visible from this image 
@@ -176,7 +109,7 @@ def main(args):
                 # get vertices as numbers
                 obj_vert_ndx = np.where(obj_mask)[0]
                 # get the vertex coordinates and bbox of this object
-                obj_verts = np.array(mesh.vertices)[obj_vert_ndx]
+                obj_verts = mesh.vertices[obj_vert_ndx]
                 obj_bbox = o3d.geometry.AxisAlignedBoundingBox.create_from_points(o3d.utility.Vector3dVector(obj_verts))
                 # change bbox color to red
                 obj_bbox.color = (1, 0, 0)
@@ -220,7 +153,7 @@ def main(args):
                 geoms += obj_bboxes
                 # display the mesh and camera
                 geoms.append(camera_lines)
-                geoms.append(mesh)
+                geoms.append(mesh_to_o3d(mesh))
 
                 o3d.visualization.draw_geometries(geoms)
 
@@ -240,6 +173,29 @@ def main(args):
                 plt.axis('off')
                 plt.show()
 
+        # get h, w from the image headers, images of the same size are rasterized in batches
+        names_by_size = {}
+        for image_name in dslr_names:
+            with Image.open(scene.dslr_resized_dir / image_name) as image:
+                names_by_size.setdefault((image.height, image.width), []).append(image_name)
+
+        # go through dslr images
+        progress = tqdm(total=len(dslr_names), desc='image')
+        for (img_height, img_width), image_names in names_by_size.items():
+            def callback(idx, raster_out_dict):
+                # H, W
+                pix_to_face = np.asarray(raster_out_dict['pix_to_face'])[0, :, :, 0]
+                process_image(image_names[idx], img_height, img_width, pix_to_face)
+                progress.update()
+
+            rasterize_mesh_batched(
+                meshes, img_height, img_width,
+                np.stack([all_extrinsics_dict[image_name] for image_name in image_names]),
+                intrinsic_mat, callback, batch_size=cfg.get('raster_batch_size'), device=device,
+                backend=raster_backend, camera_model=colmap_camera.model, distort_params=distort_params,
+                face_index=face_index,
+            )
+        progress.close()
 
 
 if __name__ == "__main__":
@@ -5,6 +5,11 @@ from here: https://github.com/colmap/colmap/blob/dev/scripts/python/read_write_m
 import collections
 import numpy as np
 
+# pose math is shared with the main COLMAP reader
+from common.utils.colmap import (
+    qvec2rotmat, qvec2rotmat_batch, world_to_camera_batch, camera_to_world_batch, image_poses
+)
+
 CameraModel = collections.namedtuple(
     "CameraModel", ["model_id", "model_name", "num_params"])
 Camera = collections.namedtuple(
@@ -28,22 +33,6 @@ def camera_to_intrinsic(camera):
         [0, 0, 1]
     ])
 
-def qvec2rotmat(qvec):
-    '''
-    quaternion to rotmat
-    '''
-    return np.array([
-        [1 - 2 * qvec[2]**2 - 2 * qvec[3]**2,
-         2 * qvec[1] * qvec[2] - 2 * qvec[0] * qvec[3],
-         2 * qvec[3] * qvec[1] + 2 * qvec[0] * qvec[2]],
-        [2 * qvec[1] * qvec[2] + 2 * qvec[0] * qvec[3],
-         1 - 2 * qvec[1]**2 - 2 * qvec[3]**2,
-         2 * qvec[2] * qvec[3] - 2 * qvec[0] * qvec[1]],
-        [2 * qvec[3] * qvec[1] - 2 * qvec[0] * qvec[2],
-         2 * qvec[2] * qvec[3] + 2 * qvec[0] * qvec[1],
-         1 - 2 * qvec[1]**2 - 2 * qvec[2]**2]])
-
-
 class Image(BaseImage):
     def to_transform_mat(self):
         '''
@@ -84,11 +73,12 @@ def read_cameras_text(path):
                                             params=params)
     return cameras
 
-def read_images_text(path):
+def read_images_text(path, pose_only=False):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadImagesText(const std::string& path)
         void Reconstruction::WriteImagesText(const std::string& path)
+    pose_only: skip parsing the 2D points, the images have empty xys and point3D_ids
     """
     images = {}
     with open(path, "r") as fid:
@@ -104,10 +94,15 @@ def read_images_text(path):
                 tvec = np.array(tuple(map(float, elems[5:8])))
                 camera_id = int(elems[8])
                 image_name = elems[9]
-                elems = fid.readline().split()
-                xys = np.column_stack([tuple(map(float, elems[0::3])),
-                                       tuple(map(float, elems[1::3]))])
-                point3D_ids = np.array(tuple(map(int, elems[2::3])))
+                points_line = fid.readline()
+                if pose_only:
+                    xys = np.zeros((0, 2))
+                    point3D_ids = np.zeros(0, dtype=np.int64)
+                else:
+                    elems = points_line.split()
+                    xys = np.column_stack([tuple(map(float, elems[0::3])),
+                                           tuple(map(float, elems[1::3]))])
+                    point3D_ids = np.array(tuple(map(int, elems[2::3])))
                 images[image_id] = Image(
                     id=image_id, qvec=qvec, tvec=tvec,
                     camera_id=camera_id, name=image_name,
@@ -5,7 +5,7 @@ Read training data from pth and visualize it
 import argparse
 from pathlib import Path
 import os
-from common.scene_release import ScannetppScene_Release
+from common.scene_release import ScannetppScene_Release, mesh_to_o3d
 
 import torch
 import open3d as o3d
@@ -47,7 +47,8 @@ def main(args):
         scene = ScannetppScene_Release(scene_id, data_root=cfg.data_root)
 
         if cfg.viz_mesh:
-            mesh = o3d.io.read_triangle_mesh(str(scene.scan_mesh_path))
+            # a new mesh object from the cached arrays, its colors are modified below
+            mesh = mesh_to_o3d(scene.load_mesh())
 
         if cfg.viz_semantic:
             labels = pth_data[f'{prop_type}labels']
@@ -0,0 +1,86 @@
+'''
+Decoding of globally zlib-compressed iPhone depth.bin files
+'''
+
+import tracemalloc
+import zlib
+
+import numpy as np
+import pytest
+
+from iphone.depth_decoder import iter_depth_frames
+
+HEIGHT, WIDTH = 192, 256
+
+
+def synthetic_depth(frame_id):
+    '''
+    float32 depth in m that differs per frame, the noise keeps the compressed frames
+    large enough that the files of all tested lengths fill the read buffer of the decoder
+    '''
+    y, x = np.mgrid[:HEIGHT, :WIDTH].astype(np.float32)
+    noise = np.random.default_rng(frame_id).random((HEIGHT, WIDTH), dtype=np.float32)
+    return 0.5 + 0.01 * x + 0.005 * y + 0.001 * frame_id + 0.01 * noise
+
+
+def write_global_depth(path, num_frames):
+    '''
+    write the frames as a single raw deflate stream, frame by frame
+    '''
+    compressor = zlib.compressobj(1, wbits=-zlib.MAX_WBITS)
+    with open(path, 'wb') as outfile:
+        for frame_id in range(num_frames):
+            outfile.write(compressor.compress(synthetic_depth(frame_id).tobytes()))
+        outfile.write(compressor.flush())
+
+
+def drain_peak_memory(path, sample_rate):
+    '''
+    decode all frames, check them and return the number of frames and the peak
+    traced memory while decoding
+    '''
+    num_frames = 0
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        for frame_id, depth in iter_depth_frames(path, HEIGHT, WIDTH, sample_rate=sample_rate):
+            assert frame_id == num_frames * sample_rate
+            assert depth.dtype == np.uint16
+            np.testing.assert_array_equal(depth, (synthetic_depth(frame_id) * 1000).astype(np.uint16))
+            num_frames += 1
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return num_frames, peak
+
+
+@pytest.fixture(scope="module")
+def depth_files(tmp_path_factory):
+    tmp_dir = tmp_path_factory.mktemp("depth")
+    paths = {}
+    for num_frames in (50, 500):
+        paths[num_frames] = tmp_dir / f"depth_{num_frames}.bin"
+        write_global_depth(paths[num_frames], num_frames)
+    return paths
+
+
+@pytest.mark.parametrize("sample_rate", [1, 4])
+def test_global_depth_memory_is_flat(depth_files, sample_rate):
+    peaks = {}
+    for num_frames, path in depth_files.items():
+        decoded, peaks[num_frames] = drain_peak_memory(path, sample_rate)
+        assert decoded == len(range(0, num_frames, sample_rate))
+
+    frame_nbytes = HEIGHT * WIDTH * 4
+    # 450 more frames would add 88 MB if the capture were held in memory
+    assert peaks[500] < peaks[50] + 2 * frame_nbytes
+
+
+def test_global_depth_incomplete_frame(tmp_path):
+    path = tmp_path / "depth.bin"
+    with open(path, 'wb') as outfile:
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        outfile.write(compressor.compress(synthetic_depth(0).tobytes()[:-4]))
+        outfile.write(compressor.flush())
+    with pytest.raises(ValueError):
+        list(iter_depth_frames(path, HEIGHT, WIDTH))